@@ -1,8 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_api import status
 import sys
+import os
+import gzip
+import hashlib
 import json
+import signal
+import time
 import markdown.extensions.fenced_code
+import profiler
+from cache import VerdictCache
+from decoders import scan_complete, select_decoder
+from decoding import decoding
+from fastpath import FastPath, is_json
+from forms import inspected, scan_query, scanner_for
+from limits import Limits, LimitExceeded
+from metrics import Metrics
+from pool import ScanPool, PoolSaturated
+from proxy import Proxy, UpstreamPool
+from ratelimit import BucketSketch, RateLimiter, parse_rates
+from rules import load_rules
+from scanner import BodyScanner, NO_MATCH
 
 
 # A simple HTTP service that will accept requests
@@ -14,24 +32,121 @@ import markdown.extensions.fenced_code
 # then the request should generate a 403 Forbidden response. For example:
 #   { "is_malicious": true } and { "hidden": { "is_malicious": true } } => 403 Forbidden
 #   { "is_malicious": false } and { "data": null } => 200 OK
+#
+# The { "is_malicious": true } check is the default rule in rules.json. More rules (forbidden keys,
+# keys with specific values, key prefixes) can be added there, or loaded from the file named by the
+# WAF_RULES environment variable; each rule has its own status code and response message.
 
 app = Flask(__name__)
-app.config["DEBUG"] = True
+app.config["DEBUG"] = os.getenv("WAF_DEBUG", default="0") == "1"  # never enable the debugger in production
 
 success = {"status": "success", "code": 200,
            "message": ""}  # success response body
-forbidden = {"status": "error", "code": 403,
-             "message": "is_malicious found"}  # forbidden response body
+busy = {"status": "error", "code": 503,
+        "message": "scanner busy, retry later"}  # response body when the scanner pool is saturated
+unavailable = {"status": "error", "code": 502,
+               "message": "upstream unavailable"}  # response body in proxy mode when the upstream cannot be reached
+bad_request = {"status": "error", "code": 400,
+               "message": "request cannot be forwarded"}  # response body in proxy mode for a malformed header
+limited = {"status": "error", "code": 429,
+           "message": "too many requests, retry later"}  # response body of a client over its rate limit
+unsupported_encoding = {"status": "error", "code": 415,
+                        "message": "compressed batch uploads are not supported"}  # see handleRequests
 IS_MALICIOUS = "is_malicious"
+README_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "README.md")
+RULES_PATH = os.getenv("WAF_RULES", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"))
+RULES = load_rules(RULES_PATH)  # compiled rule set, see rules.py
+# limits on the size and structure of request bodies, enforced while they are read and scanned (see limits.py).
+# 0 disables a limit.
+LIMITS = Limits(
+    max_bytes=int(os.getenv("WAF_MAX_BODY_BYTES", default=64 * 1024 * 1024)),
+    max_depth=int(os.getenv("WAF_MAX_DEPTH", default=10000)),
+    max_elements=int(os.getenv("WAF_MAX_ELEMENTS", default=1000000)),
+    max_string=int(os.getenv("WAF_MAX_STRING", default=1024 * 1024)),
+    max_ratio=float(os.getenv("WAF_MAX_RATIO", default=200)),
+)
+# decoder of JSON bodies that are scanned whole, see decoders.py: "auto" picks the fastest one installed,
+# "stream" tokenizes every body
+DECODER = select_decoder(os.getenv("WAF_JSON_DECODER", default="auto"))
+DECODER_NAME = DECODER.name if DECODER is not None else "stream"
+print("http-waf: JSON decoder %s" % DECODER_NAME, file=sys.stderr)
+# bodies of at least INDEX_MIN_BODY bytes that the decoder leaves to the scanner are first scanned with the
+# structural index when NumPy is installed, see structural.py (0 disables it)
+INDEX_MIN_BODY = int(os.getenv("WAF_INDEX_MIN_BODY", default=1024 * 1024))
+# bodies with a Content-Length of at least OFFLOAD_MIN_BODY are scanned in a pool of processes, see pool.py
+OFFLOAD_MIN_BODY = int(os.getenv("WAF_OFFLOAD_MIN_BODY", default=4 * 1024 * 1024))
+SCAN_WORKERS = int(os.getenv("WAF_SCAN_WORKERS", default=os.cpu_count() or 1))  # 0 disables the pool
+SCAN_POOL = ScanPool(
+    RULES, SCAN_WORKERS,
+    limits=LIMITS,
+    decoder=DECODER_NAME,
+    index_min_body=INDEX_MIN_BODY,
+    max_pending=int(os.getenv("WAF_SCAN_MAX_PENDING", default=2 * SCAN_WORKERS)),
+    wait=float(os.getenv("WAF_SCAN_WAIT", default=0)),
+) if SCAN_WORKERS > 0 else None
+# verdict counters and phase histograms shared by every worker, see metrics.py (WAF_METRICS=0 disables them)
+METRICS = Metrics(RULES, slots=int(os.getenv("WAF_METRICS_SLOTS", default=256)),
+                  info={"json_decoder": DECODER_NAME}) \
+    if os.getenv("WAF_METRICS", default="1") != "0" else None
+# verdicts of recently seen bodies, see cache.py. Bodies with a Content-Length up to CACHE_MAX_BODY
+# and the ones sent to the scanner pool are read whole and looked up by their hash, other bodies are
+# streamed. A larger CACHE_MAX_BODY holds more of each body in memory and gives up the early verdict
+# of streaming.
+CACHE_MAX_BODY = int(os.getenv("WAF_CACHE_MAX_BODY", default=64 * 1024))
+VERDICTS = VerdictCache(
+    max_entries=int(os.getenv("WAF_CACHE_ENTRIES", default=100000)),
+    max_bytes=int(os.getenv("WAF_CACHE_BYTES", default=32 * 1024 * 1024)),
+    ttl=float(os.getenv("WAF_CACHE_TTL", default=300)),
+    metrics=METRICS,
+)
+homepage = None  # rendered README.md, see load_homepage
+CHUNK_SIZE = 64 * 1024  # bytes read from the request body at a time
+MAX_DEPTH = 10000  # default nesting limit of traverse_object
 
 # Return the README.md file as the homepage
+# The page is served from memory as pre-encoded bytes with a strong ETag, a gzip variant for clients
+# that accept it, and 304 Not Modified for conditional requests that already have the current page.
 @app.route('/', methods=['GET'])
 def home():
-    readme_file = open("README.md", "r")
-    md_template_string = markdown.markdown(
-        readme_file.read(), extensions=["fenced_code"]
-    )
-    return md_template_string
+    page = load_homepage()
+    gzipped = request.accept_encodings['gzip'] > 0
+    etag = page["gzip_etag"] if gzipped else page["etag"]
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(page["gzip_body"] if gzipped else page["body"], mimetype="text/html")
+        if gzipped:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"  # clients revalidate with If-None-Match
+    return response
+
+
+# Render README.md into the homepage the first time it is needed, and again whenever the file changes.
+# output: dict with the rendered body, its gzip variant and the ETag of each
+def load_homepage():
+    global homepage
+    mtime = os.stat(README_PATH).st_mtime_ns
+    page = homepage
+    if page is None or page["mtime"] != mtime:
+        with open(README_PATH, "r") as readme_file:
+            md_template_string = markdown.markdown(
+                readme_file.read(), extensions=["fenced_code"]
+            )
+        body = md_template_string.encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+        page = {
+            "mtime": mtime,
+            "body": body,
+            "etag": etag,
+            "gzip_body": gzip.compress(body, mtime=0),
+            "gzip_etag": etag + "-gzip",
+        }
+        homepage = page
+    return page
+
 
 # Function to handle 404 errors.
 # Simply displays instructions for connecting.
@@ -42,33 +157,200 @@ def page_not_found(e):
                     <p> ex: localhost:5000/api/handle-request with request body { "is_malicious": true/false } </p>""", 404
 
 # Function to act as Web Application Firewall, handles http requests.
-# if request body contains { "is_malicious": true }
-#   returns 403 Forbidden
+# if request body contains { "is_malicious": true } (or a pair any other rule forbids)
+#   returns 403 Forbidden (or the status and message of that rule)
+# if request body is over one of the LIMITS
+#   returns 413 Payload Too Large (size) or 400 Bad Request (depth, elements, string length)
 # else returns 200 Ok
 #
+# The body is read from the input stream chunk by chunk (this also covers chunked transfer-encoding)
+# and fed to an incremental scanner, so a malicious request is rejected as soon as the pair is seen
+# without reading or decoding the rest of the body. Bodies with a gzip or deflate Content-Encoding are
+# decompressed chunk by chunk on the way to the scanner (see decoding.py). Besides JSON bodies, the
+# fields of form-encoded and multipart bodies and of the query string are checked (see forms.py).
+#
 # Function/Assignment acts as a firewall so should handle all methods with a body (all methods can have body per RFCs 7230-7237)
 @app.route('/api/handle-request', methods=['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH'])
 def handleRequest():
-    try:  # try to deserialize request body
-        req_data = request.get_json()  # convert the JSON object into Python data for us
-    except ValueError:  # if no text or bad format
-        return success  # return 200 OK as there is no { "is_malicious": true }
+    start = time.perf_counter()
+    rule = None
+    try:
+        rule = scan_request(request.stream, request.content_length, request.headers.get("Content-Encoding"),
+                            request.headers.get("Content-Type", ""), request.query_string)
+    except PoolSaturated:  # too many large bodies in flight, ask the client to come back
+        response = busy, status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": "1"}
+    except LimitExceeded as error:  # rejected before the rest of the body is read or scanned
+        response = error.response, error.status
+    else:
+        if rule:
+            # return the informative response of the rule with its status code (403 FORBIDDEN by default)
+            response = rule.response, rule.status
+        else:
+            # return informative success object with status code 200 OK
+            # (this includes bodies that are not valid JSON, as there is no { "is_malicious": true })
+            response = success, status.HTTP_200_OK
+
+    if METRICS is not None:
+        METRICS.record(response[1], rule, request.content_length, time.perf_counter() - start)
+    return response
+
+
+# Batch version of handleRequest for newline-delimited JSON (NDJSON) bodies.
+# Every non-blank line of the body is scanned like a request body of its own, and one verdict line
+# is streamed back per input line as soon as it is known, e.g.
+#   {"status": "success", "code": 200, "message": "", "line": 1}
+#   {"status": "error", "code": 403, "message": "is_malicious found", "rule": "is-malicious", "line": 2}
+# A line over one of the LIMITS gets the 413 or 400 response of that limit; the upload as a whole is not limited.
+# The upload is read chunk by chunk while the verdicts are written, so it is never buffered whole.
+# Compressed uploads are not supported and are answered with 415 Unsupported Media Type.
+@app.route('/api/handle-requests', methods=['POST', 'PUT'])
+def handleRequests():
+    if request.headers.get("Content-Encoding", "identity").strip().lower() != "identity":
+        return unsupported_encoding, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+    def generate():
+        for line, rule in scan_lines(request.stream):
+            verdict = dict(rule.response if rule else success, line=line)
+            yield json.dumps(verdict) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# Read an NDJSON stream chunk by chunk and scan each line against the rules.
+# A line is fed to its own BodyScanner piece by piece, so long lines are not buffered either, and the
+# rest of a line is skipped once its verdict is known.
+# input: a file-like object with a read(size) method
+# output: generator of (line number, the Rule that fired, NO_MATCH or the LimitExceeded of the line),
+#         blank lines are skipped
+def scan_lines(stream, rules=None):
+    rules = rules or RULES
+    number = 1
+    scanner = BodyScanner(rules, LIMITS)
+    verdict = None
+    blank = True  # only whitespace seen on the current line so far
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        start = 0
+        while True:
+            newline = chunk.find(b"\n", start)
+            piece = chunk[start:] if newline < 0 else chunk[start:newline]
+            if piece:
+                blank = blank and not piece.strip()
+                if verdict is None:
+                    try:
+                        verdict = scanner.feed(piece)
+                    except LimitExceeded as error:  # the verdict of the line, skip the rest of it
+                        verdict = error
+            if newline < 0:
+                break
+            if not blank:
+                yield number, verdict if verdict is not None else scanner.close()
+            number += 1
+            scanner = BodyScanner(rules, LIMITS)
+            verdict = None
+            blank = True
+            start = newline + 1
+        if not chunk:  # end of the body, the last line may have no newline
+            if not blank:
+                yield number, verdict if verdict is not None else scanner.close()
+            return
+
 
-    # iterate through the object recursively to get all (key, value) pairs in nested object
-    for key, value in traverse_object(req_data):
+# Scan a request: its query string, then its body if it is JSON, form-encoded or multipart.
+# Pick how to scan a JSON body from its Content-Length:
+#   - bodies of at least OFFLOAD_MIN_BODY are read whole and scanned in the process pool, so they do not
+#     hold the request thread (PoolSaturated is raised when the pool is full)
+#   - bodies up to CACHE_MAX_BODY and the offloaded ones are looked up in the verdict cache first
+#   - other bodies (small ones and chunked ones of unknown length) are streamed through the scanner inline
+# Only bodies without a Content-Encoding are cached, a compressed body is decompressed on every scan.
+# Form-encoded and multipart bodies are always streamed.
+# A Content-Length over the size limit is rejected before the body is read.
+# input: the body stream, its length (None if unknown), its Content-Encoding (None if not sent),
+#        its Content-Type and the query string of the request
+# output: the Rule that fired or NO_MATCH (False)
+# raises LimitExceeded if the body is over one of the LIMITS or its encoding is not supported
+def scan_request(stream, length, encoding=None, content_type="application/json", query=None):
+    if query:
+        verdict = scan_query(query, RULES, LIMITS)
+        if verdict:
+            return verdict
+    if not is_json(content_type):
+        if not inspected(content_type):
+            return NO_MATCH
+        LIMITS.check_length(length)
+        scan = timed(scan_stream, "scan") if METRICS is not None else scan_stream
+        return scan(stream, encoding=encoding, content_type=content_type)
+    LIMITS.check_length(length)
+    offload = SCAN_POOL is not None and length is not None and length >= OFFLOAD_MIN_BODY
+    scan = SCAN_POOL.scan if offload else scan_body
+    if METRICS is not None:
+        scan = timed(scan, "scan")
+    if length is not None and (length <= CACHE_MAX_BODY or offload) and not encoding:
+        # replayed bodies are answered from the verdict cache, identical bodies in flight are scanned once;
+        # offloaded bodies are read whole anyway, the lookup only costs them a hash
+        return VERDICTS.get_or_scan(read_body(stream), RULES, scan)
+    if offload:
+        return scan(read_body(stream), encoding=encoding)
+    if METRICS is not None:
+        return timed(scan_stream, "scan")(stream, encoding=encoding)
+    return scan_stream(stream, encoding=encoding)
 
-        # if the key == "is_malicious" and the value is True
-        if key == IS_MALICIOUS and value == True:
-            # return informative forbidden object with status code 403 FORBIDDEN
-            return forbidden, status.HTTP_403_FORBIDDEN
 
-    # return informative success object with status code 200 OK
-    return success, status.HTTP_200_OK
+# Read a whole body, timing the read phase of the metrics.
+def read_body(stream):
+    if METRICS is None:
+        return stream.read()
+    start = time.perf_counter()
+    body = stream.read()
+    METRICS.observe("read", time.perf_counter() - start)
+    return body
+
+
+# Wrap a function so each call records its duration as a phase of the metrics.
+def timed(function, phase):
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            METRICS.observe(phase, time.perf_counter() - start)
+    return call
+
+
+# Read a body stream chunk by chunk and scan it against the rules.
+# Chunks go through the BodyScanner pipeline (see scanner.py): a body that never contains a key of
+# the rules is answered without being parsed, otherwise reading stops as soon as the verdict is known.
+# input: a file-like object with a read(size) method
+#   encoding - the Content-Encoding of the body, None if it was not sent
+#   content_type - the Content-Type of the body, form-encoded and multipart bodies go through forms.py
+# output: the Rule that fired or NO_MATCH (False)
+def scan_stream(stream, rules=None, encoding=None, content_type="application/json"):
+    scanner = decoding(scanner_for(content_type, rules or RULES, LIMITS), encoding, LIMITS)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return scanner.close()
+        verdict = scanner.feed(chunk)
+        if verdict is not None:
+            return verdict
+
+
+# Scan a complete body against the rules, see scan_complete in decoders.py.
+# input: the raw body bytes
+#   encoding - the Content-Encoding of the body, None if it was not sent
+# output: the Rule that fired or NO_MATCH (False)
+def scan_body(body, rules=None, encoding=None):
+    return scan_complete(body, rules or RULES, LIMITS, DECODER, INDEX_MIN_BODY, encoding)
 
 
 # a generator function to find key value pairs with a depth first search order.
 # Generator computes values as needed rather than computing them all at once and returning as a list.
+# The traversal is iterative: it keeps an explicit stack of iterators (one per open dict or list)
+# instead of recursing, so every pair is yielded directly in O(1) no matter how deep it is nested,
+# and deeply nested objects cannot raise RecursionError.
 # input: Object
+#   max_depth - the maximum nesting depth of dicts and lists, NestingTooDeep is raised beyond it
+#               (None for no limit)
 # output: key, value pairs
 # key - a key or index in object mapped to a value
 # value - value in the object that is not a dictionary, list, or tuple
@@ -95,20 +377,79 @@ def handleRequest():
 # (1, 'form')
 # (2, 'json')
 # ('boolean_test', True)
-def traverse_object(obj, parent_key=None):
+def traverse_object(obj, parent_key=None, max_depth=MAX_DEPTH):
     if isinstance(obj, dict):  # if the object is a dictionary
-        for key, value in obj.items():  # for each key value pair in the dictionary
-            # keep yielding key,value pairs as needed recursively
-            yield from traverse_object(value, key)
+        stack = [iter(obj.items())]
     elif isinstance(obj, list):  # if the object is a list
-        for idx, item in enumerate(obj):  # for each index, item in the list
-            # recursively traverse each object in list
-            yield from traverse_object(item, idx)
+        stack = [enumerate(obj)]
     else:
-        # else(basecase), the obj is not a dict or list just yield the simple parent_key, object pair
+        # the obj is not a dict or list just yield the simple parent_key, object pair
         yield parent_key, obj
+        return
+
+    while stack:
+        # continue with the innermost open dict or list
+        for key, value in stack[-1]:
+            if isinstance(value, dict):  # descend into the dictionary
+                children = iter(value.items())
+            elif isinstance(value, list):  # descend into the list
+                children = enumerate(value)
+            else:
+                # the value is not a dict or list just yield the key, value pair
+                yield key, value
+                continue
+            if max_depth is not None and len(stack) >= max_depth:
+                raise NestingTooDeep(max_depth)
+            stack.append(children)
+            break
+        else:
+            # every item of the innermost dict or list was visited, go back to its parent
+            stack.pop()
+
+
+# Raised by traverse_object when an object is nested deeper than the allowed limit.
+class NestingTooDeep(ValueError):
+    pass
+
+
+# Counters and histograms of every worker in the Prometheus text format, see metrics.py
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS is None:
+        return page_not_found(None)
+    return Response(METRICS.exposition(), mimetype="text/plain; version=0.0.4")
+
+
+# In proxy mode, with WAF_UPSTREAM set to the URL of the backend, every request but /metrics is scanned like
+# a request to /api/handle-request and forwarded to the backend when it is allowed (see proxy.py).
+# Otherwise answer /api/handle-request with the raw WSGI fast path (see fastpath.py) instead of going through
+# Flask routing and JSON serialization. handleRequest remains the same endpoint when WAF_FAST_PATH=0.
+UPSTREAM = os.getenv("WAF_UPSTREAM")
+if UPSTREAM:
+    app.wsgi_app = Proxy(app.wsgi_app, scan_request,
+                         UpstreamPool(UPSTREAM, size=int(os.getenv("WAF_UPSTREAM_CONNECTIONS", default=16)),
+                                      timeout=float(os.getenv("WAF_UPSTREAM_TIMEOUT", default=30))),
+                         unavailable, bad_request, limits=LIMITS, busy=(PoolSaturated, busy), rejected=LimitExceeded,
+                         metrics=METRICS)
+elif os.getenv("WAF_FAST_PATH", default="1") != "0":
+    app.wsgi_app = FastPath(app.wsgi_app, scan_request, success, busy=(PoolSaturated, busy),
+                            rejected=LimitExceeded, metrics=METRICS)
+
+
+# Per-client rate limits of the routes, checked before anything else and before the body is read (see
+# ratelimit.py), e.g. WAF_RATE_LIMITS="/api/handle-request=100:200,*=1000" in requests per second and burst.
+# Clients are told apart by their address, or by the header named in WAF_RATE_LIMIT_KEY.
+RATE_LIMITS = parse_rates(os.getenv("WAF_RATE_LIMITS", default=""))
+if RATE_LIMITS:
+    app.wsgi_app = RateLimiter(app.wsgi_app, RATE_LIMITS, limited, key_header=os.getenv("WAF_RATE_LIMIT_KEY"),
+                               sketch=BucketSketch(cells=int(os.getenv("WAF_RATE_LIMIT_CELLS", default=65536))),
+                               metrics=METRICS)
+
 
+# sampling profiler of the request path, off until WAF_PROFILE=1 or SIGUSR2 (see profiler.py)
+PROFILER = profiler.from_env(app)
 
 
 if __name__ == '__main__': # encapsulate the run
-    app.run(debug=True) # start the app
+    signal.signal(signal.SIGUSR2, PROFILER.toggle)  # start or stop (and dump) the profiler
+    app.run(debug=app.config["DEBUG"]) # start the app
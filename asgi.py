@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+
+from app import LIMITS, METRICS, RULES, success, load_homepage, page_not_found
+from decoding import decoding
+from forms import scan_query, scanner_for
+from limits import LimitExceeded
+
+
+# An asyncio (ASGI) serving mode for the firewall.
+#
+# The Flask app in app.py runs on synchronous workers, so a client that uploads its body
+# slowly pins a whole worker until the upload completes. This module serves the same
+# endpoints as a plain ASGI application: bodies are received asynchronously and fed to the
+# same BodyScanner as handleRequest, so a process can hold thousands of slow uploads while
+# each one only costs a coroutine. Run it with an ASGI server, for example:
+#   uvicorn asgi:app
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+RECEIVE_TIMEOUT = 30  # seconds a client may stall between two chunks of its body
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+SUCCESS_BODY = json.dumps(success).encode("utf-8") + b"\n"
+TIMEOUT_BODY = json.dumps({"status": "error", "code": 408,
+                           "message": "request body timed out"}).encode("utf-8") + b"\n"
+
+
+# The ASGI application, dispatches on the path like the routes of app.py.
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if scope["method"] == "HEAD":  # same headers as GET, without the body
+        send = without_body(send)
+
+    if scope["path"] == "/api/handle-request":
+        await handle_request(scope, receive, send)
+    elif scope["path"] == "/" and scope["method"] in ("GET", "HEAD"):
+        await home(scope, send)
+    elif scope["path"] == "/metrics" and METRICS is not None:
+        await respond(send, 200, [(b"content-type", b"text/plain; version=0.0.4")],
+                      METRICS.exposition().encode("utf-8"))
+    else:
+        html, code = page_not_found(None)
+        await respond(send, code, [(b"content-type", b"text/html; charset=utf-8")], html.encode("utf-8"))
+
+
+# Same as handleRequest in app.py:
+# if request body (or query string) contains { "is_malicious": true } (or a pair any other rule forbids)
+#   returns 403 Forbidden (or the status and message of that rule)
+# if request body is over one of the LIMITS
+#   returns 413 Payload Too Large (size) or 400 Bad Request (depth, elements, string length)
+# else returns 200 Ok
+# Each chunk is scanned as soon as it is received, and the verdict is sent without waiting
+# for the rest of the body once it is known.
+async def handle_request(scope, receive, send):
+    start = time.perf_counter()
+    length = header(scope, b"content-length")
+    length = int(length) if length.isdigit() else None
+    try:
+        verdict = scan_query(scope.get("query_string", b""), RULES, LIMITS)
+        # only JSON, form-encoded and multipart bodies are inspected
+        scanner = None if verdict else scanner_for(header(scope, b"content-type").decode("latin-1"), RULES, LIMITS)
+        if scanner is not None:
+            LIMITS.check_length(length)
+            scanner = decoding(scanner, header(scope, b"content-encoding").decode("latin-1"), LIMITS)
+            verdict = await scan_body(receive, scanner)
+            if verdict is None:  # the client went away
+                return
+    except asyncio.TimeoutError:  # slowloris style upload, give the connection back
+        record(408, None, length, start)
+        await respond(send, 408, JSON_HEADERS, TIMEOUT_BODY)
+        return
+    except LimitExceeded as error:  # rejected before the rest of the body is received or scanned
+        record(error.status, None, length, start)
+        await respond(send, error.status, JSON_HEADERS, error.body)
+        return
+
+    record(verdict.status if verdict else 200, verdict, length, start)
+    if verdict:  # the rule that fired, with its pre-encoded response
+        await respond(send, verdict.status, JSON_HEADERS, verdict.body)
+    else:
+        await respond(send, 200, JSON_HEADERS, SUCCESS_BODY)
+
+
+# Receive a body chunk by chunk and feed each chunk to a scanner as soon as it arrives.
+# output: the verdict, None if the client disconnected
+async def scan_body(receive, scanner):
+    more_body = True
+    while more_body:
+        message = await asyncio.wait_for(receive(), RECEIVE_TIMEOUT)
+        if message["type"] == "http.disconnect":
+            return None
+        more_body = message.get("more_body", False)
+        chunk = message.get("body", b"")
+        if chunk:
+            verdict = scanner.feed(chunk)
+            if verdict is not None:
+                return verdict
+    return scanner.close()
+
+
+# Serve the rendered README.md, see home() in app.py.
+async def home(scope, send):
+    page = load_homepage()
+    gzipped = accepts_gzip(header(scope, b"accept-encoding"))
+    etag = '"%s"' % (page["gzip_etag"] if gzipped else page["etag"])
+    headers = [(b"etag", etag.encode("ascii")), (b"vary", b"Accept-Encoding"), (b"cache-control", b"no-cache")]
+
+    if matches_etag(header(scope, b"if-none-match").decode("latin-1"), etag):
+        await respond(send, 304, headers, b"")
+        return
+    headers.append((b"content-type", b"text/html; charset=utf-8"))
+    if gzipped:
+        headers.append((b"content-encoding", b"gzip"))
+    body = page["gzip_body"] if gzipped else page["body"]
+    await respond(send, 200, headers, body)
+
+
+# record a response in the metrics shared with app.py (see metrics.py)
+def record(code, rule, length, start):
+    if METRICS is not None:
+        METRICS.record(code, rule, length, time.perf_counter() - start)
+
+
+async def respond(send, code, headers, body):
+    await send({
+        "type": "http.response.start",
+        "status": code,
+        "headers": headers + [(b"content-length", str(len(body)).encode("ascii"))],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# wraps the send function of a HEAD request, the body of the response is dropped and its
+# Content-Length kept (see proxy.py)
+def without_body(send):
+    async def send_head(message):
+        if message["type"] == "http.response.body":
+            message = dict(message, body=b"")
+        await send(message)
+    return send_head
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            load_homepage()  # render the homepage before the first request
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# returns the value of a request header (lower case name) or b"" if it was not sent
+def header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return b""
+
+
+# True if an If-None-Match header lists an ETag, or is * (RFC 7232 section 3.2, weak comparison)
+def matches_etag(if_none_match, etag):
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
+
+# True if an Accept-Encoding header allows gzip (and does not give it q=0)
+def accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(b","):
+        name, _, params = coding.partition(b";")
+        if name.strip().lower() in (b"gzip", b"*"):
+            quality = params.strip().lower()
+            if not quality.startswith(b"q="):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
@@ -0,0 +1,311 @@
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import os
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import SHAPES, KB, payload
+
+
+# A load generator for the firewall.
+#
+# pytest-benchmark sends one request at a time, so it says nothing about how the server behaves
+# when many clients hit it at once. This tool drives a running server in one of two modes:
+#   closed loop - a fixed number of clients each send a request, wait for the response, and
+#                 send the next one, so the offered load adapts to the server's speed
+#   open loop - requests are sent at a fixed rate whether or not earlier ones have completed;
+#               latency is measured from the time a request was due, not from the time a client
+#               got around to sending it, so a server that falls behind shows the queueing delay
+#               its users would see instead of hiding it (coordinated omission)
+# Connections are either kept alive and reused or opened for every request, and the bodies are
+# a mix of benign and malicious payloads from payloads.py. The report gives the throughput, the
+# status codes, and the p50/p90/p99/p99.9 latencies from a log bucketed histogram. Threads share
+# the GIL with the response parsing, so use --processes to generate more load than one core can.
+#
+# Example:
+#   python3 benchmarks/loadgen.py --mode open --rate 500 --duration 30 --malicious-ratio 0.1
+
+DEFAULT_URL = "http://localhost:5000/api/handle-request"
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+# Latency histogram with buckets a constant ratio (about 1%) apart, so it uses little memory for
+# any number of samples and any range of latencies, while percentiles stay within 1%.
+class Histogram:
+
+    BUCKETS_PER_E = 100  # buckets per factor of e, ie. a bucket spans a 1% range
+
+    def __init__(self):
+        self.counts = {}  # bucket -> number of samples
+        self.total = 0
+        self.max = 0.0
+
+    # record a latency in seconds
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros) * self.BUCKETS_PER_E)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    # add the samples of another histogram, e.g. from another process
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # the latency in seconds below which the given percentage of the samples fall
+    def percentile(self, percent):
+        if not self.total:
+            return 0.0
+        rank = math.ceil(self.total * percent / 100.0)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                # upper bound of the bucket, but never beyond the largest sample
+                return min(math.exp((bucket + 1) / self.BUCKETS_PER_E) / 1e6, self.max)
+        return self.max
+
+
+# Results of a load run: the latency histogram, the responses by status code and the failed requests.
+class Results:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}  # status code -> number of responses
+        self.errors = 0  # requests that failed without a response (refused, reset, timed out)
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, status, seconds):
+        with self.lock:
+            if status is None:
+                self.errors += 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                self.latency.record(seconds)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        for code, count in other.statuses.items():
+            self.statuses[code] = self.statuses.get(code, 0) + count
+        self.errors += other.errors
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+    def summary(self):
+        responses = sum(self.statuses.values())
+        return {
+            "requests": responses + self.errors,
+            "responses": responses,
+            "errors": self.errors,
+            "seconds": round(self.elapsed, 3),
+            "throughput": round(responses / self.elapsed, 1) if self.elapsed else 0.0,
+            "statuses": {str(code): count for code, count in sorted(self.statuses.items())},
+            "latency_ms": dict([("p%s" % p, round(self.latency.percentile(p) * 1000, 3)) for p in PERCENTILES]
+                               + [("max", round(self.latency.max * 1000, 3))]),
+        }
+
+    # the Results fields that cross a process boundary
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+# An HTTP client sending bodies to the endpoint over one connection at a time.
+class Client:
+
+    def __init__(self, url, keep_alive=True, timeout=10.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.connection = None
+
+    # Send a body and read the whole response.
+    # output: the status code, or None if the request failed
+    def send(self, body):
+        headers = {"Content-Type": "application/json"}
+        if not self.keep_alive:
+            headers["Connection"] = "close"
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.connection.request("POST", self.path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            status = response.status
+            if not self.keep_alive or response.will_close:
+                self.close()
+            return status
+        except (OSError, http.client.HTTPException):
+            self.close()  # reconnect for the next request
+            return None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# Bodies of a run: benign and malicious payloads mixed at the given ratio.
+class Mix:
+
+    def __init__(self, shape="records", size=KB, malicious_ratio=0.0, seed=0):
+        self.benign = payload(shape, size, "absent")
+        self.malicious = payload(shape, size, "late")
+        self.malicious_ratio = malicious_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            return self.malicious if self.random.random() < self.malicious_ratio else self.benign
+
+
+# Run a closed loop: concurrency clients, each sending its next request when the last one completes.
+def closed_loop(url, mix, concurrency, duration, keep_alive=True):
+    results = Results()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def client_loop():
+        client = Client(url, keep_alive)
+        while time.perf_counter() < deadline:
+            body = mix.next()
+            sent = time.perf_counter()
+            status = client.send(body)
+            results.record(status, time.perf_counter() - sent)
+        client.close()
+
+    run_threads(client_loop, concurrency)
+    results.elapsed = time.perf_counter() - start
+    return results
+
+
+# Run an open loop: requests are due at a fixed rate, and up to connections of them are in flight at once.
+def open_loop(url, mix, rate, duration, connections=64, keep_alive=True):
+    results = Results()
+    start = time.perf_counter()
+    total = int(rate * duration)
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def client_loop():
+        client = Client(url, keep_alive)
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            due = start + index / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            status = client.send(mix.next())
+            results.record(status, time.perf_counter() - due)  # includes the time spent waiting for a client
+        client.close()
+
+    run_threads(client_loop, connections)
+    results.elapsed = time.perf_counter() - start
+    return results
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Run the load of the options in one process, the share of a process when there are several.
+def run(options, seed=0):
+    mix = Mix(options.shape, options.size, options.malicious_ratio, seed)
+    if options.mode == "open":
+        return open_loop(options.url, mix, options.rate / options.processes, options.duration,
+                         options.connections, not options.no_keep_alive)
+    return closed_loop(options.url, mix, options.concurrency, options.duration, not options.no_keep_alive)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the firewall with concurrent load and report latencies.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="endpoint to load (default %(default)s)")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed",
+                        help="closed: fixed concurrency, open: fixed request rate (default %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=16, help="clients per process in closed loop mode")
+    parser.add_argument("--rate", type=float, default=200.0, help="requests per second in open loop mode")
+    parser.add_argument("--connections", type=int, default=64,
+                        help="maximum requests in flight per process in open loop mode")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--no-keep-alive", action="store_true", help="open a new connection for every request")
+    parser.add_argument("--shape", choices=SHAPES, default="records", help="payload shape, see payloads.py")
+    parser.add_argument("--size", type=int, default=KB, help="approximate body size in bytes")
+    parser.add_argument("--malicious-ratio", type=float, default=0.1, help="fraction of malicious bodies")
+    parser.add_argument("--processes", type=int, default=1, help="load generating processes")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.processes > 1:
+        with multiprocessing.Pool(options.processes) as pool:
+            shares = pool.starmap(run, [(options, seed) for seed in range(options.processes)])
+        results = Results()
+        for share in shares:
+            results.merge(share)
+    else:
+        results = run(options)
+
+    summary = summary_of(options, results)
+    if options.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(report(summary))
+    return 0 if results.errors == 0 else 1
+
+
+def summary_of(options, results):
+    summary = {
+        "mode": options.mode,
+        "keep_alive": not options.no_keep_alive,
+        "load": ("%g requests/s" % options.rate) if options.mode == "open"
+        else ("%d clients" % (options.concurrency * options.processes)),
+        "payload": "%s %d bytes, %g%% malicious" % (options.shape, options.size, options.malicious_ratio * 100),
+    }
+    summary.update(results.summary())
+    return summary
+
+
+def report(summary):
+    lines = [
+        "%s loop, %s, %s, %s" % (summary["mode"], summary["load"], "keep-alive" if summary["keep_alive"]
+                                 else "new connection per request", summary["payload"]),
+        "%d requests in %.1fs: %.1f responses/s, %d errors" % (summary["requests"], summary["seconds"],
+                                                             summary["throughput"], summary["errors"]),
+        "status codes: " + ", ".join("%s x %d" % item for item in summary["statuses"].items()),
+        "latency (ms):",
+    ]
+    lines.extend("  %-6s %10.3f" % item for item in summary["latency_ms"].items())
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
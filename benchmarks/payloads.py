@@ -0,0 +1,102 @@
+import functools
+
+
+# Synthetic request bodies for the in-process benchmarks.
+#
+# Every payload is JSON of roughly a requested size (within a few hundred bytes) in one of
+# several shapes that stress different parts of the scanner, with the { "is_malicious": true }
+# pair placed near the start of the body (early), near its end (late), or not at all (absent):
+#   records - an array of realistic user records, like the payload of tests/test_api_perf.py
+#   deep - an array of objects nested DEEP_CHAIN levels deep (fewer in bodies too small for that)
+#   wide - a single object with one key per value
+#   array - one huge array of numbers
+#   string - an array of objects holding long string values
+# Payloads are built from bytes directly (never through json.dumps of a huge object), so even
+# a 100 MB body takes seconds at most to generate, and they are cached per process.
+
+KB = 1024
+MB = 1024 * KB
+SIZES = (KB, 64 * KB, MB, 10 * MB, 100 * MB)
+SHAPES = ("records", "deep", "wide", "array", "string")
+PLACEMENTS = ("early", "late", "absent")
+
+DEEP_CHAIN = 500  # nesting depth of each object of the deep shape, below the MAX_DEPTH of app.py
+LONG_STRING = 64 * KB  # length of each value of the string shape
+MALICIOUS_ITEM = b'{"is_malicious": true}'
+MALICIOUS_PAIR = b'"is_malicious": true'
+
+RECORD = (b'{"_id": "5fcc06200a8ac0b3c0b6ac9d", "index": %d, "guid": "84f0aa98-b57a-4fe6-a98d-34c3fd7ccd10", '
+          b'"isActive": false, "balance": "$1,067.14", "picture": "http://placehold.it/32x32", "age": 30, '
+          b'"name": "Annmarie Harding", "email": "annmarieharding@cubix.com", "phone": "+1 (834) 518-3577", '
+          b'"about": "Exercitation reprehenderit laboris do ullamco qui eu dolor duis incididunt est anim qui.", '
+          b'"latitude": -40.106472, "longitude": -105.380377, "tags": ["tempor", "incididunt", "elit", "sit"], '
+          b'"friends": [{"id": 0, "name": "Black Mcfarland"}, {"id": 1, "name": "Robbins Dillard"}], '
+          b'"favoriteFruit": "strawberry"}')
+
+
+# Build a payload.
+# input: shape - one of SHAPES
+#        size - approximate size of the body in bytes
+#        placement - one of PLACEMENTS
+# output: the JSON body as bytes
+@functools.lru_cache(maxsize=None)
+def payload(shape, size, placement):
+    if shape == "wide":
+        return _wide(size, placement)
+    if shape == "deep":
+        depth = max(1, min(DEEP_CHAIN, size // 64))  # a small body holds at least one whole chain
+        items = _repeat(_chain(depth), size)
+        if placement == "late":  # at the bottom of the last chain
+            items[-1] = _chain(depth, innermost=MALICIOUS_PAIR)
+    elif shape == "records":
+        items = _repeat(lambda i: RECORD % i, size)
+    elif shape == "array":
+        items = _repeat(lambda i: b"%d" % i, size)
+    elif shape == "string":
+        value = b'{"text": "' + (b"lorem ipsum " * (LONG_STRING // 12))[:max(1, min(LONG_STRING, size - 16))] + b'"}'
+        items = _repeat(value, size)
+    else:
+        raise ValueError("unknown shape %r" % shape)
+
+    if placement == "early":
+        items[0] = MALICIOUS_ITEM
+    elif placement == "late" and shape != "deep":
+        items[-1] = MALICIOUS_ITEM
+    elif placement not in PLACEMENTS:
+        raise ValueError("unknown placement %r" % placement)
+    return b"[" + b", ".join(items) + b"]"
+
+
+# the verdict a payload should get: True if it contains the malicious pair
+def is_malicious(placement):
+    return placement != "absent"
+
+
+# Repeat item(i) for i = 0, 1, ... until the items joined into an array are about size bytes.
+# item is either a function of the index or the same bytes for every index.
+def _repeat(item, size):
+    if not callable(item):
+        return [item] * max(1, size // (len(item) + 2))
+    items = []
+    total = 0
+    while total < size or not items:
+        items.append(item(len(items)))
+        total += len(items[-1]) + 2  # the item and the separator after it
+    return items
+
+
+# one object nested depth levels deep, with the innermost pair at the bottom
+def _chain(depth, innermost=b'"bottom": null'):
+    opening = b"".join(b'{"level": %d, "next": ' % level for level in range(depth - 1))
+    return opening + b"{" + innermost + b"}" * depth
+
+
+def _wide(size, placement):
+    pairs = _repeat(lambda i: b'"key_%d": %d' % (i, i), size)
+    if placement == "early":
+        pairs[0] = MALICIOUS_PAIR
+    elif placement == "late":
+        pairs[-1] = MALICIOUS_PAIR
+    elif placement not in PLACEMENTS:
+        raise ValueError("unknown placement %r" % placement)
+    return b"{" + b", ".join(pairs) + b"}"
@@ -0,0 +1,79 @@
+import collections
+import io
+import json
+import sys
+import os
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# ./bin/benchmark sets the configuration of app.py: no verdict cache and no process pool, so every round
+# measures a scan, and no limits, so the largest payloads are scanned rather than rejected
+import app
+from payloads import SHAPES, SIZES, PLACEMENTS, MB, payload, is_malicious
+
+# Bodies up to WAF_BENCH_MAX_SIZE bytes are benchmarked (1 MiB by default, 104857600 for every size).
+MAX_SIZE = int(os.getenv('WAF_BENCH_MAX_SIZE', default=str(MB)))
+BENCH_SIZES = [size for size in SIZES if size <= MAX_SIZE]
+
+FLASK_APP = getattr(app.app.wsgi_app, 'wsgi_app', app.app.wsgi_app)  # handleRequest without the fast path
+BASE_ENVIRON = EnvironBuilder(path='/api/handle-request', method='POST', content_type='application/json').get_environ()
+
+
+def size_id(size):
+    return '%dKB' % (size // 1024) if size < MB else '%dMB' % (size // MB)
+
+
+# Call a WSGI application in-process with a body.
+# returns the status line
+def call_wsgi(wsgi_app, body):
+    environ = dict(BASE_ENVIRON)
+    environ['wsgi.input'] = io.BytesIO(body)
+    environ['CONTENT_LENGTH'] = str(len(body))
+    started = []
+    response = wsgi_app(environ, lambda status, headers: started.append(status))
+    for _ in response:
+        pass
+    if hasattr(response, 'close'):
+        response.close()
+    return started[0]
+
+
+# Class to benchmark the scanning core and the WSGI app in-process, without network or HTTP client
+# overhead. Run with ./bin/benchmark, which compares every run with the stored baseline.
+class TestScanPerformance:
+
+    # Benchmark the streaming scanner on a whole body (scan_body in app.py).
+    @pytest.mark.parametrize('placement', PLACEMENTS)
+    @pytest.mark.parametrize('size', BENCH_SIZES, ids=size_id)
+    @pytest.mark.parametrize('shape', SHAPES)
+    def test_scan_body(self, benchmark, shape, size, placement):
+        body = payload(shape, size, placement)
+
+        verdict = benchmark(app.scan_body, body)
+
+        assert bool(verdict) == is_malicious(placement)
+
+    # Benchmark the traversal of an already decoded body (traverse_object in app.py).
+    @pytest.mark.parametrize('size', BENCH_SIZES, ids=size_id)
+    @pytest.mark.parametrize('shape', SHAPES)
+    def test_traverse_object(self, benchmark, shape, size):
+        obj = json.loads(payload(shape, size, 'absent'))
+
+        benchmark(lambda: collections.deque(app.traverse_object(obj), maxlen=0))  # visit every pair
+
+    # Benchmark a whole request to /api/handle-request through the WSGI app, with and without
+    # the fast path of fastpath.py.
+    @pytest.mark.parametrize('route', ['fast_path', 'flask'])
+    @pytest.mark.parametrize('placement', ['late', 'absent'])
+    @pytest.mark.parametrize('size', BENCH_SIZES, ids=size_id)
+    @pytest.mark.parametrize('shape', SHAPES)
+    def test_handle_request(self, benchmark, shape, size, placement, route):
+        body = payload(shape, size, placement)
+        wsgi_app = app.app.wsgi_app if route == 'fast_path' else FLASK_APP
+
+        status = benchmark(call_wsgi, wsgi_app, body)
+
+        assert status.startswith('403' if is_malicious(placement) else '200')
@@ -0,0 +1,130 @@
+import collections
+import hashlib
+import threading
+import time
+
+
+# A bounded LRU cache of verdicts keyed by a hash of the raw request body.
+#
+# Bots often replay byte-identical bodies, and each replay would otherwise be scanned
+# again. The cache maps a 128-bit BLAKE2b digest of the body (plus the version of the
+# rule set that produced the verdict) to the verdict, so a replay costs one hash and one
+# lookup. Memory stays bounded: the cache holds at most max_entries verdicts and at most
+# max_bytes of estimated entry memory, evicting the least recently used, and entries
+# expire after ttl seconds.
+#
+# get_or_scan also coalesces concurrent scans of the same body (single-flight): while one
+# thread scans a body, other threads with the same body wait for its verdict instead of
+# scanning it again. Only bodies that are read whole can be looked up, which app.py does for
+# small bodies and for the large ones it sends to the scanner pool; the bodies it streams in
+# between are neither cached nor coalesced.
+
+ENTRY_BYTES = 256  # estimated memory of one entry (digest, verdict reference, LRU links, expiry)
+
+
+class VerdictCache:
+
+    # max_entries - the maximum number of verdicts kept
+    # max_bytes - the maximum estimated memory of the entries
+    # ttl - seconds a verdict stays valid
+    # metrics - Metrics every lookup is recorded in (see metrics.py), or None
+    def __init__(self, max_entries=100000, max_bytes=32 * 1024 * 1024, ttl=300.0, metrics=None):
+        self.capacity = max(0, min(max_entries, max_bytes // ENTRY_BYTES))
+        self.ttl = ttl
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0  # scans avoided by waiting for an identical scan in progress
+        self._entries = collections.OrderedDict()  # key -> (verdict, expires)
+        self._in_flight = {}  # key -> Flight for bodies being scanned
+        self._lock = threading.Lock()
+
+    # cache key of a body for a rule set
+    @staticmethod
+    def key(body, rules):
+        return rules.version, hashlib.blake2b(body, digest_size=16).digest()
+
+    # Return the verdict for a body, scanning it with scan(body) only if it is not cached.
+    # input: body - the raw body bytes
+    #        rules - the RuleSet the verdict is computed with
+    #        scan - function of the body returning its verdict
+    # output: the verdict
+    def get_or_scan(self, body, rules, scan):
+        if self.capacity == 0:
+            return scan(body)
+        key = self.key(body, rules)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    if self.metrics is not None:
+                        self.metrics.record_cache("hit")
+                    return entry[0]
+                del self._entries[key]  # expired
+            flight = self._in_flight.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._in_flight[key] = Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if self.metrics is not None:
+            self.metrics.record_cache("miss" if leader else "coalesced")
+
+        if not leader:  # an identical body is being scanned, wait for its verdict
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.verdict
+
+        try:
+            flight.verdict = scan(body)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if flight.error is None:
+                    self._put(key, flight.verdict)
+            flight.done.set()
+        return flight.verdict
+
+    def _put(self, key, verdict):
+        self._entries[key] = (verdict, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # counters for monitoring
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# A scan in progress that other threads can wait for.
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.verdict = None
+        self.error = None
@@ -0,0 +1,280 @@
+import functools
+import json
+import sys
+
+from decoding import decoding
+from limits import NO_LIMITS
+from rules import CONTAINER, SCALAR_TYPES
+from scanner import BodyScanner, KeyPrefilter, NO_MATCH
+import structural
+
+
+# Pluggable JSON decoders for complete request bodies.
+#
+# The StreamScanner (see scanner.py) tokenizes a body in Python, which is what a streamed body
+# needs but dominates the CPU time of large bodies that are already in memory whole (bodies read
+# for the verdict cache or sent to the process pool) and that hold a key of the rules. Such a body
+# is decoded instead by a JSON decoder written in C and the decoded objects are walked in document
+# order, an order of magnitude faster. The decoder is picked at startup: the fastest one installed
+# when WAF_JSON_DECODER is "auto", a given one by name, or none ("stream") to always tokenize.
+#
+# A decoder is only a shortcut to the verdict of the StreamScanner, and the body is tokenized after
+# all (Decoder.scan returns None) whenever a decoded body could get a different verdict:
+#   - bodies that are not in UTF-8 or start with a byte order mark, which the scanner transcodes
+#   - bodies the decoder rejects: invalid JSON (the scanner may still find a pair before the error),
+#     NaN and Infinity, lone surrogates, nesting deeper than the decoder allows
+#   - duplicate keys: a decoder keeps the last value of a duplicate key, which would hide the pair
+#     the scanner reports. The spellings of the keys of the rules are counted in the raw body (like
+#     the prefilter, see KeyPrefilter) and the body is tokenized unless the walk finds every one
+#   - bodies that may go over a structure limit (see limits.py), so limits are only ever enforced by
+#     the scanner: more commas and brackets than the elements allowed, more brackets than the depth
+#     allowed, a run of the bytes of a number longer than the string limit, or a key or string the
+#     walk finds may be written longer than the string limit
+#   - rule sets with signatures, which are checked against every string value, including the ones a
+#     duplicate key hides
+# A body none of the keys can be in is answered without being decoded, like with the prefilter.
+
+# orjson decodes integers beyond 64 bits as floats, a float from this size on may have been one
+INEXACT_FLOAT = 2.0 ** 63
+# the most bytes a character of a decoded string may be written with: a surrogate pair of \u escapes
+MAX_ESCAPED_CHARACTER = 12
+# translation tables of the bytes a number is written with, and of the bytes that are not a quote, to b"1"
+_NUMBER_BYTES = bytes(0x31 if byte in b'-+.0123456789eE' else 0x30 for byte in range(256))
+_UNQUOTED_BYTES = bytes(0x30 if byte == 0x22 else 0x31 for byte in range(256))
+_is_string = str.__instancecheck__
+MAX_IGNORED = 4096  # keys remembered as matching no rule, per rule set
+
+
+class Decoder:
+
+    # name - the name of the backend, as set in WAF_JSON_DECODER
+    # loads - decodes a complete body (bytes), raises ValueError if it is not valid JSON
+    # max_depth - returns the deepest nesting loads accepts (it fails on deeper bodies), None if unbounded
+    # exact_numbers - False if loads may decode an integer as a float, see INEXACT_FLOAT
+    def __init__(self, name, loads, max_depth, exact_numbers=True):
+        self.name = name
+        self.loads = loads
+        self.max_depth = max_depth
+        self.exact_numbers = exact_numbers
+
+    # Scan a complete JSON body by decoding it.
+    # input: body - the raw body bytes
+    #        rules - the RuleSet to check the body against
+    #        limits - the Limits of the body (see limits.py)
+    # output: the Rule that fired or NO_MATCH, None if the body must be tokenized instead
+    def scan(self, body, rules, limits=None):
+        limits = limits or NO_LIMITS
+        keys = _keys(rules)
+        if keys is None or json.detect_encoding(body[:4]) != "utf-8":
+            return None
+        if limits.max_bytes is not None and len(body) > limits.max_bytes:
+            return None
+        prefilter, ignored = keys
+        if prefilter.pattern is None:  # no rules
+            return NO_MATCH
+        if b'\\u' in body:  # every spelling, one match per occurrence
+            expected, per_rule = len(prefilter.pattern.findall(body)), False
+        else:  # the literal spelling of each rule, counted once per rule
+            expected, per_rule = sum(map(body.count, prefilter.literals)), True
+        if not expected:
+            return NO_MATCH
+        if not self._decodable(body, limits):
+            return None
+        try:
+            obj = self.loads(body)
+        except (ValueError, RecursionError):
+            return None
+        # a key or string longer than max_string is a run of as many bytes without a quote
+        max_string = limits.max_string
+        if max_string is not None and (len(body) <= max_string or not _has_run(body, _UNQUOTED_BYTES, max_string)):
+            max_string = None
+        return _walk(obj, rules, ignored, expected, per_rule, self.exact_numbers, self._max_depth(body, limits),
+                     max_string, b'\\' in body)
+
+    # True if the body cannot go over the element or number length limits once it decodes (the depth and
+    # the lengths of keys and strings are checked by the walk)
+    def _decodable(self, body, limits):
+        size = len(body)
+        # an element takes a byte at least, and each follows a comma or opens its container
+        if limits.max_elements is not None and size > limits.max_elements and \
+                body.count(b',') + body.count(b'[') + body.count(b'{') > limits.max_elements:
+            return False
+        # a run of the bytes a number is written with, in a string too (where it is only a may)
+        return limits.max_string is None or size <= limits.max_string or not _has_run(body, _NUMBER_BYTES,
+                                                                                       limits.max_string)
+
+    # the depth limit if the decoded body may be nested deeper, None otherwise
+    def _max_depth(self, body, limits):
+        if limits.max_depth is None or (self.max_depth is not None and self.max_depth() <= limits.max_depth):
+            return None  # a body nested deeper does not decode
+        # nesting deeper than max_depth opens more than max_depth containers
+        return limits.max_depth if body.count(b'[') + body.count(b'{') > limits.max_depth else None
+
+    def __repr__(self):
+        return "<Decoder %s>" % self.name
+
+
+# Walk a decoded body for the pairs the StreamScanner checks: the rules of a key fire on the key
+# (rules without values) or on its scalar value, like in RuleSet.match. A key that was duplicated
+# keeps the place of its first occurrence with its last value, so the dicts may not hold the pairs in the
+# order of the body either way: when two different rules fire, the one the scanner reports first is not
+# known. Keys no rule applies to are remembered in the ignored set, so a dict whose keys have all been
+# seen before is skipped with a single set operation.
+# input: obj - the decoded body
+#        rules - the RuleSet
+#        ignored - set of keys no rule applies to, shared by the walks of the rule set
+#        expected - the occurrences of the keys of the rules counted in the raw body
+#        per_rule - True if an occurrence was counted once per rule of the key, False if once
+#        exact_numbers - False if a large float may stand for an integer the rules would compare differently
+#        max_depth - the depth limit if the body may be nested deeper, None otherwise
+#        max_string - the string limit if a key or string of the body may be longer, None otherwise
+#        escaped - True if the body has escapes, see _long_strings
+# output: the Rule that fires or NO_MATCH, None if some occurrence was not found in the decoded body,
+#         different rules fire, a value of a key of the rules may not be what the body holds, or the body
+#         is nested deeper than max_depth or a key or string may be longer than max_string
+def _walk(obj, rules, ignored, expected, per_rule, exact_numbers=True, max_depth=None, max_string=None,
+          escaped=False):
+    match_key = rules.match_key
+    # the scanner stops at the first hit, a limit it meets before is only known once the whole body is walked
+    limited = max_depth is not None or max_string is not None
+    # keys and strings of at most this many characters cannot be written with more than max_string bytes
+    safe = max_string // (MAX_ESCAPED_CHARACTER if escaped else 4) if max_string is not None else None
+    seen = 0  # occurrences of the keys of the rules found so far
+    verdict = NO_MATCH
+    stack = [(obj, 1)]
+    while stack:
+        obj, depth = stack.pop()
+        if isinstance(obj, dict):
+            if safe is not None and obj and (
+                    max(map(len, obj)) > safe or max(map(len, filter(_is_string, obj.values())), default=0) > safe):
+                if _long_strings(obj, max_string, escaped) or _long_strings(obj.values(), max_string, escaped):
+                    return None
+            if not ignored.issuperset(obj):
+                for key in obj.keys() - ignored:
+                    key_rules = match_key(key)
+                    if not key_rules:
+                        if len(ignored) >= MAX_IGNORED:
+                            ignored.clear()
+                        ignored.add(key)
+                        continue
+                    seen += len(key_rules) if per_rule else 1
+                    value = obj[key]
+                    rule = rules.match(key, CONTAINER)
+                    if rule is None and not isinstance(value, (dict, list)):
+                        if not exact_numbers and type(value) is float and abs(value) >= INEXACT_FLOAT:
+                            return None
+                        rule = rules.match(key, value)
+                    if rule is not None:
+                        if not verdict:
+                            if seen == expected and not limited:  # every occurrence is accounted for
+                                return rule
+                            verdict = rule
+                        elif rule is not verdict:
+                            return None
+            children = obj.values()
+        elif isinstance(obj, list):
+            # collect the types in C, a list of scalars does not need to be visited item by item
+            types = set(map(type, obj))
+            if safe is not None and str in types and max(map(len, filter(_is_string, obj))) > safe and \
+                    _long_strings(obj, max_string, escaped):
+                return None
+            if SCALAR_TYPES.issuperset(types):
+                continue
+            children = obj
+        else:  # a scalar at the root has no key
+            continue
+        containers = [(child, depth + 1) for child in children if isinstance(child, (dict, list))]
+        if containers:
+            if max_depth is not None and depth >= max_depth:
+                return None
+            stack.extend(containers)
+    return verdict if seen == expected else None
+
+
+# True if one of the strings of decoded values may be written with more than max_string bytes in the body:
+# a string is written with its UTF-8 bytes, or with up to MAX_ESCAPED_CHARACTER bytes a character when the
+# body has escapes, whose lengths are not known once decoded. Only called once a string may be that long.
+def _long_strings(values, max_string, escaped):
+    return escaped or any(len(value.encode("utf-8")) > max_string for value in values if type(value) is str)
+
+
+# True if the body has a run of more than length bytes that the table translates to b"1"
+def _has_run(body, table, length):
+    return b'1' * (length + 1) in body.translate(table)
+
+
+# Scan a complete body, the way both the request threads (app.py) and the scanner processes (pool.py) do it.
+# A body without a Content-Encoding is decoded with the JSON decoder when it gets the same verdict that way,
+# then with the structural index if it is large (see structural.py), otherwise it goes through the BodyScanner
+# pipeline.
+# input: body - the raw body bytes
+#        rules - the RuleSet to check the body against
+#        limits - the Limits of the body (see limits.py)
+#        decoder - the Decoder, None to tokenize every body
+#        index_min_body - bodies of at least this many bytes are tried with the structural index, 0 for none
+#        encoding - the Content-Encoding of the body, None if it was not sent (see decoding.py)
+# output: the Rule or Signature that fired or NO_MATCH
+# raises LimitExceeded if the body is over one of the limits
+def scan_complete(body, rules, limits, decoder=None, index_min_body=0, encoding=None):
+    if decoder is not None and not encoding:
+        verdict = decoder.scan(body, rules, limits)
+        if verdict is not None:
+            return verdict
+    if 0 < index_min_body <= len(body) and not encoding:
+        verdict = structural.scan_indexed(body, rules, limits)
+        if verdict is not None:
+            return verdict
+    scanner = decoding(BodyScanner(rules, limits), encoding, limits)
+    return scanner.feed(body) or scanner.close()
+
+
+# The key prefilter of a rule set, whose spellings are counted in the raw body, and the set of keys
+# its walks ignore, or None if bodies cannot be decoded for the rule set (see the conditions above).
+@functools.lru_cache(maxsize=16)
+def _keys(rules):
+    prefilter = KeyPrefilter(rules)
+    if rules.signatures is not None or not prefilter.complete:
+        return None
+    return prefilter, set()
+
+
+def _stdlib():
+    # only UTF-8 bodies are decoded (see Decoder.scan), and without the surrogates json.loads lets through
+    return Decoder("stdlib", lambda body: json.loads(body.decode("utf-8")), sys.getrecursionlimit)
+
+
+def _orjson():
+    import orjson
+    return Decoder("orjson", orjson.loads, None, exact_numbers=False)
+
+
+# the decoders in order of preference, fastest first, each built by a function that raises
+# ImportError if the backend is not installed
+BACKENDS = {
+    "orjson": _orjson,
+    "stdlib": _stdlib,
+}
+STREAM = "stream"  # no decoder, bodies are always tokenized
+
+
+# Pick the decoder named by WAF_JSON_DECODER.
+# input: "auto" for the fastest decoder installed, the name of a backend, or "stream"
+# output: the Decoder, None for "stream"
+# raises ValueError for an unknown backend or one that is not installed
+def select_decoder(name="auto"):
+    name = name.strip().lower()
+    if name == STREAM:
+        return None
+    if name == "auto":
+        for backend in BACKENDS.values():
+            try:
+                return backend()
+            except ImportError:
+                continue
+        return None
+    if name not in BACKENDS:
+        raise ValueError("unknown JSON decoder %r, expected auto, %s or %s" % (name, ", ".join(BACKENDS), STREAM))
+    try:
+        return BACKENDS[name]()
+    except ImportError:
+        raise ValueError("JSON decoder %s is not installed" % name)
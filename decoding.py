@@ -0,0 +1,132 @@
+import zlib
+
+from limits import LimitExceeded, NO_LIMITS
+
+
+# Streaming Content-Encoding decompression of request bodies.
+#
+# A body sent with Content-Encoding: gzip or deflate would otherwise be scanned as compressed
+# bytes, never match a rule, and reach the backend unscanned. A Decompressor sits in front of a
+# scanner with the same feed/close interface: each compressed chunk is inflated incrementally,
+# at most OUTPUT_CHUNK bytes at a time, and every piece of output is fed to the scanner right away,
+# so the body is never inflated whole and decompression stops as soon as the verdict is known.
+#
+# Decompression bombs are bounded by the limits (see limits.py): the decompressed bytes count
+# against the size limit of the scanner, the compressed bytes against the same limit here, and a
+# body whose output grows beyond max_ratio times its input is rejected with 413 once it has
+# produced more than RATIO_MIN_OUTPUT bytes (small bodies legitimately compress very well).
+# A coding that is not supported is rejected with 415 Unsupported Media Type and data that does
+# not decompress with 400 Bad Request, as the backend could not decode them either.
+
+OUTPUT_CHUNK = 64 * 1024  # the most bytes inflated at a time
+RATIO_MIN_OUTPUT = 1024 * 1024  # output below this size is not checked against the ratio limit
+GZIP = 16 + zlib.MAX_WBITS  # wbits of a gzip stream
+ZLIB = zlib.MAX_WBITS  # wbits of a zlib stream, the deflate of HTTP
+RAW_DEFLATE = -zlib.MAX_WBITS  # wbits of a deflate stream without header, sent by some clients as deflate
+CODINGS = frozenset(("gzip", "x-gzip", "deflate"))
+_UNLIMITED = float('inf')
+
+
+class Decompressor:
+
+    # scanner - the scanner the decompressed body is fed to (a BodyScanner or another Decompressor)
+    # coding - "gzip", "x-gzip" or "deflate"
+    # limits - the Limits of the body (see limits.py)
+    def __init__(self, scanner, coding, limits=None):
+        self.scanner = scanner
+        self.coding = coding
+        self.limits = limits or NO_LIMITS
+        self.size = 0  # compressed bytes fed so far
+        self.output = 0  # decompressed bytes produced so far
+        self._max_bytes = self.limits.max_bytes or _UNLIMITED
+        self._max_ratio = self.limits.max_ratio or _UNLIMITED
+        self._decompressor = None  # created once the first two bytes tell the format
+        self._head = b''  # first byte of a deflate body, kept until the second one arrives
+        self.verdict = None  # set once the scanner knows the verdict, the rest of the body is not decompressed
+
+    # Feed the next chunk of the compressed body.
+    # returns the Rule that fired or NO_MATCH once the verdict is known, None if more input is needed
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            raise self.limits.too_large()
+        if self._decompressor is None:
+            chunk = self._head + chunk
+            if self.coding == "deflate" and len(chunk) < 2:
+                self._head = chunk
+                return None
+            self._decompressor = zlib.decompressobj(_wbits(self.coding, chunk))
+        return self._inflate(chunk)
+
+    # Signal the end of the body.
+    # returns the Rule that fired or NO_MATCH
+    def close(self):
+        if self.verdict is not None:
+            return self.verdict
+        if self._decompressor is None:
+            if self._head:  # a single byte is no deflate stream
+                raise bad_encoding(self.coding)
+        elif not self._decompressor.eof:  # truncated
+            raise bad_encoding(self.coding)
+        return self.scanner.close()
+
+    def _inflate(self, data):
+        decompressor = self._decompressor
+        while True:
+            try:
+                output = decompressor.decompress(data, OUTPUT_CHUNK)
+            except zlib.error:
+                raise bad_encoding(self.coding)
+            data = decompressor.unconsumed_tail
+            if output:
+                self.output += len(output)
+                if self.output > RATIO_MIN_OUTPUT and self.output > self._max_ratio * self.size:
+                    raise self.limits.too_compressed()
+                verdict = self.scanner.feed(output)
+                if verdict is not None:
+                    self.verdict = verdict
+                    return verdict
+            if decompressor.eof:
+                data = decompressor.unused_data
+                if not data:
+                    return None
+                if self.coding == "deflate":  # trailing data after the stream
+                    raise bad_encoding(self.coding)
+                # gzip bodies may hold several members, decompressed one after the other
+                decompressor = self._decompressor = zlib.decompressobj(GZIP)
+            elif not data and len(output) < OUTPUT_CHUNK:  # all the input was inflated
+                return None
+
+
+# Put the decompressors of a Content-Encoding header in front of a scanner.
+# The codings are listed in the order they were applied, so the last one is undone first.
+# input: scanner - the scanner of the decoded body
+#        content_encoding - the value of the header, None or "" if it was not sent
+#        limits - the Limits of the body
+# output: the scanner to feed the body as received (the scanner itself for an identity body)
+def decoding(scanner, content_encoding, limits=None):
+    if not content_encoding:
+        return scanner
+    for coding in content_encoding.split(","):
+        coding = coding.strip().lower()
+        if coding in ("", "identity"):
+            continue
+        if coding not in CODINGS:
+            raise LimitExceeded("encoding", 415, "unsupported content encoding %s" % coding[:32])
+        scanner = Decompressor(scanner, coding, limits)
+    return scanner
+
+
+# the rejection of a body that does not decompress
+def bad_encoding(coding):
+    return LimitExceeded("encoding", 400, "request body is not valid %s data" % coding)
+
+
+# wbits of the decompressor of a body from its first bytes
+def _wbits(coding, head):
+    if coding != "deflate":
+        return GZIP
+    # a zlib header: compression method 8 and a check value that makes the first two bytes a multiple of 31
+    if head[0] & 0x0f == 8 and (head[0] << 8 | head[1]) % 31 == 0:
+        return ZLIB
+    return RAW_DEFLATE
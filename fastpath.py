@@ -0,0 +1,98 @@
+import json
+import time
+from http import HTTPStatus
+
+from werkzeug.wsgi import get_content_length, get_input_stream
+
+
+# A raw WSGI fast path for the firewall endpoint.
+#
+# A verdict only has a handful of possible responses, yet going through Flask means setting up
+# a request context, routing the URL, and serializing the response dict to JSON on every
+# request. FastPath wraps the Flask application (app.wsgi_app = FastPath(...)) and answers
+# /api/handle-request itself: it reads the body straight from wsgi.input and replies with
+# response bodies, status lines and headers that were encoded once up front. Every other path
+# falls through to Flask.
+
+PATH = "/api/handle-request"
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "DELETE", "CONNECT", "OPTIONS", "TRACE", "PATCH"))
+
+
+class FastPath:
+
+    # wsgi_app - the WSGI application that handles every other request
+    # scan - function (stream, length, content encoding, content type, query string) returning the verdict
+    #        of a request, see scan_request in app.py
+    # success - response body dict when no rule fires
+    # busy - (exception type, response body dict) for a scan that cannot be run right now, or None
+    # rejected - exception type for a body that is rejected (with its .status and pre-encoded .body,
+    #            see LimitExceeded in limits.py), or None
+    # metrics - Metrics every response is recorded in (see metrics.py), or None
+    def __init__(self, wsgi_app, scan, success, busy=None, rejected=None, metrics=None):
+        self.wsgi_app = wsgi_app
+        self.scan = scan
+        self.metrics = metrics
+        self.success = self._encode(200, json.dumps(success).encode("utf-8") + b"\n")
+        self.busy_error = busy[0] if busy else ()
+        if busy:
+            self.busy = self._encode(503, json.dumps(busy[1]).encode("utf-8") + b"\n", [("Retry-After", "1")])
+        self.rejected_error = rejected or ()
+        self._verdicts = {}  # rule or signature number -> encoded response
+        self._rejections = {}  # body of a rejection -> encoded response
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") != PATH or environ.get("REQUEST_METHOD") not in METHODS:
+            return self.wsgi_app(environ, start_response)
+
+        start = time.perf_counter()
+        verdict = None
+        length = get_content_length(environ)
+        try:
+            verdict = self.scan(get_input_stream(environ), length, environ.get("HTTP_CONTENT_ENCODING"),
+                                environ.get("CONTENT_TYPE", ""), environ.get("QUERY_STRING", ""))
+        except self.busy_error:
+            response = self.busy
+        except self.rejected_error as error:
+            response = self._rejection(error)
+        else:
+            response = self._verdict(verdict) if verdict else self.success
+
+        status_line, headers, body = response
+        if self.metrics is not None:
+            self.metrics.record(int(status_line[:3]), verdict, length, time.perf_counter() - start)
+        start_response(status_line, list(headers))
+        if environ["REQUEST_METHOD"] == "HEAD":
+            return [b""]
+        return [body]
+
+    # encoded response of the rule or signature that fired
+    def _verdict(self, rule):
+        response = self._verdicts.get(rule.number)
+        if response is None or response[2] is not rule.body:
+            response = self._verdicts[rule.number] = self._encode(rule.status, rule.body)
+        return response
+
+    # encoded response of a rejected body
+    def _rejection(self, error):
+        response = self._rejections.get(error.body)
+        if response is None:
+            response = self._rejections[error.body] = self._encode(error.status, error.body)
+        return response
+
+    @staticmethod
+    def _encode(code, body, extra_headers=()):
+        try:
+            status_line = "%d %s" % (code, HTTPStatus(code).phrase)
+        except ValueError:  # a status code without a standard reason phrase
+            status_line = "%d Error" % code
+        headers = [("Content-Type", "application/json"), ("Content-Length", str(len(body)))]
+        headers.extend(extra_headers)
+        return status_line, tuple(headers), body
+
+
+# Same rule as Flask's request.is_json: application/json or application/*+json
+def is_json(content_type):
+    mimetype = content_type.split(";", 1)[0].strip().lower()
+    return mimetype == "application/json" or (
+        mimetype.startswith("application/") and mimetype.endswith("+json")
+    )
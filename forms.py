@@ -0,0 +1,336 @@
+import json
+import re
+from urllib.parse import unquote_to_bytes
+
+from werkzeug.http import parse_options_header
+
+from fastpath import is_json
+from limits import LimitExceeded, NO_LIMITS
+from rules import CONTAINER
+from scanner import BodyScanner, NO_MATCH
+
+
+# Streaming scanners for form-encoded and multipart bodies and for query strings.
+#
+# Only JSON bodies used to be inspected, so a client could send the same pair as a form field
+# (is_malicious=true) and get through. A field is checked like a JSON pair: its name is the key
+# and its value the value, so the same rules and signatures apply. Names in the bracket notation
+# of nested parameters are read as the path of nested objects (hidden[is_malicious]=true is
+# {"hidden": {"is_malicious": true}}), and values spelled as JSON literals or numbers (true, 1) are
+# also matched as what they spell, as backends commonly coerce them.
+#
+# The scanners have the feed/close interface of BodyScanner, so they are driven by the same
+# servers, decompressors and limits. Fields are checked as soon as they are complete and scanning
+# stops at the first hit. Only the field being read is held in memory: in a multipart body, parts
+# sent as application/json are streamed through a BodyScanner, other file parts are skipped
+# without being buffered, and only plain fields are collected up to the string length limit.
+
+FORM = "application/x-www-form-urlencoded"
+MULTIPART = "multipart/form-data"
+MAX_PART_HEADERS = 16 * 1024  # the largest header block of a multipart part
+_UNLIMITED = float('inf')
+_LITERAL = re.compile(r'true|false|null|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?')
+_INDEX = re.compile(r'[0-9]*')  # a bracket of the name that indexes an array: a[] or a[0]
+
+
+# Create the scanner for a body from its Content-Type.
+# output: BodyScanner for JSON, FormScanner or MultipartScanner, None for a body that is not inspected
+# raises LimitExceeded for a multipart body without a boundary
+def scanner_for(content_type, rules, limits=None):
+    if is_json(content_type):
+        return BodyScanner(rules, limits)
+    mimetype, options = parse_options_header(content_type)
+    mimetype = mimetype.lower()
+    if mimetype == FORM:
+        return FormScanner(rules, limits)
+    if mimetype == MULTIPART:
+        boundary = options.get("boundary", "")
+        if not boundary or len(boundary) > 70:
+            raise LimitExceeded("encoding", 400, "multipart body without a valid boundary")
+        return MultipartScanner(rules, boundary.encode("latin-1"), limits)
+    return None
+
+
+# True if bodies of the Content-Type are scanned
+def inspected(content_type):
+    if is_json(content_type):
+        return True
+    return parse_options_header(content_type)[0].lower() in (FORM, MULTIPART)
+
+
+# Scan a query string.
+# input: the query string, bytes or a str as found in a WSGI environ
+# output: the Rule or Signature that fired or NO_MATCH (False)
+def scan_query(query, rules, limits=None):
+    if isinstance(query, str):
+        query = query.encode("latin-1")
+    scanner = FormScanner(rules, limits)
+    return scanner.feed(query) or scanner.close()
+
+
+# Check a form field against the rules, like a JSON pair.
+# input: name and value of the field as decoded strings, or CONTAINER for a value that is not a scalar
+#        (a JSON part or a file), which only rules without values apply to
+# output: the Rule or Signature that fired or None
+def match_field(rules, name, value, limits=NO_LIMITS):
+    keys = name.replace("]", "").split("[") if "[" in name else (name,)
+    if limits.max_depth is not None and len(keys) > limits.max_depth:
+        raise limits.too_deep()
+    if len(keys) > 1 and _INDEX.fullmatch(keys[-1]):  # an item of an array, every named key holds a container
+        parents, key = keys, None
+    else:
+        parents, key = keys[:-1], keys[-1]
+    for parent in parents:
+        if rules.match_key(parent):
+            rule = rules.match(parent, CONTAINER)
+            if rule is not None:
+                return rule
+    if key is not None and rules.match_key(key):
+        rule = rules.match(key, value)
+        if rule is None and value is not CONTAINER and _LITERAL.fullmatch(value):
+            rule = rules.match(key, json.loads(value))
+        if rule is not None:
+            return rule
+    if rules.signatures is not None and value is not CONTAINER:
+        return rules.signatures.search(value)
+    return None
+
+
+# Scanner of an application/x-www-form-urlencoded body (or a query string): name=value fields
+# separated by &, with + for spaces and %XX escapes.
+class FormScanner:
+
+    # rules - the compiled RuleSet to check the fields against
+    # limits - the Limits of the body (see limits.py), each field counts as an element
+    def __init__(self, rules, limits=None):
+        self.rules = rules
+        self.limits = limits or NO_LIMITS
+        self.size = 0  # bytes fed so far
+        self.verdict = None
+        self._fields = 0
+        self._pending = []  # the start of a field whose end has not arrived yet
+        self._pending_size = 0
+        self._max_bytes = self.limits.max_bytes or _UNLIMITED
+        self._max_elements = self.limits.max_elements or _UNLIMITED
+        self._max_string = self.limits.max_string or _UNLIMITED
+
+    # Feed the next chunk of the body.
+    # returns the Rule that fired or NO_MATCH once the verdict is known, None if more input is needed
+    def feed(self, chunk):
+        if self.verdict is not None:
+            return self.verdict
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            raise self.limits.too_large()
+        if b"&" not in chunk:
+            self._pending.append(chunk)
+            self._pending_size += len(chunk)
+            if self._pending_size > 2 * self._max_string + 1:  # name or value too long, whatever its split
+                raise self.limits.string_too_long()
+            return None
+        fields = chunk.split(b"&")
+        if self._pending:
+            self._pending.append(fields[0])
+            fields[0] = b"".join(self._pending)
+        for field in fields[:-1]:
+            rule = self._field(field)
+            if rule is not None:
+                self.verdict = rule
+                return rule
+        self._pending = [fields[-1]]
+        self._pending_size = len(fields[-1])
+        return None
+
+    # Signal the end of the body and return the final verdict.
+    def close(self):
+        if self.verdict is None:
+            self.verdict = self._field(b"".join(self._pending)) or NO_MATCH
+        return self.verdict
+
+    # check a complete field
+    def _field(self, field):
+        if not field:
+            return None
+        name, _, value = field.partition(b"=")
+        if len(name) > self._max_string or len(value) > self._max_string:
+            raise self.limits.string_too_long()
+        self._fields += 1
+        if self._fields > self._max_elements:
+            raise self.limits.too_many_elements()
+        return match_field(self.rules, _unquote(name), _unquote(value), self.limits)
+
+
+# states of MultipartScanner
+PREAMBLE = 0  # before the first delimiter
+DELIMITER = 1  # after a possible delimiter, before the end of its line
+HEADERS = 2  # in the header block of a part
+CONTENT = 3  # in the content of a part
+
+
+# Scanner of a multipart/form-data body. Each part is checked as it streams by:
+#   - a plain field is collected (up to the string length limit) and checked like a form field
+#   - a part sent as JSON is fed to a BodyScanner of its own, its name is checked as the key of an object
+#   - the content of any other file is skipped, only its name is checked
+class MultipartScanner:
+
+    # rules - the compiled RuleSet to check the parts against
+    # boundary - the boundary parameter of the Content-Type, as bytes
+    # limits - the Limits of the body (see limits.py), each part counts as an element
+    def __init__(self, rules, boundary, limits=None):
+        self.rules = rules
+        self.limits = limits or NO_LIMITS
+        self.delimiter = b"\r\n--" + boundary
+        self.size = 0  # bytes fed so far
+        self.verdict = None
+        self._buf = b"\r\n"  # so that a delimiter at the very start of the body is found like the others
+        self._state = PREAMBLE
+        self._outer = PREAMBLE  # state the last delimiter was found in
+        self._parts = 0
+        self._name = None  # name of the current part
+        self._field = None  # chunks of the current plain field, None if the part is not a field
+        self._field_size = 0
+        self._json = None  # BodyScanner of the current JSON part
+        self._max_bytes = self.limits.max_bytes or _UNLIMITED
+        self._max_elements = self.limits.max_elements or _UNLIMITED
+        self._max_string = self.limits.max_string or _UNLIMITED
+
+    # Feed the next chunk of the body.
+    # returns the Rule that fired or NO_MATCH once the verdict is known, None if more input is needed
+    def feed(self, chunk):
+        if self.verdict is not None:
+            return self.verdict
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            raise self.limits.too_large()
+        buf = self._buf + chunk if self._buf else chunk
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            state = self._state
+            if state == PREAMBLE or state == CONTENT:
+                found = buf.find(self.delimiter, pos)
+                # without a delimiter, keep the bytes that may be the start of one for the next chunk
+                stop = found if found >= 0 else max(pos, end - len(self.delimiter) + 1)
+                rule = self._content(buf[pos:stop]) if state == CONTENT else None
+                if rule is not None:
+                    return self._finish(rule)
+                if found < 0:
+                    pos = stop
+                    break
+                pos = found + len(self.delimiter)
+                self._outer = state
+                self._state = DELIMITER
+            elif state == DELIMITER:
+                # a delimiter is only followed by transport padding and the end of its line (or "--" and
+                # the end of the line for the closing one), like parsers of the backend require
+                newline = buf.find(b"\r\n", pos)
+                if newline < 0 and end - pos <= MAX_PART_HEADERS:
+                    break  # wait for the end of the line
+                line = buf[pos:newline]
+                closing = line.startswith(b"--")
+                if newline < 0 or (line[2:] if closing else line).strip(b" \t"):  # not a delimiter, it was content
+                    self._state = self._outer
+                    rule = self._content(self.delimiter) if self._outer == CONTENT else None
+                    if rule is not None:
+                        return self._finish(rule)
+                    continue
+                rule = self._end_part() if self._outer == CONTENT else None
+                if rule is not None or closing:  # the rest after the closing delimiter is the epilogue
+                    return self._finish(rule or NO_MATCH)
+                pos = newline + 2
+                self._state = HEADERS
+            elif state == HEADERS:
+                if buf.startswith(b"\r\n", pos):  # a part without headers
+                    headers, pos = b"", pos + 2
+                else:
+                    blank = buf.find(b"\r\n\r\n", pos)
+                    if blank < 0:
+                        if end - pos > MAX_PART_HEADERS:
+                            return self._finish(NO_MATCH)  # malformed
+                        break
+                    headers, pos = buf[pos:blank], blank + 4
+                rule = self._start_part(headers)
+                if rule is not None:
+                    return self._finish(rule)
+                self._state = CONTENT
+        self._buf = buf[pos:]
+        return None
+
+    # Signal the end of the body and return the final verdict.
+    def close(self):
+        if self.verdict is None:
+            rule = None
+            if self._state == CONTENT:  # unterminated, check what was sent of the last part
+                rule = self._content(self._buf) or self._end_part()
+            elif self._state == DELIMITER and self._outer == CONTENT:  # a last delimiter without line end
+                rule = self._end_part()
+            self._finish(rule or NO_MATCH)
+        return self.verdict
+
+    def _finish(self, verdict):
+        self.verdict = verdict
+        self._buf = b""
+        self._field = self._json = None
+        return verdict
+
+    # check the headers of a part and set up the handling of its content
+    def _start_part(self, headers):
+        self._parts += 1
+        if self._parts > self._max_elements:
+            raise self.limits.too_many_elements()
+        disposition = content_type = ""
+        for line in headers.split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-disposition":
+                disposition = value.decode("utf-8", "replace")
+            elif name == b"content-type":
+                content_type = value.decode("latin-1").strip()
+        _, options = parse_options_header(disposition)
+        self._name = options.get("name")
+        self._field = self._json = None
+        if self._name is None:  # not a form field, skipped
+            return None
+        if len(self._name.encode("utf-8")) > self._max_string:
+            raise self.limits.string_too_long()
+        if is_json(content_type):
+            self._json = BodyScanner(self.rules, self.limits)
+        elif "filename" not in options:
+            self._field = []
+            self._field_size = 0
+            return None
+        return match_field(self.rules, self._name, CONTAINER, self.limits)
+
+    # feed content of the current part
+    def _content(self, data):
+        if not data:
+            return None
+        if self._json is not None:
+            verdict = self._json.feed(data)
+            if verdict is not None:
+                self._json = None  # the rest of the part cannot change the verdict
+                return verdict or None
+        elif self._field is not None:
+            self._field_size += len(data)
+            if self._field_size > self._max_string:
+                raise self.limits.string_too_long()
+            self._field.append(data)
+        return None
+
+    # check the current part once its content is complete
+    def _end_part(self):
+        rule = None
+        if self._json is not None:
+            rule = self._json.close() or None
+        elif self._field is not None:
+            value = b"".join(self._field).decode("utf-8", "replace")
+            rule = match_field(self.rules, self._name, value, self.limits)
+        self._field = self._json = None
+        return rule
+
+
+# decode a name or value of a form field
+def _unquote(raw):
+    if b"%" not in raw and b"+" not in raw:
+        return raw.decode("utf-8", "replace")
+    return unquote_to_bytes(raw.replace(b"+", b" ")).decode("utf-8", "replace")
@@ -0,0 +1,60 @@
+import gc
+import multiprocessing
+import os
+import signal
+
+
+# Production serving profile for gunicorn (the Procfile runs gunicorn --config gunicorn.conf.py app:app).
+#
+# The app is loaded once in the master before the workers are forked (preload_app), so the compiled
+# rule tables, the fast path responses and the rendered homepage are built once and shared
+# copy-on-write by every worker. Reference counting and the cyclic garbage collector would still
+# write to those shared pages and copy them into each worker, so the objects that exist after the
+# preload are moved to the permanent generation with gc.freeze(), which the collector never scans.
+# Workers are recycled after a number of requests (with jitter, so they do not all restart at once)
+# to bound the memory any one worker can accumulate.
+#
+# Every setting can be overridden from the environment, see README.md.
+
+CPUS = multiprocessing.cpu_count()
+
+bind = "0.0.0.0:%s" % os.getenv("PORT", default="5000")
+
+# Scanning is CPU bound, so a few processes per CPU keep every CPU busy while some workers wait on
+# the network. With one or two CPUs (a typical dyno) there are too few processes to hide slow
+# clients, so workers get threads instead.
+workers = int(os.getenv("WEB_CONCURRENCY", default=str(CPUS * 2 + 1)))
+worker_class = os.getenv("WAF_WORKER_CLASS", default="gthread" if CPUS <= 2 else "sync")
+threads = int(os.getenv("WAF_THREADS", default="4" if worker_class == "gthread" else "1"))
+
+# Every worker starts its own pool of scanner processes for large bodies (see pool.py), so the server runs
+# workers x WAF_SCAN_WORKERS of them. By default the CPUs are shared out between the workers, at least one
+# process each, rather than every worker getting a process per CPU. app.py reads it when it is preloaded.
+os.environ.setdefault("WAF_SCAN_WORKERS", str(max(1, CPUS // workers)))
+
+preload_app = True
+max_requests = int(os.getenv("WAF_MAX_REQUESTS", default="10000"))  # 0 never recycles workers
+max_requests_jitter = int(os.getenv("WAF_MAX_REQUESTS_JITTER", default=str(max_requests // 10)))
+
+timeout = int(os.getenv("WAF_TIMEOUT", default="30"))
+graceful_timeout = int(os.getenv("WAF_GRACEFUL_TIMEOUT", default="30"))
+keepalive = int(os.getenv("WAF_KEEPALIVE", default="5"))
+
+accesslog = os.getenv("WAF_ACCESS_LOG")  # None disables the access log
+errorlog = "-"
+
+
+# Called in the master once the app is preloaded, before the first worker is forked.
+def when_ready(server):
+    import app
+    app.load_homepage()  # render the homepage once instead of once per worker
+    gc.collect()  # drop the garbage of loading so it is not frozen with the live objects
+    gc.freeze()
+
+
+# Called in each worker once it is initialized. SIGUSR2 sent to a worker starts its profiler, and
+# sent again stops it and writes the sampled stacks to WAF_PROFILE_DIR (see profiler.py); the master
+# keeps its own meaning of SIGUSR2 (upgrading the executable).
+def post_worker_init(worker):
+    import app
+    signal.signal(signal.SIGUSR2, app.PROFILER.toggle)
@@ -0,0 +1,76 @@
+import json
+
+
+# Resource limits on request bodies.
+#
+# Without limits a client can send a body of any size, nesting depth, number of elements or
+# string length and make the server spend memory and CPU on it. The limits are enforced while
+# the body is read and tokenized, before any expensive work: the Content-Length is checked
+# before a single byte is read, bodies without one (chunked) are counted as they are read, and
+# the scanner counts the nesting depth, elements and the lengths of strings and numbers as it
+# tokenizes. A body over a limit is rejected with LimitExceeded, answered with 413 Payload Too
+# Large for the size and 400 Bad Request for the structure limits.
+#
+# The structure limits only apply to the bodies that are tokenized (or indexed, see structural.py).
+# A body that the key prefilter rules out (see BodyScanner in scanner.py) is answered without being
+# tokenized, unless it is streamed past MAX_PENDING bytes: nothing is built from it, and only the
+# size limit applies to it. The size limit of a compressed body (see decoding.py) applies to both
+# its compressed and its decompressed bytes.
+
+
+# Raised when a body exceeds a limit.
+class LimitExceeded(Exception):
+
+    # limit - name of the limit: "bytes", "depth", "elements", "string", "ratio" (see decoding.py)
+    #         or "encoding" for a Content-Encoding that is not supported or does not decode
+    # status - HTTP status code of the response
+    # message - message of the response
+    def __init__(self, limit, status, message):
+        super().__init__(limit, status, message)
+        self.limit = limit
+        self.status = status
+        self.message = message
+        self.response = {"status": "error", "code": status, "message": message, "limit": limit}
+        self.body = json.dumps(self.response).encode("utf-8") + b"\n"  # pre-encoded response
+
+
+class Limits:
+
+    # max_bytes - the maximum size of a body in bytes
+    # max_depth - the maximum nesting depth of objects and arrays
+    # max_elements - the maximum number of array items and object members in a body
+    # max_string - the maximum length of a key, string value or number in bytes, as written in the body
+    # max_ratio - the maximum ratio of the decompressed to the compressed size of an encoded body
+    # Each limit is disabled with None (or 0).
+    def __init__(self, max_bytes=None, max_depth=None, max_elements=None, max_string=None, max_ratio=None):
+        self.max_bytes = max_bytes or None
+        self.max_depth = max_depth or None
+        self.max_elements = max_elements or None
+        self.max_string = max_string or None
+        self.max_ratio = max_ratio or None
+
+    # Check the Content-Length of a request before its body is read (None when it was not sent).
+    def check_length(self, length):
+        if self.max_bytes is not None and length is not None and length > self.max_bytes:
+            raise self.too_large()
+
+    def too_large(self):
+        return LimitExceeded("bytes", 413, "request body larger than %d bytes" % self.max_bytes)
+
+    def too_deep(self):
+        return LimitExceeded("depth", 400, "request body nested deeper than %d levels" % self.max_depth)
+
+    def too_many_elements(self):
+        return LimitExceeded("elements", 400, "request body has more than %d elements" % self.max_elements)
+
+    def string_too_long(self):
+        return LimitExceeded("string", 400, "request body has a string longer than %d bytes" % self.max_string)
+
+    def number_too_long(self):
+        return LimitExceeded("string", 400, "request body has a number longer than %d bytes" % self.max_string)
+
+    def too_compressed(self):
+        return LimitExceeded("ratio", 413, "request body decompresses to more than %g times its size" % self.max_ratio)
+
+
+NO_LIMITS = Limits()
@@ -0,0 +1,224 @@
+import mmap
+import multiprocessing
+import os
+import threading
+
+
+# Counters and histograms of the firewall, shared by every worker process.
+#
+# Each gunicorn worker is a separate process, so counters kept in Python objects would only show
+# what the worker that happens to answer the scrape has seen. Instead the metrics live in one
+# shared memory region (an anonymous shared mmap created when app.py is imported, so it must be
+# imported before the workers are forked, which preload_app in gunicorn.conf.py does). The region
+# is split into slots and each thread of each worker claims a slot of its own the first time it
+# records something, so recording is a plain unlocked increment of 64-bit integers that no other
+# thread ever writes. A scrape of /metrics sums the slots of every worker.
+#
+# A slot that belonged to a worker that has exited (e.g. recycled after max_requests) or to a thread
+# that has exited can be claimed by a new thread; its counts are kept and added to, so the totals
+# never go down.
+#
+# Recorded metrics:
+#   waf_responses_total{code} - responses of /api/handle-request by status code (of every forwarded or
+#       blocked request in proxy mode, see proxy.py)
+#   waf_rule_matches_total{rule} - requests blocked by each rule or signature
+#   waf_phase_seconds{phase} - histogram of the time spent per request in each phase:
+#       request - the whole request, from the start of its handling to the verdict
+#       read - reading a body that is scanned whole (cached or offloaded bodies)
+#       scan - scanning the body; streamed bodies are read while they are scanned
+#   waf_request_body_bytes - histogram of the Content-Length of the requests that have one
+#   waf_cache_lookups_total{outcome} - lookups of the verdict cache (see cache.py) by outcome: a hit, a
+#       miss (the body is scanned) or coalesced (the body waited for the scan of an identical one)
+#   waf_info - always 1, labelled with the configuration (e.g. the JSON decoder in use)
+
+PHASES = ("request", "read", "scan")
+CACHE_OUTCOMES = ("hit", "miss", "coalesced")
+TIME_BUCKETS = 26  # bucket k holds durations below 2**k microseconds (about 33 s for the last one)
+SIZE_BUCKETS = 34  # bucket k holds sizes below 2**k bytes (16 GiB for the last one)
+MIN_CODE = 100
+CODES = 500  # status codes 100 to 599
+
+
+class Metrics:
+
+    # rules - RuleSet whose rules and signatures are counted by number
+    # slots - the number of threads (over all workers) that can record at once
+    # info - labels of the waf_info gauge describing the configuration, e.g. {"json_decoder": "orjson"}
+    def __init__(self, rules, slots=256, info=None):
+        self.info = dict(info or {})
+        self.labels = {rule.number: rule.id for rule in rules.rules}  # rule or signature number -> id
+        if rules.signatures is not None:
+            self.labels.update((signature.number, signature.id) for signature in rules.signatures.signatures)
+        self.slots = slots
+
+        # offsets of the counters of a slot, after the pid of the process that owns it
+        self.codes = 1
+        self.matches = self.codes + CODES
+        self.phases = {}  # phase -> offset of its buckets, followed by the sum (microseconds)
+        offset = self.matches + max(self.labels, default=0) + 1
+        for phase in PHASES:
+            self.phases[phase] = offset
+            offset += TIME_BUCKETS + 1
+        self.request = self.phases["request"]
+        self.sizes = offset  # buckets, then the sum (bytes)
+        offset += SIZE_BUCKETS + 1
+        self.cache = {outcome: offset + index for index, outcome in enumerate(CACHE_OUTCOMES)}
+        self.slot_size = offset + len(CACHE_OUTCOMES)
+
+        self.region = mmap.mmap(-1, slots * self.slot_size * 8)  # anonymous, shared with forked children
+        self.counters = memoryview(self.region).cast("Q")
+        self._claim_lock = multiprocessing.Lock()  # only taken to claim a slot
+        self._local = threading.local()
+        self._free = []  # slots of exited threads of this process, reused by new threads
+        self._generation = 0  # number of forks since this object was created
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    # Record a response of the endpoint.
+    # input: code - the status code
+    #        rule - the Rule or Signature that fired, or None
+    #        length - the Content-Length of the body, None if it was not sent
+    #        seconds - time taken by the whole request
+    def record(self, code, rule, length, seconds):
+        base = self._slot()
+        counters = self.counters
+        counters[base + self.codes + min(max(code - MIN_CODE, 0), CODES - 1)] += 1
+        if rule:
+            counters[base + self.matches + rule.number] += 1
+        index = base + self.request
+        micros = int(seconds * 1000000)
+        counters[index + min(micros.bit_length(), TIME_BUCKETS - 1)] += 1
+        counters[index + TIME_BUCKETS] += micros
+        if length is not None:
+            index = base + self.sizes
+            counters[index + min(length.bit_length(), SIZE_BUCKETS - 1)] += 1
+            counters[index + SIZE_BUCKETS] += length
+
+    # Record the time spent in a phase (one of PHASES) of a request.
+    def observe(self, phase, seconds):
+        index = self._slot() + self.phases[phase]
+        micros = int(seconds * 1000000)
+        counters = self.counters
+        counters[index + min(micros.bit_length(), TIME_BUCKETS - 1)] += 1
+        counters[index + TIME_BUCKETS] += micros
+
+    # Record a lookup of the verdict cache by its outcome (one of CACHE_OUTCOMES).
+    def record_cache(self, outcome):
+        self.counters[self._slot() + self.cache[outcome]] += 1
+
+    # offset of the slot of the calling thread, claimed on first use
+    def _slot(self):
+        slot = getattr(self._local, "slot", None)
+        if slot is None or slot.generation != self._generation:  # first use in this thread or this process
+            slot = self._local.slot = Lease(self, self._claim(os.getpid()), self._generation)
+        return slot.base
+
+    # called in the child after a fork: the threads of the child must claim slots of their own
+    def _after_fork(self):
+        self._generation += 1
+        self._free = []
+
+    def _claim(self, pid):
+        counters = self.counters
+        with self._claim_lock:
+            if self._free:
+                return self._free.pop()
+            for slot in range(self.slots):
+                base = slot * self.slot_size
+                owner = counters[base]
+                if owner == 0 or (owner != pid and not _alive(owner)):
+                    counters[base] = pid
+                    return base
+        raise RuntimeError("all %d metrics slots are in use, raise WAF_METRICS_SLOTS" % self.slots)
+
+    # the counters summed over every slot
+    def totals(self):
+        counters = self.counters
+        rows = [counters[base:base + self.slot_size].tolist()
+                for base in range(0, self.slots * self.slot_size, self.slot_size) if counters[base]]
+        totals = [sum(column) for column in zip(*rows)] if rows else [0] * self.slot_size
+        totals[0] = 0  # the owner pids
+        return totals
+
+    # Render the totals in the Prometheus text exposition format.
+    def exposition(self):
+        totals = self.totals()
+        lines = []
+        if self.info:
+            lines.append("# HELP waf_info Configuration of the firewall.")
+            lines.append("# TYPE waf_info gauge")
+            lines.append("waf_info{%s} 1" % ",".join(
+                '%s="%s"' % (name, _escape(str(value))) for name, value in sorted(self.info.items())))
+        lines.append("# HELP waf_responses_total Responses of /api/handle-request by status code.")
+        lines.append("# TYPE waf_responses_total counter")
+        for index in range(CODES):
+            count = totals[self.codes + index]
+            if count:
+                lines.append('waf_responses_total{code="%d"} %d' % (MIN_CODE + index, count))
+
+        lines.append("# HELP waf_rule_matches_total Requests blocked by each rule or signature.")
+        lines.append("# TYPE waf_rule_matches_total counter")
+        for number, rule_id in sorted(self.labels.items()):
+            lines.append('waf_rule_matches_total{rule="%s"} %d' % (_escape(rule_id), totals[self.matches + number]))
+
+        lines.append("# HELP waf_phase_seconds Time spent per request in each phase.")
+        lines.append("# TYPE waf_phase_seconds histogram")
+        for phase in PHASES:
+            offset = self.phases[phase]
+            lines.extend(_histogram("waf_phase_seconds", 'phase="%s",' % phase, totals, offset, TIME_BUCKETS,
+                                    lambda k: "%g" % (2 ** k / 1000000.0), 1000000.0))
+
+        lines.append("# HELP waf_request_body_bytes Content-Length of the request bodies.")
+        lines.append("# TYPE waf_request_body_bytes histogram")
+        lines.extend(_histogram("waf_request_body_bytes", "", totals, self.sizes, SIZE_BUCKETS,
+                                lambda k: "%d" % 2 ** k, 1))
+
+        lines.append("# HELP waf_cache_lookups_total Lookups of the verdict cache by outcome.")
+        lines.append("# TYPE waf_cache_lookups_total counter")
+        for outcome in CACHE_OUTCOMES:
+            lines.append('waf_cache_lookups_total{outcome="%s"} %d' % (outcome, totals[self.cache[outcome]]))
+        return "\n".join(lines) + "\n"
+
+
+# The slot of a thread. Thread locals are dropped when their thread exits, which returns the slot
+# to its process, so servers that start a thread per request (like the Flask development server)
+# do not use up the slots.
+class Lease:
+
+    def __init__(self, metrics, base, generation):
+        self.metrics = metrics
+        self.base = base
+        self.generation = generation
+
+    def __del__(self):
+        if self.generation == self.metrics._generation:  # not a slot of the parent process
+            self.metrics._free.append(self.base)
+
+
+# Lines of a histogram whose buckets and sum start at offset in totals (the count is the sum of the buckets).
+# The last bucket also counts everything larger, so it is reported as +Inf.
+def _histogram(name, labels, totals, offset, buckets, bound, scale):
+    lines = []
+    cumulative = 0
+    for k in range(buckets):
+        cumulative += totals[offset + k]
+        le = "+Inf" if k == buckets - 1 else bound(k)
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, le, cumulative))
+    labels = "{%s}" % labels.rstrip(",") if labels else ""
+    lines.append("%s_sum%s %g" % (name, labels, totals[offset + buckets] / scale))
+    lines.append("%s_count%s %d" % (name, labels, cumulative))
+    return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# True if a process with this pid exists
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, owned by another user
+        return True
+    return True
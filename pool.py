@@ -0,0 +1,104 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from decoders import scan_complete, select_decoder
+
+
+# A bounded pool of scanner processes for large bodies.
+#
+# Scanning is pure Python CPU work, so a huge body scanned inside a request thread holds the
+# GIL and its worker for seconds, stalling every small request queued behind it. Bodies above
+# a size threshold are instead sent to a pool of scanner processes, while small bodies keep
+# being scanned inline. The pool only accepts a bounded number of bodies at once; when it is
+# saturated, submit raises PoolSaturated right away (back-pressure) instead of queueing without
+# limit, and the request is answered with 503 Service Unavailable.
+#
+# The processes are started lazily with the "spawn" method, so a pool is never inherited across
+# a fork (e.g. from a preloading gunicorn master) and never forks a multi-threaded process.
+
+
+# Raised when the pool already holds max_pending bodies.
+class PoolSaturated(Exception):
+    pass
+
+
+class ScanPool:
+
+    # rules - the RuleSet the worker processes scan with
+    # workers - the number of scanner processes
+    # limits - the Limits bodies are scanned with (see limits.py), None for no limits
+    # decoder - the name of the JSON decoder the worker processes use (see decoders.py)
+    # index_min_body - bodies of at least this many bytes are tried with the structural index (see structural.py),
+    #                  0 to never use it
+    # max_pending - the maximum number of bodies queued or being scanned (defaults to 2 per process)
+    # wait - seconds to wait for a free slot before PoolSaturated is raised
+    def __init__(self, rules, workers, limits=None, decoder="stream", index_min_body=0, max_pending=None, wait=0.0):
+        self.rules = rules
+        self.limits = limits
+        self.decoder = decoder
+        self.index_min_body = index_min_body
+        self.workers = workers
+        self.max_pending = max_pending or 2 * workers
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._pid = None  # process that created the executor
+        self._lock = threading.Lock()
+
+    # Scan a complete body in a worker process and wait for its verdict.
+    # input: body - the raw body bytes
+    #        encoding - the Content-Encoding of the body, None if it was not sent (see decoding.py)
+    # output: the Rule or Signature that fired or NO_MATCH (False)
+    # raises LimitExceeded (from the worker) if the body is over one of the limits
+    def scan(self, body, encoding=None):
+        if self.wait:
+            acquired = self._slots.acquire(timeout=self.wait)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            raise PoolSaturated()
+        try:
+            number = self._get_executor().submit(_scan, body, encoding).result()
+        finally:
+            self._slots.release()
+        return self.rules.by_number(number) or False
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.rules, self.limits, self.decoder, self.index_min_body),
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+
+worker_rules = None  # the RuleSet of a worker process
+worker_limits = None  # the Limits of a worker process
+worker_decoder = None  # the JSON Decoder of a worker process, None to tokenize every body
+worker_index_min_body = 0  # smallest body a worker process tries with the structural index, 0 for none
+
+
+def _init_worker(rules, limits, decoder, index_min_body=0):
+    global worker_rules, worker_limits, worker_decoder, worker_index_min_body
+    worker_rules = rules
+    worker_limits = limits
+    worker_decoder = select_decoder(decoder)
+    worker_index_min_body = index_min_body
+
+
+# runs in a worker process, returns the number of the rule or signature that fired (0 for none)
+def _scan(body, encoding):
+    verdict = scan_complete(body, worker_rules, worker_limits, worker_decoder, worker_index_min_body, encoding)
+    return verdict.number if verdict else 0
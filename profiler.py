@@ -0,0 +1,176 @@
+import atexit
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.wsgi import get_content_length
+
+
+# A sampling profiler for the request path.
+#
+# When latency spikes it is not obvious whether the time goes into reading the body, decoding it
+# or scanning it. While the profiler runs, a background thread wakes up every interval seconds and
+# records the Python stack of every thread that is handling a profiled request. A request is
+# profiled when it is picked at random (rate), when its Content-Length is at least min_bytes, or,
+# with min_seconds, when it turns out to take at least that long (every request is then sampled
+# and the samples of the fast ones are dropped). The stacks are aggregated in memory and written
+# in the collapsed format of flame graph tools, one "caller;callee;... count" line per stack:
+#   flamegraph.pl waf-profile-*.collapsed > flame.svg
+#
+# A stopped profiler costs nothing: start() wraps the WSGI application of the Flask app and stop()
+# puts the original back, so no code of the profiler runs on the request path while it is off.
+# In production, send SIGUSR2 to a worker to start profiling it and again to stop and write its
+# stacks to WAF_PROFILE_DIR (see gunicorn.conf.py).
+
+DEFAULT_INTERVAL = 0.005  # seconds between two samples
+
+
+class Profiler:
+
+    # rate - fraction of the requests profiled at random
+    # min_bytes - requests with at least this Content-Length are profiled, None to not select by size
+    # min_seconds - requests taking at least this long are profiled, None to not select by latency
+    # interval - seconds between two samples
+    # directory - where dump() writes the collapsed stacks
+    def __init__(self, rate=0.01, min_bytes=None, min_seconds=None, interval=DEFAULT_INTERVAL, directory=None):
+        self.rate = rate
+        self.min_bytes = min_bytes
+        self.min_seconds = min_seconds
+        self.interval = interval
+        self.directory = directory or tempfile.gettempdir()
+        self.stacks = collections.Counter()  # collapsed stack -> number of samples
+        self.requests = 0  # profiled requests whose samples were kept
+        self.running = False
+        self._app = None
+        self._original = None  # WSGI application of the app while the profiler runs
+        self._sampling = {}  # thread id -> samples of the profiled request that thread handles
+        self._lock = threading.RLock()  # reentrant, stop() may run in a signal handler
+        self._sampler = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    # Profile the requests of a Flask app from now on (when started).
+    def attach(self, app):
+        self._app = app
+
+    def start(self):
+        if self.running:
+            return
+        self._original = self._app.wsgi_app
+        self._app.wsgi_app = self._profiled
+        self.running = True
+        self._start_sampler()
+
+    # Stop profiling.
+    # output: path of the file the collapsed stacks were written to, None if nothing was sampled
+    def stop(self):
+        if not self.running:
+            return None
+        self.running = False
+        self._app.wsgi_app = self._original
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        return self.dump()
+
+    # signal handler: start the profiler if it is stopped, stop it if it runs
+    def toggle(self, signum=None, frame=None):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    # the aggregated stacks in collapsed format
+    def collapsed(self):
+        with self._lock:
+            return "".join("%s %d\n" % item for item in sorted(self.stacks.items()))
+
+    # Write the aggregated stacks to a new file of the directory and start aggregating afresh.
+    # output: path of the file, None if nothing was sampled
+    def dump(self):
+        text = self.collapsed()
+        with self._lock:
+            self.stacks.clear()
+            self.requests = 0
+        if not text:
+            return None
+        path = os.path.join(self.directory, "waf-profile-%d-%d.collapsed" % (os.getpid(), time.time()))
+        with open(path, "w") as profile:
+            profile.write(text)
+        return path
+
+    # The WSGI application while the profiler runs.
+    def _profiled(self, environ, start_response):
+        length = get_content_length(environ)
+        selected = random.random() < self.rate or (self.min_bytes is not None and (length or 0) >= self.min_bytes)
+        if not selected and self.min_seconds is None:
+            return self._original(environ, start_response)
+
+        thread = threading.get_ident()
+        samples = self._sampling[thread] = []
+        start = time.perf_counter()
+        try:
+            return self._original(environ, start_response)
+        finally:
+            del self._sampling[thread]
+            if selected or time.perf_counter() - start >= self.min_seconds:
+                with self._lock:
+                    self.stacks.update(samples)
+                    self.requests += 1
+
+    def _start_sampler(self):
+        self._sampler = threading.Thread(target=self._sample, name="waf-profiler", daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while self.running:
+            time.sleep(self.interval)
+            if not self._sampling:
+                continue
+            frames = sys._current_frames()
+            for thread, samples in list(self._sampling.items()):
+                frame = frames.get(thread)
+                if frame is not None:
+                    samples.append(collapse(frame))
+
+    # threads do not survive a fork, a child of a running profiler (a gunicorn worker) needs its own sampler
+    def _after_fork(self):
+        self._sampling = {}
+        self._lock = threading.RLock()  # reentrant, stop() may run in a signal handler
+        if self.running:
+            self._start_sampler()
+
+
+# Collapse the stack of a frame into "outermost;...;innermost", each frame as module:function.
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (frame.f_globals.get("__name__", "?"), getattr(code, "co_qualname", code.co_name)))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+# Create the profiler of the app from the environment:
+#   WAF_PROFILE=1 starts it right away, otherwise it waits for SIGUSR2
+#   WAF_PROFILE_RATE, WAF_PROFILE_MIN_BYTES, WAF_PROFILE_MIN_SECONDS select the requests (see Profiler)
+#   WAF_PROFILE_INTERVAL is the sampling interval and WAF_PROFILE_DIR where stacks are written
+def from_env(app):
+    min_bytes = os.getenv("WAF_PROFILE_MIN_BYTES")
+    min_seconds = os.getenv("WAF_PROFILE_MIN_SECONDS")
+    profiler = Profiler(
+        rate=float(os.getenv("WAF_PROFILE_RATE", default=0.01)),
+        min_bytes=int(min_bytes) if min_bytes else None,
+        min_seconds=float(min_seconds) if min_seconds else None,
+        interval=float(os.getenv("WAF_PROFILE_INTERVAL", default=DEFAULT_INTERVAL)),
+        directory=os.getenv("WAF_PROFILE_DIR"),
+    )
+    profiler.attach(app)
+    if os.getenv("WAF_PROFILE", default="0") == "1":
+        profiler.start()
+    atexit.register(profiler.stop)  # keep what was sampled when the process exits
+    return profiler
@@ -0,0 +1,287 @@
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from werkzeug.wsgi import get_content_length, get_input_stream
+
+from fastpath import FastPath
+
+
+# Reverse proxy mode.
+#
+# Run as a separate hop, the firewall only answers a verdict and the client then sends the same
+# body again to the backend, which doubles the bandwidth and adds a round trip to every request.
+# In proxy mode (WAF_UPSTREAM set, see app.py) the firewall sits inline instead: Proxy wraps the
+# Flask application like FastPath and handles every request itself. A request a rule forbids gets
+# the response of the rule (403 by default) and never reaches the backend; any other request is
+# forwarded to the upstream, method, path, query string, headers and body, and the response of the
+# upstream is streamed back to the client.
+#
+# No byte of a body reaches the upstream before its verdict is known, as the upstream could act on a
+# body whose end holds the pair of a rule. While the scanner reads the body, every chunk it reads is
+# also written to a spool, which keeps up to SPOOL_MEMORY bytes in memory and moves larger bodies to a
+# temporary file, and the part of the body the scanner did not need (e.g. after a prefilter miss or in a
+# body type that is not inspected) is read into it afterwards. The spool is then streamed to the upstream
+# chunk by chunk, so a body is never held in memory whole by the proxy. Bodies are thus buffered rather
+# than streamed through to the upstream as they arrive, deliberately: until the last byte is scanned it
+# can still turn the verdict into a block.
+#
+# Connections to the upstream are HTTP/1.1 keep-alive connections kept in an UpstreamPool and reused
+# from one request to the next, so a forwarded request costs no connection setup. A pooled connection
+# the upstream closed while it was idle is detected when the request is sent and the request is sent
+# again on another connection.
+
+CHUNK_SIZE = 64 * 1024  # bytes sent to the upstream or returned to the client at a time
+SPOOL_MEMORY = 1024 * 1024  # bytes of a body kept in memory before it is spooled to a temporary file
+LOCAL_PATHS = frozenset(("/metrics",))  # paths the firewall answers itself in proxy mode
+# headers that only apply to one connection (RFC 7230 section 6.1), never forwarded
+HOP_BY_HOP = frozenset(("connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection",
+                        "te", "trailer", "transfer-encoding", "upgrade"))
+# headers of a request the proxy sets itself
+FORWARDED = frozenset(("host", "content-length", "x-forwarded-for", "x-forwarded-host", "x-forwarded-proto"))
+# errors of a request to the upstream, answered with 502 Bad Gateway
+UPSTREAM_ERRORS = (http.client.HTTPException, OSError)
+# errors of a request whose target or headers cannot be sent on, e.g. a header value with a control
+# character, answered with 400 Bad Request
+INVALID_REQUEST_ERRORS = (ValueError, http.client.InvalidURL)
+
+
+class UpstreamPool:
+
+    # url - the base URL of the upstream, e.g. http://127.0.0.1:8080 (a path is prefixed to every request)
+    # size - the maximum number of idle connections kept open
+    # timeout - seconds to wait for the upstream to accept a connection or send data
+    # raises ValueError for a URL that is not http or https
+    def __init__(self, url, size=16, timeout=30.0):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("upstream must be an http:// or https:// URL, got %r" % url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.size = size
+        self.timeout = timeout
+        self._idle = []  # idle connections, the most recently used last
+        self._lock = threading.Lock()
+        self._pid = os.getpid()  # process the idle connections belong to
+
+    # Send a request to the upstream and read the head of its response.
+    # input: method - the request method
+    #        target - the path and query string of the request
+    #        headers - list of (name, value) of the headers to send, besides Host and Content-Length
+    #        body - a file-like object holding the body, read from its start, None for no body
+    #        length - the size of the body in bytes
+    # output: (connection, response) with the body of the response left to read, see release
+    # raises one of INVALID_REQUEST_ERRORS if the target or a header cannot be sent, before any byte is sent
+    #        one of UPSTREAM_ERRORS if the upstream cannot be reached or does not answer
+    def request(self, method, target, headers, body=None, length=0):
+        while True:
+            connection, reused = self._acquire()
+            try:
+                connection.putrequest(method, self.prefix + target, skip_host=True, skip_accept_encoding=True)
+                connection.putheader("Host", self.netloc)
+                for name, value in headers:
+                    connection.putheader(name, value)
+                if body is not None:
+                    connection.putheader("Content-Length", str(length))
+                connection.endheaders()
+                if body is not None:
+                    body.seek(0)
+                    chunk = body.read(CHUNK_SIZE)
+                    while chunk:
+                        connection.send(chunk)
+                        chunk = body.read(CHUNK_SIZE)
+                return connection, connection.getresponse()
+            except INVALID_REQUEST_ERRORS:
+                connection.close()  # in the middle of a request, it cannot be used again
+                raise
+            except UPSTREAM_ERRORS as error:
+                connection.close()
+                if not reused or not isinstance(error, ConnectionError):
+                    raise
+                # the upstream closed the idle connection (it resets it or answers nothing), send the request
+                # again on another one; a request that timed out is never sent twice
+
+    # Put back the connection of a response once its body has been read, or close it.
+    def release(self, connection, response):
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                if self._pid == os.getpid() and len(self._idle) < self.size:
+                    self._idle.append(connection)
+                    return
+        connection.close()
+
+    # an idle connection, or a new one; and whether it was used before
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():  # the connections of the parent process are not ours to use
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+# A body stream that copies what is read from it to a spool, to be forwarded once the verdict is known.
+class Spool:
+
+    # stream - the body stream of the request
+    # limits - the Limits of the request, the size limit applies to the part the scanner does not read too
+    def __init__(self, stream, limits=None):
+        self.stream = stream
+        self.limits = limits
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read() if size is None or size < 0 else self.stream.read(size)
+        self.size += len(chunk)
+        if self.limits is not None and self.limits.max_bytes is not None and self.size > self.limits.max_bytes:
+            raise self.limits.too_large()
+        self.file.write(chunk)
+        return chunk
+
+    # Read the rest of the body into the spool.
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self):
+        self.file.close()
+
+
+class Proxy(FastPath):
+
+    # wsgi_app - the WSGI application that answers LOCAL_PATHS
+    # scan - function (stream, length, content encoding, content type, query string) returning the verdict
+    #        of a request, see scan_request in app.py
+    # upstream - the UpstreamPool allowed requests are forwarded to
+    # unavailable - response body dict when the upstream cannot be reached (502 Bad Gateway)
+    # bad_request - response body dict when the target or a header of a request cannot be forwarded
+    #               (400 Bad Request)
+    # limits - the Limits of the requests, see Spool
+    # busy, rejected, metrics - see FastPath
+    def __init__(self, wsgi_app, scan, upstream, unavailable, bad_request, limits=None, busy=None, rejected=None,
+                 metrics=None):
+        super().__init__(wsgi_app, scan, unavailable, busy=busy, rejected=rejected, metrics=metrics)
+        self.upstream = upstream
+        self.limits = limits
+        self.unavailable = self._encode(502, json.dumps(unavailable).encode("utf-8") + b"\n")
+        self.bad_request = self._encode(400, json.dumps(bad_request).encode("utf-8") + b"\n")
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") in LOCAL_PATHS:
+            return self.wsgi_app(environ, start_response)
+
+        start = time.perf_counter()
+        verdict = None
+        response = None
+        length = get_content_length(environ)
+        spool = Spool(get_input_stream(environ), self.limits)
+        try:
+            verdict = self.scan(spool, length, environ.get("HTTP_CONTENT_ENCODING"),
+                                environ.get("CONTENT_TYPE", ""), environ.get("QUERY_STRING", ""))
+            if not verdict:
+                spool.drain()
+        except self.busy_error:
+            response = self.busy
+        except self.rejected_error as error:
+            response = self._rejection(error)
+        else:
+            if verdict:
+                response = self._verdict(verdict)
+
+        if response is None:  # allowed, forward it
+            try:
+                has_body = length is not None or "HTTP_TRANSFER_ENCODING" in environ
+                connection, upstream_response = self.upstream.request(
+                    environ["REQUEST_METHOD"], _target(environ), _headers(environ),
+                    spool.file if has_body else None, spool.size)
+            except INVALID_REQUEST_ERRORS:
+                response = self.bad_request
+            except UPSTREAM_ERRORS:
+                response = self.unavailable
+            else:
+                spool.close()
+                if self.metrics is not None:
+                    self.metrics.record(upstream_response.status, None, length, time.perf_counter() - start)
+                start_response("%d %s" % (upstream_response.status, upstream_response.reason),
+                               [(name, value) for name, value in upstream_response.getheaders()
+                                if name.lower() not in HOP_BY_HOP])
+                return Forwarded(self.upstream, connection, upstream_response)
+        spool.close()
+
+        status_line, headers, body = response
+        if self.metrics is not None:
+            self.metrics.record(int(status_line[:3]), verdict, length, time.perf_counter() - start)
+        start_response(status_line, list(headers))
+        if environ["REQUEST_METHOD"] == "HEAD":
+            return [b""]
+        return [body]
+
+
+# The body of an upstream response, streamed to the client chunk by chunk. The connection goes back to
+# the pool when the WSGI server closes the iterable, if the whole body was read.
+class Forwarded:
+
+    def __init__(self, upstream, connection, response):
+        self.upstream = upstream
+        self.connection = connection
+        self.response = response
+
+    def __iter__(self):
+        chunk = self.response.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.response.read(CHUNK_SIZE)
+
+    def close(self):
+        self.upstream.release(self.connection, self.response)
+
+
+# the path and query string of a request, as sent by the client
+def _target(environ):
+    path = (environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")).encode("latin-1")
+    target = quote(path, safe="/:@!$&'()*+,;=-._~%") or "/"
+    query = environ.get("QUERY_STRING")
+    return target + "?" + query if query else target
+
+
+# the end-to-end headers of a request, with the client added to X-Forwarded-For and the Host and scheme
+# it was sent to in X-Forwarded-Host and X-Forwarded-Proto
+def _headers(environ):
+    connection = {token.strip().lower() for token in environ.get("HTTP_CONNECTION", "").split(",")}
+    headers = []
+    for key, value in environ.items():
+        if key.startswith("HTTP_"):
+            name = key[5:].replace("_", "-").title()
+        elif key == "CONTENT_TYPE" and value:
+            name = "Content-Type"
+        else:
+            continue
+        lowered = name.lower()
+        if lowered in HOP_BY_HOP or lowered in connection or lowered in FORWARDED:
+            continue
+        headers.append((name, value))
+    forwarded_for = environ.get("HTTP_X_FORWARDED_FOR")
+    client = environ.get("REMOTE_ADDR")
+    if client:
+        forwarded_for = forwarded_for + ", " + client if forwarded_for else client
+    if forwarded_for:
+        headers.append(("X-Forwarded-For", forwarded_for))
+    if environ.get("HTTP_HOST"):
+        headers.append(("X-Forwarded-Host", environ["HTTP_HOST"]))
+    headers.append(("X-Forwarded-Proto", environ.get("wsgi.url_scheme", "http")))
+    return headers
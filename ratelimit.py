@@ -0,0 +1,164 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import time
+
+from werkzeug.wsgi import get_content_length
+
+
+# Per-client rate limiting of the firewall routes, in fixed memory.
+#
+# Scanning costs CPU for every request, so a client that hammers the firewall is turned away before
+# its body is read: RateLimiter wraps the WSGI application (outside the fast path and the proxy, see
+# app.py) and answers 429 Too Many Requests, with a Retry-After header, to a client over the rate of
+# the route without touching wsgi.input.
+#
+# Each client has a token bucket per route, tracked with the generic cell rate algorithm (GCRA): a
+# bucket of `burst` tokens refilled at `rate` tokens per second is a single number, its theoretical
+# arrival time (TAT). A request at time `now` moves the TAT to max(TAT, now) + 1 / rate and is allowed
+# if that is at most burst / rate ahead of now, i.e. if a token was left.
+#
+# The TATs live in a count-min sketch (BucketSketch) instead of a table per client, so the memory is
+# the same however many clients are seen: `depth` rows of `cells` numbers, and a client (and route) is
+# hashed to one cell per row with a secret key, so clients cannot pick keys that collide on purpose. A
+# cell shared by several clients holds the latest TAT of any of them, which can only be later than the
+# client's own, so the smallest of the client's cells is the closest estimate and is never too early.
+# A collision can never let a client exceed its rate, it can only make it wait longer, and only when
+# every one of its cells is shared, which is unlikely with several rows. Cells are only ever raised to the
+# new TAT (the conservative update), which keeps the estimates of the other clients as low as possible.
+#
+# The sketch is an anonymous shared mmap created when app.py is imported, before gunicorn forks its
+# workers (preload_app), so every worker counts into the same buckets like the metrics (see metrics.py).
+# Updates are unlocked: two workers updating a cell at the same instant may lose one of the requests.
+
+DEPTH = 4  # rows of the sketch, each client has a cell in every row
+CELLS = 65536  # cells per row
+DEFAULT_ROUTE = "*"  # the route of rate limits for every path that has none of its own
+# the header X-Forwarded-For is appended to by every proxy on the way, only its last address was set by
+# the proxy in front of the firewall and cannot be forged by the client
+FORWARDED_FOR = "X-Forwarded-For"
+
+
+# The rate limit of a route.
+class Rate:
+
+    # rate - requests per second a client is allowed on average
+    # burst - requests a client may send at once, after it has been idle (defaults to a second worth)
+    def __init__(self, rate, burst=None):
+        if not rate > 0:
+            raise ValueError("rate must be a positive number of requests per second")
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, math.floor(self.rate))
+        if self.burst < 1:
+            raise ValueError("burst must be at least one request")
+        self.interval = 1.0 / self.rate  # seconds a token takes to refill
+        self.tolerance = self.burst * self.interval  # the furthest the TAT may be ahead of now
+
+    def __repr__(self):
+        return "<Rate %g/s burst %g>" % (self.rate, self.burst)
+
+
+# Parse the rate limits of WAF_RATE_LIMITS: comma separated route=rate or route=rate:burst entries, with
+# the rate in requests per second, e.g. "/api/handle-request=100:200,*=1000". The route * applies to every
+# path without an entry of its own.
+# output: dict route -> Rate, empty for no rate limits
+# raises ValueError for a malformed entry
+def parse_rates(spec):
+    rates = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        route, separator, rate = entry.rpartition("=")
+        route = route.strip()
+        if not separator or not route:
+            raise ValueError("rate limit %r is not route=rate or route=rate:burst" % entry)
+        rate, _, burst = rate.partition(":")
+        try:
+            rates[route] = Rate(float(rate), float(burst) if burst.strip() else None)
+        except ValueError as error:
+            raise ValueError("rate limit %r: %s" % (entry, error))
+    return rates
+
+
+class BucketSketch:
+
+    # cells - the number of cells per row
+    # depth - the number of rows
+    # clock - returns the current time in seconds, the same in every process (time.monotonic)
+    def __init__(self, cells=CELLS, depth=DEPTH, clock=time.monotonic):
+        self.cells = cells
+        self.depth = depth
+        self.clock = clock
+        self.secret = os.urandom(16)  # key of the hash, shared with the forked workers
+        self.region = mmap.mmap(-1, cells * depth * 8)  # anonymous, shared with forked children
+        self.tats = memoryview(self.region).cast("d")
+
+    # Take a token from the bucket of a key.
+    # input: key - the bytes identifying the client and route
+    #        rate - the Rate of the bucket
+    # output: 0 if the request is allowed, otherwise the seconds until the bucket has a token again
+    def take(self, key, rate):
+        now = self.clock()
+        digest = hashlib.blake2b(key, digest_size=4 * self.depth, key=self.secret).digest()
+        indices = [row * self.cells + int.from_bytes(digest[4 * row:4 * row + 4], "big") % self.cells
+                   for row in range(self.depth)]
+        tats = self.tats
+        tat = max(min(tats[index] for index in indices), now) + rate.interval
+        wait = tat - now - rate.tolerance
+        if wait > 0:
+            return wait
+        for index in indices:
+            if tats[index] < tat:
+                tats[index] = tat
+        return 0
+
+
+class RateLimiter:
+
+    # wsgi_app - the WSGI application the allowed requests go to
+    # rates - dict route (a path, or DEFAULT_ROUTE) -> Rate, see parse_rates
+    # limited - response body dict of a request over the rate (429 Too Many Requests)
+    # key_header - the request header that identifies a client, None for its address (REMOTE_ADDR); a client
+    #              without the header is identified by its address
+    # sketch - the BucketSketch of the buckets
+    # metrics - Metrics every rejected request is recorded in (see metrics.py), or None
+    def __init__(self, wsgi_app, rates, limited, key_header=None, sketch=None, metrics=None):
+        self.wsgi_app = wsgi_app
+        self.rates = dict(rates)
+        self.default = self.rates.pop(DEFAULT_ROUTE, None)
+        self.body = json.dumps(limited).encode("utf-8") + b"\n"
+        self.key_environ = "HTTP_" + key_header.upper().replace("-", "_") if key_header else None
+        self.last_address = key_header is not None and key_header.lower() == FORWARDED_FOR.lower()
+        self.sketch = sketch or BucketSketch()
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        rate = self.rates.get(path, self.default)
+        if rate is None:
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        wait = self.sketch.take(("%s\0%s" % (path if path in self.rates else DEFAULT_ROUTE,
+                                             self._client(environ))).encode("latin-1", "replace"), rate)
+        if not wait:
+            return self.wsgi_app(environ, start_response)
+
+        if self.metrics is not None:
+            self.metrics.record(429, None, get_content_length(environ), time.perf_counter() - start)
+        start_response("429 Too Many Requests", [("Content-Type", "application/json"),
+                                                 ("Content-Length", str(len(self.body))),
+                                                 ("Retry-After", str(math.ceil(wait)))])
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return [b""]
+        return [self.body]
+
+    # the key of the client of a request
+    def _client(self, environ):
+        if self.key_environ is not None:
+            value = environ.get(self.key_environ)
+            if value:
+                return value.rsplit(",", 1)[-1].strip() if self.last_address else value
+        return environ.get("REMOTE_ADDR", "")
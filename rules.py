@@ -0,0 +1,184 @@
+import hashlib
+import json
+
+from signatures import compile_signatures
+
+
+# Detection rules of the firewall and the matcher they are compiled into.
+#
+# A rule forbids a key, either an exact key or every key starting with a prefix. It may
+# also list the values it applies to; the value found in the body is compared with == like
+# the original { "is_malicious": true } check, so only scalar values can match a value rule
+# and a rule for true also matches 1 and 1.0. A rule without values forbids the key whatever
+# it maps to. Rules are loaded from a JSON file such as rules.json:
+# {
+#     "rules": [
+#         {"id": "is-malicious", "key": "is_malicious", "values": [true], "message": "is_malicious found"},
+#         {"id": "debug-flag", "prefix": "__debug", "status": 403, "message": "debug keys are not allowed"}
+#     ]
+# }
+#
+# All rules are compiled into one RuleSet (a hash of exact keys plus a prefix trie), so every
+# key in a body is checked against every rule with a single lookup during a single traversal.
+# The rule file may also list value signatures, which are checked against every string value
+# during the same traversal (see signatures.py).
+
+
+# Raised when a rule file is malformed.
+class RuleError(ValueError):
+    pass
+
+
+class Rule:
+
+    # number - position of the rule in its rule set, starting at 1
+    # rule_id - name of the rule reported in responses
+    # key - exact key the rule applies to (or None)
+    # prefix - key prefix the rule applies to (or None)
+    # values - list of scalar values the key must map to, None for any value
+    # status - HTTP status code of the response when the rule fires
+    # message - message of the response when the rule fires
+    def __init__(self, number, rule_id, key=None, prefix=None, values=None, status=403, message=""):
+        self.number = number
+        self.id = rule_id
+        self.key = key
+        self.prefix = prefix
+        self.values = values
+        self.status = status
+        self.message = message
+        # response body, replaces the fixed forbidden dict of the original firewall
+        self.response = {"status": "error", "code": status, "message": message, "rule": rule_id}
+        self.body = json.dumps(self.response).encode("utf-8") + b"\n"  # pre-encoded response
+
+    # True if the rule fires for a scalar value (the key is already known to match)
+    def accepts(self, value):
+        if self.values is None:
+            return True
+        for expected in self.values:
+            if value == expected:
+                return True
+        return False
+
+    def __repr__(self):
+        return "<Rule %d %s>" % (self.number, self.id)
+
+
+class RuleSet:
+
+    KEY_CACHE_SIZE = 4096  # distinct keys remembered by match_key
+
+    # rules - list of Rule
+    # signatures - SignatureSet checked against string values, or None
+    # version - identifies the rule set, e.g. for caches keyed on verdicts
+    def __init__(self, rules, signatures=None, version=None):
+        self.rules = list(rules)
+        self.signatures = signatures if signatures else None
+        self.version = version or hashlib.sha1(repr([
+            (rule.id, rule.key, rule.prefix, rule.values, rule.status, rule.message) for rule in self.rules
+        ] + [
+            (signature.id, signature.literal, signature.regex, signature.ignore_case, signature.status,
+             signature.message) for signature in (signatures.signatures if signatures else ())
+        ]).encode("utf-8")).hexdigest()
+        self.exact = {}  # key -> rules for that key
+        self.trie = {}  # prefix trie, one nested dict per character, rules stored under None
+        for rule in self.rules:
+            if rule.key is not None:
+                self.exact.setdefault(rule.key, []).append(rule)
+            else:
+                node = self.trie
+                for char in rule.prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(rule)
+        self._key_cache = {}
+
+    # Find a rule or signature by its number, e.g. for a verdict computed in another process.
+    # output: Rule, Signature, or None for number 0 (no match) or an unknown number
+    def by_number(self, number):
+        if 1 <= number <= len(self.rules):
+            return self.rules[number - 1]
+        if self.signatures is not None:
+            for signature in self.signatures.signatures:
+                if signature.number == number:
+                    return signature
+        return None
+
+    # the exact keys and prefixes the rules look for, as (text, is_prefix) pairs
+    def needles(self):
+        return [(rule.key, False) if rule.key is not None else (rule.prefix, True) for rule in self.rules]
+
+    # Find the rules that apply to a key.
+    # output: tuple of Rule in rule set order, empty if no rule applies
+    def match_key(self, key):
+        rules = self._key_cache.get(key)
+        if rules is not None:
+            return rules
+        rules = list(self.exact.get(key, ()))
+        node = self.trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            rules.extend(node.get(None, ()))
+        rules = tuple(sorted(rules, key=lambda rule: rule.number)) if len(rules) > 1 else tuple(rules)
+        if len(self._key_cache) >= self.KEY_CACHE_SIZE:
+            self._key_cache.clear()
+        self._key_cache[key] = rules
+        return rules
+
+    # Find the first rule that fires for a key mapped to a value.
+    # value - the decoded value, or CONTAINER for a dict or list (only rules without values fire)
+    # output: Rule or None
+    def match(self, key, value):
+        for rule in self.match_key(key):
+            if rule.values is None or (value is not CONTAINER and rule.accepts(value)):
+                return rule
+        return None
+
+
+CONTAINER = object()  # stands for a dict or list value in RuleSet.match
+SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))  # types produced for JSON scalars
+
+
+# Build a RuleSet from decoded configuration.
+# input: {"rules": [...], "signatures": [...]} or a plain list of rule dicts
+# output: RuleSet
+def compile_rules(config, version=None):
+    entries = config.get("rules", []) if isinstance(config, dict) else config
+    if not isinstance(entries, list):
+        raise RuleError("expected a list of rules")
+    rules = []
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise RuleError("rule %d is not an object" % number)
+        key = entry.get("key")
+        prefix = entry.get("prefix")
+        if (key is None) == (prefix is None):
+            raise RuleError("rule %d needs exactly one of key or prefix" % number)
+        if not isinstance(key if key is not None else prefix, str) or prefix == "":
+            raise RuleError("rule %d key or prefix must be a non-empty string" % number)
+        values = entry.get("values")
+        if "value" in entry:
+            values = [entry["value"]]
+        if values is not None and (not isinstance(values, list) or any(isinstance(value, (dict, list)) for value in values)):
+            raise RuleError("rule %d values must be a list of scalars" % number)
+        status = entry.get("status", 403)
+        if not isinstance(status, int) or not 400 <= status <= 599:
+            raise RuleError("rule %d status must be an HTTP error code" % number)
+        rules.append(Rule(number, str(entry.get("id", number)), key=key, prefix=prefix, values=values,
+                          status=status, message=str(entry.get("message", ""))))
+    signatures = None
+    if isinstance(config, dict) and config.get("signatures"):
+        signatures = compile_signatures(config["signatures"], first_number=len(rules) + 1, error_type=RuleError)
+    return RuleSet(rules, signatures, version)
+
+
+# Load and compile a rule file.
+# output: RuleSet whose version is a hash of the file contents
+def load_rules(path):
+    with open(path, "rb") as rule_file:
+        data = rule_file.read()
+    try:
+        config = json.loads(data)
+    except ValueError as e:
+        raise RuleError("%s is not valid JSON: %s" % (path, e))
+    return compile_rules(config, version=hashlib.sha1(data).hexdigest())
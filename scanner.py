@@ -0,0 +1,547 @@
+import codecs
+import functools
+import json
+import re
+
+from limits import NO_LIMITS
+from rules import CONTAINER
+
+
+# An incremental JSON scanner used by the firewall to inspect request bodies.
+#
+# Instead of decoding the whole body into Python objects and then walking them,
+# the scanner tokenizes the raw bytes chunk by chunk as they are read from the
+# client. It keeps only the state it needs (the stack of open containers and
+# the rules that apply to the key of the value currently being read), so a hit
+# can be reported the moment a rule fires, e.g. on "is_malicious": true, without
+# reading or decoding the rest of the body. Because keys are checked as they are
+# tokenized, a duplicate key that json.loads would silently collapse is still caught.
+#
+# The scanners return the verdict as the Rule that fired (see rules.py), NO_MATCH,
+# or None while more input is needed. A body over one of the limits (see limits.py)
+# raises LimitExceeded as soon as the scanner reaches the point where it goes over.
+
+NO_MATCH = False  # the body can no longer produce a match (complete or invalid)
+MAX_PENDING = 1024 * 1024  # bytes of a body kept aside while the prefilter has not fired, see BodyScanner
+
+# container markers kept on the stack
+OBJECT = True
+ARRAY = False
+
+# tokenizer states (what the scanner expects to see next)
+EXPECT_VALUE = 0  # a value (top level, after ':' or after ',' in an array)
+EXPECT_VALUE_OR_CLOSE = 1  # a value or ']' (right after '[')
+EXPECT_KEY_OR_CLOSE = 2  # a key or '}' (right after '{')
+EXPECT_KEY = 3  # a key (after ',' in an object)
+EXPECT_COLON = 4  # ':' after a key
+EXPECT_COMMA_OR_CLOSE = 5  # ',' or the closing bracket of the current container
+EXPECT_END = 6  # only whitespace may follow the top level value
+IN_KEY = 7  # inside a key string
+IN_STRING = 8  # inside a string value
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+# longest run of valid string content (no quote, no raw control character, only legal escapes)
+_STRING_BODY = re.compile(rb'(?:[^"\\\x00-\x1f]+|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*')
+_NUMBER_PATTERN = rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+_NUMBER = re.compile(_NUMBER_PATTERN)
+_NUMBER_CHARS = re.compile(rb'[-+.0-9eE]*')
+# a run of array items that are scalars (strings without escapes), each followed by a comma.
+# Such items can never match, so the whole run is skipped with one call.
+_SCALAR_RUN_PATTERN = rb'(?:(?:%s|true|false|null|NaN|-?Infinity%s)[ \t\n\r]*,[ \t\n\r]*)+'
+# literals accepted by the stdlib json decoder and their values
+_LITERALS = ((b'true', True), (b'false', False), (b'null', None),
+             (b'NaN', float('nan')), (b'Infinity', float('inf')), (b'-Infinity', float('-inf')))
+_LONGEST_LITERAL = max(len(literal) for literal, _ in _LITERALS)
+_DELIMITERS = frozenset(b' \t\n\r,]}')  # bytes that may follow a number or literal
+_MAX_ESCAPE = 6  # length of the longest escape sequence, \uXXXX
+_QUOTED = re.compile(rb'"[^"\\\x00-\x1f]*"')  # a string without escapes, as found in scalar runs
+_UNLIMITED = float('inf')
+
+
+class StreamScanner:
+
+    # rules - the compiled RuleSet to check every key and value against
+    #         (and every string value against its signatures, if it has any)
+    # limits - the Limits on nesting depth, elements and string length (see limits.py)
+    def __init__(self, rules, limits=None):
+        self.rules = rules
+        self.signatures = rules.signatures
+        self.limits = limits or NO_LIMITS
+        self._max_depth = self.limits.max_depth or _UNLIMITED
+        self._max_elements = self.limits.max_elements or _UNLIMITED
+        self._max_string = self.limits.max_string or _UNLIMITED
+        # a literal is not held to the limit, the whole scalar is checked once it ends
+        self._max_partial = max(self._max_string, _LONGEST_LITERAL)
+        # string values are left to the string state when they are checked against signatures
+        self._scalar_run = _scalar_run(self.limits.max_string, self.signatures is None)
+        self._elements = 0  # array items and object members seen so far
+        self._string = 0  # length of the part of the current string (or partial scalar) before the buffer
+        self.finished = False  # set once further input cannot change the verdict
+        self.verdict = None
+        self._buf = b''
+        self._stack = []  # open containers, OBJECT or ARRAY
+        self._state = EXPECT_VALUE
+        self._parts = []  # raw bytes of the key (or inspected string value) being read
+        self._key = None  # the key of the value being read
+        self._key_rules = ()  # the rules that apply to that key
+        self._collect = False  # True while a string value is kept for the rules or signatures
+        self._partial = False  # True while _parts holds a number or literal that continues in the next chunk
+
+    # Feed the next chunk of the body.
+    # returns the Rule as soon as one fires, NO_MATCH once the body is known to be
+    # invalid JSON (invalid bodies are allowed), None if more input is needed
+    def feed(self, chunk):
+        if self.finished:
+            return self.verdict
+        if self._partial:
+            chunk = self._rest_of_scalar(chunk)
+            if chunk is None:
+                return None
+        self._buf = self._buf + chunk if self._buf else chunk
+        return self._scan(False)
+
+    # Signal the end of the body and return the final verdict.
+    def close(self):
+        if self._partial:
+            self._buf = b''.join(self._parts)
+            self._parts = []
+            self._partial = False
+        if not self.finished:
+            self._scan(True)
+        if not self.finished:  # body ended in the middle of a value
+            self._finish(NO_MATCH)
+        return self.verdict
+
+    def _finish(self, verdict):
+        self.finished = True
+        self.verdict = verdict
+        self._buf = b''
+        self._stack = []
+        self._parts = []
+        return verdict
+
+    # Tokenize as much of the buffer as possible.
+    # eof - True when no more input will arrive, so partial tokens are final
+    def _scan(self, eof):
+        buf = self._buf
+        end = len(buf)
+        pos = 0
+        state = self._state
+        stack = self._stack
+
+        while True:
+            if state == IN_STRING or state == IN_KEY:
+                stop = _STRING_BODY.match(buf, pos).end()
+                if self._string + stop - pos > self._max_string:
+                    raise self.limits.string_too_long()
+                if stop < end and buf[stop] == 0x22:  # closing quote
+                    if state == IN_KEY:
+                        self._parts.append(buf[pos:stop])
+                        key = _decode(b''.join(self._parts))
+                        self._parts = []
+                        if key is None:  # undecodable key
+                            return self._finish(NO_MATCH)
+                        self._key = key
+                        self._key_rules = self.rules.match_key(key)
+                        if self._key_rules:
+                            rule = self.rules.match(key, CONTAINER)  # rules without values fire on the key
+                            if rule is not None:
+                                return self._finish(rule)
+                        state = EXPECT_COLON
+                    else:
+                        if self._collect:
+                            self._parts.append(buf[pos:stop])
+                            value = _decode(b''.join(self._parts))
+                            self._parts = []
+                            self._collect = False
+                            if value is None:
+                                return self._finish(NO_MATCH)
+                            rule = None
+                            if self._key_rules and stack and stack[-1]:
+                                rule = self.rules.match(self._key, value)
+                            if rule is None and self.signatures is not None:
+                                rule = self.signatures.search(value)
+                            if rule is not None:
+                                return self._finish(rule)
+                        state = EXPECT_COMMA_OR_CLOSE if stack else EXPECT_END
+                    pos = stop + 1
+                    continue
+                if stop < end and (buf[stop] != 0x5c or end - stop >= _MAX_ESCAPE or eof):
+                    return self._finish(NO_MATCH)  # raw control character or bad escape
+                if eof:
+                    return self._finish(NO_MATCH)  # unterminated string
+                # the string continues in the next chunk, keep any partial escape
+                if state == IN_KEY or self._collect:
+                    self._parts.append(buf[pos:stop])
+                self._string += stop - pos
+                pos = stop
+                break
+
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == end:
+                break
+            char = buf[pos]
+
+            if state <= EXPECT_VALUE_OR_CLOSE and stack and not stack[-1]:
+                # inside an array, skip any run of scalar items at once
+                run = self._scalar_run.match(buf, pos)
+                if run is not None:
+                    if self._max_elements is not _UNLIMITED:
+                        self._count_run(buf, pos, run.end())
+                    pos = run.end()
+                    state = EXPECT_VALUE
+                    if pos == end:
+                        break
+                    char = buf[pos]
+
+            if state == EXPECT_COMMA_OR_CLOSE:
+                if char == 0x2c:  # ,
+                    state = EXPECT_KEY if stack[-1] else EXPECT_VALUE
+                    self._elements += 1
+                    if self._elements > self._max_elements:
+                        raise self.limits.too_many_elements()
+                elif (char == 0x7d and stack[-1]) or (char == 0x5d and not stack[-1]):  # } or ]
+                    if self._elements > self._max_elements:  # the first element of the container, see below
+                        raise self.limits.too_many_elements()
+                    stack.pop()
+                    state = EXPECT_COMMA_OR_CLOSE if stack else EXPECT_END
+                else:
+                    return self._finish(NO_MATCH)
+                pos += 1
+
+            elif state == EXPECT_COLON:
+                if char != 0x3a:  # :
+                    return self._finish(NO_MATCH)
+                state = EXPECT_VALUE
+                pos += 1
+
+            elif state == EXPECT_KEY or state == EXPECT_KEY_OR_CLOSE:
+                if char == 0x22:  # "
+                    state = IN_KEY
+                    self._string = 0
+                elif char == 0x7d and state == EXPECT_KEY_OR_CLOSE:  # } of an empty object
+                    stack.pop()
+                    self._elements -= 1
+                    state = EXPECT_COMMA_OR_CLOSE if stack else EXPECT_END
+                else:
+                    return self._finish(NO_MATCH)
+                pos += 1
+
+            elif state == EXPECT_END:
+                return self._finish(NO_MATCH)  # trailing data after the top level value
+
+            # remaining states expect a value
+            elif char == 0x7b or char == 0x5b:  # { or [
+                if len(stack) >= self._max_depth:
+                    raise self.limits.too_deep()
+                if self._elements > self._max_elements:
+                    raise self.limits.too_many_elements()
+                # the first element of the container, counted now and checked at the next container, comma or
+                # close; the others follow a comma. It is taken back if the container turns out to be empty.
+                self._elements += 1
+                if char == 0x7b:
+                    stack.append(OBJECT)
+                    state = EXPECT_KEY_OR_CLOSE
+                else:
+                    stack.append(ARRAY)
+                    state = EXPECT_VALUE_OR_CLOSE
+                pos += 1
+            elif char == 0x22:  # "
+                state = IN_STRING
+                self._string = 0
+                # keep the string only if there are signatures or it is the value of a key some rule applies to
+                self._collect = self.signatures is not None or bool(self._key_rules and stack and stack[-1])
+                pos += 1
+            elif char == 0x5d and state == EXPECT_VALUE_OR_CLOSE:  # ] of an empty array
+                stack.pop()
+                self._elements -= 1
+                state = EXPECT_COMMA_OR_CLOSE if stack else EXPECT_END
+                pos += 1
+            else:
+                token, stop = self._scalar(buf, pos, eof)
+                if stop is None:
+                    # the scalar continues in the next chunk, keep it aside rather than scan it again with every chunk
+                    self._string = end - pos
+                    if self._string > self._max_partial:
+                        raise self.limits.number_too_long()
+                    self._parts.append(buf[pos:])
+                    self._partial = True
+                    pos = end
+                    break
+                if token is None:
+                    return self._finish(NO_MATCH)
+                if stop - pos > self._max_string and token not in _LITERAL_VALUES:
+                    raise self.limits.number_too_long()
+                if self._key_rules and stack and stack[-1]:
+                    try:
+                        value = _LITERAL_VALUES[token] if token in _LITERAL_VALUES else _number(token)
+                    except ValueError:  # e.g. an integer too long to convert
+                        return self._finish(NO_MATCH)
+                    rule = self.rules.match(self._key, value)
+                    if rule is not None:
+                        return self._finish(rule)
+                state = EXPECT_COMMA_OR_CLOSE if stack else EXPECT_END
+                pos = stop
+
+        self._buf = buf[pos:]
+        self._state = state
+        if eof and state == EXPECT_END:
+            return self._finish(NO_MATCH)
+        return None
+
+    # Count the elements of a run of scalar items between start and stop, one per comma
+    # that is not inside one of its strings.
+    def _count_run(self, buf, start, stop):
+        count = buf.count(b',', start, stop)
+        if buf.find(b'"', start, stop) >= 0:
+            count -= b''.join(_QUOTED.findall(buf, start, stop)).count(b',')
+        self._elements += count
+        if self._elements > self._max_elements:
+            raise self.limits.too_many_elements()
+
+    # Add a chunk to the number or literal kept aside in _parts.
+    # returns the whole scalar and the rest of the chunk to scan once the scalar ends in it, None if it continues
+    def _rest_of_scalar(self, chunk):
+        stop = _NUMBER_CHARS.match(chunk).end()
+        self._string += stop
+        if self._string > self._max_partial:
+            raise self.limits.number_too_long()
+        self._parts.append(chunk)
+        if stop == len(chunk):
+            return None
+        chunk = b''.join(self._parts)
+        self._parts = []
+        self._partial = False
+        return chunk
+
+    # Read a number or literal starting at pos.
+    # returns (token, end) - token is the raw bytes of the scalar or None if it is invalid,
+    # end is None when the token may continue in the next chunk
+    def _scalar(self, buf, pos, eof):
+        size = len(buf)
+        for literal, _ in _LITERALS:
+            if buf.startswith(literal, pos):
+                stop = pos + len(literal)
+                break
+            if not eof and literal.startswith(buf[pos:pos + len(literal)]):
+                return None, None  # partial literal at the end of the buffer
+        else:
+            if not eof and _NUMBER_CHARS.match(buf, pos).end() == size:
+                return None, None  # the number may continue in the next chunk
+            match = _NUMBER.match(buf, pos)
+            if match is None:
+                return None, size
+            stop = match.end()
+        if stop == size:
+            if not eof:
+                return None, None  # the token may continue in the next chunk
+        elif buf[stop] not in _DELIMITERS:
+            return None, size  # e.g. "truex" or "01"
+        return buf[pos:stop], stop
+
+
+_LITERAL_VALUES = dict(_LITERALS)
+
+
+# The pattern of a run of scalar array items for the length limit of strings and numbers.
+# max_string - strings and numbers in the run are at most max_string bytes long (None for any length),
+#              longer ones are left to the scanner, which stops them
+# strings - False to leave strings out of the run
+@functools.lru_cache(maxsize=None)
+def _scalar_run(max_string, strings=True):
+    number = _NUMBER_PATTERN
+    string = rb'|"[^"\\\x00-\x1f]*"'
+    if max_string is not None:
+        number = rb'(?![-+.0-9eE]{%d})' % (max_string + 1) + number
+        string = rb'|"[^"\\\x00-\x1f]{0,%d}"' % max_string
+    return re.compile(_SCALAR_RUN_PATTERN % (number, string if strings else b''))
+
+
+# value of a JSON number token, like the stdlib json decoder
+def _number(token):
+    if b'.' in token or b'e' in token or b'E' in token:
+        return float(token)
+    return int(token)
+
+
+# Decode the raw (still escaped) content of a JSON string.
+# returns None if it is not valid JSON string content
+def _decode(raw):
+    try:
+        if b'\\' not in raw:
+            return raw.decode('utf-8')
+        return json.loads(b'"' + raw + b'"')
+    except ValueError:
+        return None
+
+
+# A byte level prefilter that decides whether a body could contain a key some rule applies to.
+#
+# A key can only appear in a body as a quoted JSON string, where every character is
+# either written literally or as a \uXXXX escape. The prefilter looks for the quoted
+# literal spelling of every exact key (and the opening quote and spelling of every prefix)
+# with plain substring searches and, only if the body contains a \u escape, for every other
+# legal spelling with a single regular expression. When none is found the body cannot
+# match and it does not have to be parsed at all.
+class KeyPrefilter:
+
+    # rules - the compiled RuleSet whose keys and prefixes are looked for
+    def __init__(self, rules):
+        needles = rules.needles()
+        self.literals = [b'"' + text.encode('utf-8') + (b'' if is_prefix else b'"') for text, is_prefix in needles]
+        self.pattern = re.compile(b'|'.join(
+            b'"' + b''.join(_spellings(char) for char in text) + (b'' if is_prefix else b'"')
+            for text, is_prefix in needles
+        )) if needles else None
+        # False if a key has a character with a two character escape (\" \\ \/ or a control character),
+        # whose spellings with that escape are not looked for
+        self.complete = not any(char in '"\\/' or char < ' ' for text, _ in needles for char in text)
+        # longest spelling minus one, kept between chunks so a key split across chunks is found
+        self._overlap = max([2 + 12 * len(text) - 1 for text, _ in needles] or [0])
+        self._tail = b''
+        self.found = False
+
+    # Feed the next chunk of the body, returns True once a key may be present.
+    def feed(self, chunk):
+        if self.found:
+            return True
+        if self.pattern is None:  # no rules, nothing can match
+            return False
+        data = self._tail + chunk if self._tail else chunk
+        for literal in self.literals:
+            if literal in data:
+                self.found = True
+                break
+        else:
+            self.found = b'\\u' in data and self.pattern.search(data) is not None
+        if self.found:
+            self._tail = b''
+            return True
+        self._tail = data[-self._overlap:]
+        return False
+
+
+# regular expression (bytes) matching every JSON spelling of a single character
+def _spellings(char):
+    code = ord(char)
+    if code > 0xFFFF:  # escaped as a surrogate pair
+        code -= 0x10000
+        escaped = _escaped(0xD800 + (code >> 10)) + _escaped(0xDC00 + (code & 0x3FF))
+    else:
+        escaped = _escaped(code)
+    return b'(?:' + re.escape(char.encode('utf-8')) + b'|' + escaped + b')'
+
+
+# regular expression (bytes) matching \uXXXX for a code unit, with hex digits in either case
+def _escaped(code):
+    return b'\\\\u' + b''.join(
+        b'[' + digit.lower().encode() + digit.upper().encode() + b']' if digit.isalpha() else digit.encode()
+        for digit in '%04x' % code
+    )
+
+
+# The scanning pipeline for one request body: the prefilter followed by the stream scanner.
+#
+# Chunks are kept aside until the prefilter finds a possible spelling of a key some rule
+# applies to, so a body that never contains one is not tokenized at all. Once the prefilter
+# fires, the kept chunks and every following chunk are fed to the StreamScanner. At most
+# MAX_PENDING bytes are kept aside: a streamed body that goes on past them without a key is
+# tokenized from the next chunk on, so it is never held whole (a body fed in a single chunk,
+# which the caller holds anyway, is still only prefiltered). When the rules have value
+# signatures every string has to be checked, so the prefilter is skipped.
+# The same feed/close interface as StreamScanner is used, so any server can push chunks as
+# they arrive. The bytes of the body are counted against the size limit as they are fed.
+#
+# JSON may be sent in UTF-16 or UTF-32 or start with a byte order mark, which json.loads
+# accepts. The encoding is detected from the first four bytes the way json.detect_encoding
+# does it, a UTF-8 byte order mark is dropped and a body in any other encoding is transcoded
+# to UTF-8 chunk by chunk before it reaches the prefilter. A body that is not valid in its
+# encoding is no JSON and gets NO_MATCH.
+class BodyScanner:
+
+    # rules - the compiled RuleSet to check the body against
+    # limits - the Limits of the body (see limits.py)
+    def __init__(self, rules, limits=None):
+        self.rules = rules
+        self.limits = limits or NO_LIMITS
+        self.prefilter = KeyPrefilter(rules)
+        self.scanner = None  # created once the prefilter fires
+        self.size = 0  # bytes fed so far
+        self._pending = []  # chunks seen before the prefilter fired
+        self._held = 0  # bytes of the chunks in _pending
+        self._head = b''  # first bytes of the body while its encoding is not known, None once it is
+        self._decoder = None  # incremental decoder of a body that is not UTF-8
+        self._invalid = False  # True once the body was not valid in its encoding
+        if rules.signatures is not None:
+            self.scanner = StreamScanner(rules, limits)
+
+    # Feed the next chunk of the body.
+    # returns the Rule that fired or NO_MATCH once the verdict is known, None if more input is needed
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.limits.max_bytes is not None and self.size > self.limits.max_bytes:
+            raise self.limits.too_large()
+        chunk = self._utf8(chunk)
+        if chunk is None:
+            return NO_MATCH
+        return self._scan(chunk)
+
+    # Signal the end of the body and return the final verdict.
+    def close(self):
+        chunk = self._utf8(b'', True)
+        if chunk is None:
+            return NO_MATCH
+        if chunk:
+            verdict = self._scan(chunk)
+            if verdict is not None:
+                return verdict
+        if self.scanner is None:  # no key of the rules can be in the body
+            self._pending = None
+            return NO_MATCH
+        return self.scanner.close()
+
+    # the next chunk of the body in UTF-8, None if it is not valid in the encoding of the body
+    def _utf8(self, chunk, final=False):
+        if self._head is not None:
+            chunk = self._head + chunk if self._head else chunk
+            if len(chunk) < 4 and not final:
+                self._head = chunk
+                return b''
+            self._head = None
+            encoding = json.detect_encoding(chunk[:4])
+            if encoding == 'utf-8':
+                return chunk
+            if encoding == 'utf-8-sig':
+                return chunk[len(codecs.BOM_UTF8):]
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+        if self._decoder is None:
+            return chunk
+        if self._invalid:
+            return None
+        try:
+            return self._decoder.decode(chunk, final).encode('utf-8')
+        except UnicodeError:
+            self._invalid = True
+            return None
+
+    # feed a chunk of the body in UTF-8 to the prefilter and the scanner
+    def _scan(self, chunk):
+        if self.scanner is not None:
+            return self.scanner.feed(chunk)
+        self._pending.append(chunk)
+        if self._held >= MAX_PENDING:  # tokenize the body rather than keep more of it aside
+            return self._tokenize()
+        self._held += len(chunk)
+        if not self.prefilter.feed(chunk):
+            return None
+        return self._tokenize()
+
+    # start the StreamScanner with the chunks kept aside
+    def _tokenize(self):
+        self.scanner = StreamScanner(self.rules, self.limits)
+        pending, self._pending = self._pending, None
+        for chunk in pending:
+            verdict = self.scanner.feed(chunk)
+            if verdict is not None:
+                return verdict
+        return None
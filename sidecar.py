@@ -0,0 +1,170 @@
+import io
+import os
+import socketserver
+import stat
+import struct
+import sys
+import time
+
+from limits import LimitExceeded
+
+
+# A verdict sidecar on a Unix domain socket.
+#
+# An edge proxy that asks the firewall for a verdict over HTTP on loopback pays for HTTP parsing,
+# routing and a JSON response on every request, for an answer that fits in a few bytes. The sidecar
+# listens on a Unix domain socket instead and speaks a length-prefixed binary protocol: each request
+# is a frame holding the body and the few headers the scan depends on, and each response is a fixed
+# six byte frame with the status code of the verdict and the number of the rule that fired. Bodies go
+# through the same scan function as handleRequest (scan_request in app.py), so the verdicts, limits,
+# cache and scanner pool are the ones of the HTTP endpoint.
+#
+# Request frame, integers big-endian:
+#   REQUEST header: body length (4 bytes), Content-Type length, Content-Encoding length and query
+#                   string length (2 bytes each)
+#   then the Content-Type, the Content-Encoding and the query string (latin-1), then the body
+# An empty Content-Type stands for application/json and an empty Content-Encoding for none.
+#
+# Response frame:
+#   RESPONSE: status code (2 bytes) - 200, the status of the rule that fired (403 by default), the
+#                                     status of a limit (413, 400) or 503 when the scanner pool is busy
+#             rule number (4 bytes) - the number of the rule or signature that fired (its position in
+#                                     the rules, see rules.py), 0 for none
+#
+# A client may send any number of requests on a connection without waiting for the responses
+# (pipelining); the responses come back in the order of the requests, the ones whose frames arrived
+# together in a single write. The body of a request over the size limit is discarded as it arrives
+# and answered with 413, without being buffered. Run it next to the HTTP server with:
+#   WAF_SIDECAR_SOCKET=/run/http-waf.sock python3 sidecar.py
+
+REQUEST = struct.Struct(">IHHH")
+RESPONSE = struct.Struct(">HI")
+RECEIVE_SIZE = 256 * 1024  # bytes received from a connection at a time
+DEFAULT_CONTENT_TYPE = "application/json"
+SOCKET_PATH = os.getenv("WAF_SIDECAR_SOCKET", default="/tmp/http-waf.sock")
+
+
+class SidecarServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # path - the path of the Unix domain socket, a stale socket file left there is replaced
+    # scan - function (stream, length, content encoding, content type, query string) returning the verdict
+    #        of a request, see scan_request in app.py
+    # limits - the Limits of the requests, a body over the size limit is not received (see limits.py)
+    # busy - exception type raised by scan when the scan cannot be run right now (503), or None
+    # metrics - Metrics every verdict is recorded in (see metrics.py), or None
+    def __init__(self, path, scan, limits=None, busy=None, metrics=None):
+        self.scan = scan
+        self.max_bytes = limits.max_bytes if limits is not None else None
+        self.too_large = RESPONSE.pack(413, 0) if self.max_bytes is not None else None
+        self.busy_error = busy or ()
+        self.metrics = metrics
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)  # the socket of a previous run
+        super().__init__(path, SidecarHandler)
+
+    # The response frame of a request.
+    def verdict(self, body, content_type, encoding, query):
+        start = time.perf_counter()
+        rule = None
+        try:
+            rule = self.scan(io.BytesIO(body), len(body), encoding or None, content_type or DEFAULT_CONTENT_TYPE, query)
+        except self.busy_error:
+            code = 503
+        except LimitExceeded as error:
+            code = error.status
+        else:
+            code = rule.status if rule else 200
+        if self.metrics is not None:
+            self.metrics.record(code, rule, len(body), time.perf_counter() - start)
+        return RESPONSE.pack(code, rule.number if rule else 0)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+# Reads the request frames of a connection and writes back their responses, in order.
+class SidecarHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        connection = self.request
+        buffer = bytearray()
+        discard = 0  # bytes still to drop of the body of a request over the size limit
+        while True:
+            data = connection.recv(RECEIVE_SIZE)
+            if not data:
+                return
+            buffer += data
+            responses = []
+            position = 0
+            while True:
+                if discard:
+                    dropped = min(discard, len(buffer) - position)
+                    position += dropped
+                    discard -= dropped
+                    if discard:
+                        break
+                if len(buffer) - position < REQUEST.size:
+                    break
+                length, type_length, encoding_length, query_length = REQUEST.unpack_from(buffer, position)
+                start = position + REQUEST.size
+                body_start = start + type_length + encoding_length + query_length
+                if len(buffer) < body_start:
+                    break
+                if server.max_bytes is not None and length > server.max_bytes:
+                    responses.append(server.too_large)
+                    if server.metrics is not None:
+                        server.metrics.record(413, None, length, 0)
+                    position = body_start
+                    discard = length
+                    continue
+                end = body_start + length
+                if len(buffer) < end:
+                    break
+                fields = buffer[start:body_start].decode("latin-1")
+                content_type = fields[:type_length]
+                encoding = fields[type_length:type_length + encoding_length]
+                query = fields[type_length + encoding_length:]
+                responses.append(server.verdict(bytes(buffer[body_start:end]), content_type, encoding, query))
+                position = end
+            del buffer[:position]
+            if responses:
+                connection.sendall(b"".join(responses))
+
+
+# Encode a request frame, e.g. for a client of the sidecar.
+# input: body - the raw body bytes
+#        content_type, encoding, query - the Content-Type, Content-Encoding and query string, "" if not sent
+# output: the frame bytes
+def encode_request(body, content_type="", encoding="", query=""):
+    fields = [field.encode("latin-1") if isinstance(field, str) else field for field in (content_type, encoding, query)]
+    return REQUEST.pack(len(body), *map(len, fields)) + b"".join(fields) + body
+
+
+# Decode a response frame.
+# output: (status code, rule number)
+def decode_response(frame):
+    return RESPONSE.unpack(frame)
+
+
+# Serve the rules, limits, scanner pool and metrics of app.py on SOCKET_PATH.
+def main(path=SOCKET_PATH):
+    import app  # loads the rules and the configuration of the HTTP server
+    from pool import PoolSaturated
+    server = SidecarServer(path, app.scan_request, limits=app.LIMITS, busy=PoolSaturated, metrics=app.METRICS)
+    print("http-waf: sidecar listening on %s" % path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH)
@@ -0,0 +1,176 @@
+import json
+import re
+
+
+# Value signatures: patterns that must not appear in any string value of a body.
+#
+# Key rules (rules.py) only look at keys, while attack payloads such as SQL fragments,
+# script tags or path traversal live in the string values. A signature is either a
+# literal (optionally case insensitive) or a regular expression, with its own status code
+# and message. Signatures are listed next to the rules in the rule file:
+# {
+#     "rules": [...],
+#     "signatures": [
+#         {"id": "sqli-union", "literal": "union select", "ignore_case": true, "message": "SQL injection"},
+#         {"id": "path-traversal", "regex": "(?:\\.\\./){2,}", "message": "path traversal"}
+#     ]
+# }
+#
+# All signatures are compiled into one regular expression so each string is searched once
+# however many signatures there are. The literals are merged into a trie shaped pattern
+# (e.g. "union select" and "union all" become union\ (?:all|select)), so the regex engine
+# follows a single path per position instead of trying every literal in turn, and the
+# regular expression signatures are added as alternatives of the same pattern.
+
+# prefix of the names of the groups of the combined pattern, which no signature regex may use (see _mergeable)
+GROUP_PREFIX = "_sig_"
+LITERAL_GROUP = GROUP_PREFIX + "literal"
+LITERAL_IGNORE_CASE_GROUP = GROUP_PREFIX + "literal_i"
+
+
+class Signature:
+
+    # number - position of the signature, numbered after the rules of the rule set
+    # signature_id - name of the signature reported in responses
+    # literal - text the signature looks for (or None)
+    # regex - regular expression the signature looks for (or None)
+    # ignore_case - True to match the literal or regex in any case
+    # status - HTTP status code of the response when the signature fires
+    # message - message of the response when the signature fires
+    def __init__(self, number, signature_id, literal=None, regex=None, ignore_case=False, status=403, message=""):
+        self.number = number
+        self.id = signature_id
+        self.literal = literal
+        self.regex = regex
+        self.ignore_case = ignore_case
+        self.status = status
+        self.message = message
+        self.response = {"status": "error", "code": status, "message": message, "signature": signature_id}
+        self.body = json.dumps(self.response).encode("utf-8") + b"\n"  # pre-encoded response
+        if regex is not None:
+            self.pattern = re.compile(regex, re.IGNORECASE if ignore_case else 0)
+        else:
+            self.pattern = re.compile(re.escape(literal), re.IGNORECASE if ignore_case else 0)
+
+    def __repr__(self):
+        return "<Signature %d %s>" % (self.number, self.id)
+
+
+class SignatureSet:
+
+    # signatures - list of Signature
+    def __init__(self, signatures):
+        self.signatures = list(signatures)
+        self.literals = {}  # case sensitive literal -> Signature
+        self.literals_ignore_case = {}  # lower case literal -> Signature
+        self.regexes = {}  # group name -> Signature
+        self.separate = []  # regexes that cannot be merged (e.g. they use backreferences or named groups)
+        branches = []
+        for signature in self.signatures:
+            if signature.literal is not None:
+                table = self.literals_ignore_case if signature.ignore_case else self.literals
+                table.setdefault(signature.literal.lower() if signature.ignore_case else signature.literal, signature)
+            elif _mergeable(signature):
+                name = "%sr%d" % (GROUP_PREFIX, len(self.regexes))
+                self.regexes[name] = signature
+                flags = "(?i:%s)" if signature.ignore_case else "(?:%s)"
+                branches.append("(?P<%s>%s)" % (name, flags % signature.regex))
+            else:
+                self.separate.append(signature)
+        if self.literals:
+            branches.insert(0, "(?P<%s>%s)" % (LITERAL_GROUP, _trie_pattern(self.literals)))
+        if self.literals_ignore_case:
+            branches.insert(0, "(?P<%s>(?i:%s))" % (LITERAL_IGNORE_CASE_GROUP, _trie_pattern(self.literals_ignore_case)))
+        self.pattern = re.compile("|".join(branches)) if branches else None
+
+    # Search a string value for the signatures.
+    # output: the Signature found first in the string, or None
+    def search(self, text):
+        if self.pattern is not None:
+            match = self.pattern.search(text)
+            if match is not None:
+                group = match.lastgroup
+                if group == LITERAL_GROUP:
+                    return self.literals[match.group()]
+                if group == LITERAL_IGNORE_CASE_GROUP:
+                    found = match.group()
+                    signature = self.literals_ignore_case.get(found.lower())
+                    if signature is not None:
+                        return signature
+                    # unicode case folding that lower() does not reproduce
+                    for signature in self.literals_ignore_case.values():
+                        if signature.pattern.fullmatch(found):
+                            return signature
+                return self.regexes[group]
+        for signature in self.separate:
+            if signature.pattern.search(text):
+                return signature
+        return None
+
+    def __len__(self):
+        return len(self.signatures)
+
+
+# True if a regex can be merged into the combined pattern. Group numbers shift once the
+# pattern is wrapped in a named group, so regexes with numbered backreferences stay separate,
+# and so do regexes with named groups, whose names could clash with another regex of the pattern.
+def _mergeable(signature):
+    if signature.pattern.groupindex:
+        return False
+    if signature.pattern.groups and re.search(r"\\[1-9]", signature.regex):
+        return False
+    try:
+        re.compile("(?P<x>(?:%s))|y" % signature.regex)
+    except re.error:  # e.g. global flags that are only allowed at the start of a pattern
+        return False
+    return True
+
+
+# Build a regular expression matching any of the words, factored as a trie.
+def _trie_pattern(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}  # end of a word
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    pattern = "(?:%s)" % "|".join(branches)
+    return pattern + "?" if "" in node else pattern
+
+
+# Build a SignatureSet from the "signatures" entries of a rule file.
+# first_number - number of the first signature (signatures are numbered after the rules)
+# errors are raised as error_type (RuleError when called from rules.py)
+def compile_signatures(entries, first_number=1, error_type=ValueError):
+    if not isinstance(entries, list):
+        raise error_type("expected a list of signatures")
+    signatures = []
+    for number, entry in enumerate(entries, first_number):
+        if not isinstance(entry, dict):
+            raise error_type("signature %d is not an object" % number)
+        literal = entry.get("literal")
+        regex = entry.get("regex")
+        if (literal is None) == (regex is None):
+            raise error_type("signature %d needs exactly one of literal or regex" % number)
+        if not isinstance(literal if literal is not None else regex, str) or literal == "" or regex == "":
+            raise error_type("signature %d literal or regex must be a non-empty string" % number)
+        status = entry.get("status", 403)
+        if not isinstance(status, int) or not 400 <= status <= 599:
+            raise error_type("signature %d status must be an HTTP error code" % number)
+        signature_id = str(entry.get("id", number))
+        try:
+            signatures.append(Signature(number, signature_id, literal=literal, regex=regex,
+                                        ignore_case=bool(entry.get("ignore_case", False)),
+                                        status=status, message=str(entry.get("message", ""))))
+        except re.error as e:
+            raise error_type("signature %d (%s) regex is invalid: %s" % (number, signature_id, e))
+    return SignatureSet(signatures)
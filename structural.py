@@ -0,0 +1,299 @@
+import functools
+import json
+import re
+
+try:
+    import numpy
+except ImportError:  # optional, large bodies are then tokenized by the StreamScanner
+    numpy = None
+
+from limits import NO_LIMITS
+from rules import CONTAINER
+from scanner import KeyPrefilter, StreamScanner, NO_MATCH
+
+
+# A vectorized structural index of large JSON bodies.
+#
+# However it is written, a tokenizer in Python runs at tens of MB/s, which is what every byte of
+# a multi-megabyte body that holds a key of the rules costs the StreamScanner (see scanner.py). The
+# index instead loads the raw body into a NumPy byte array, BLOCK_SIZE bytes at a time, and finds the
+# quotes, backslashes and structural characters with vectorized comparisons: quotes preceded by an
+# odd run of backslashes are escaped, the others toggle a mask of string interiors, and the brackets
+# and commas outside strings give the nesting depth, an upper bound of the elements and the length of
+# every string, and runs of the bytes of numbers bound the length of every number, so the limits (see
+# limits.py) are checked without tokenizing. The spellings of the keys of the rules are located like in
+# the prefilter (see KeyPrefilter), and only the ones that open a string in key position (after a { or
+# a ,) are decoded, together with their values.
+#
+# The index gives the verdict of the StreamScanner, which stops at the first hit or error. Up to the
+# first error of a body both see the same strings and structure, so:
+#   - when no candidate key fires and the body is within every limit, the scanner finds no pair
+#     either and the verdict is NO_MATCH, whether or not the body turns out to be invalid later
+#   - when a candidate fires, the body is tokenized up to the end of its value to confirm it (the
+#     scanner may stop at an error first) and on to the end if the scanner does not confirm it
+#   - a body that may go over a limit or is not in UTF-8, and every body of rules with signatures, is tokenized
+# scan_indexed returns None in the last case, so the body goes through the BodyScanner instead.
+
+BLOCK_SIZE = 1024 * 1024  # bytes indexed at a time, bounds the memory of the index arrays
+QUOTE, BACKSLASH, COMMA = 0x22, 0x5c, 0x2c
+OPENS = (0x5b, 0x7b)  # [ {
+CLOSES = (0x5d, 0x7d)  # ] }
+# lookup table of the bytes that are JSON whitespace
+_WHITESPACE_BYTES = numpy.isin(numpy.arange(256), list(b' \t\n\r')) if numpy is not None else None
+# lookup table of the bytes a number is written with
+_NUMBER_BYTES = numpy.isin(numpy.arange(256), list(b'-+.0123456789eE')) if numpy is not None else None
+# a key, its raw content and the raw text of its value if it is a string, number or literal
+_PAIR = re.compile(rb'"((?:[^"\\]+|\\.)*)"[ \t\n\r]*(?::[ \t\n\r]*("(?:[^"\\]+|\\.)*"|[^,\]}{\[ \t\n\r"]*))?', re.S)
+_LITERALS = {b'true': True, b'false': False, b'null': None}
+KEY, VALUE = "key", "value"  # what of a pair fires a rule
+
+
+# True if the structural index can be used (NumPy is installed).
+def available():
+    return numpy is not None
+
+
+# Scan a complete JSON body with the structural index.
+# input: body - the raw body bytes
+#        rules - the RuleSet to check the body against
+#        limits - the Limits of the body (see limits.py)
+# output: the Rule that fired or NO_MATCH, None if the body must be scanned by the BodyScanner instead
+# raises LimitExceeded if the body confirming a hit goes over a limit first
+def scan_indexed(body, rules, limits=None):
+    limits = limits or NO_LIMITS
+    if numpy is None or rules.signatures is not None:
+        return None
+    if limits.max_bytes is not None and len(body) > limits.max_bytes:
+        return None
+    if json.detect_encoding(body[:4]) != "utf-8":  # transcoded by the BodyScanner
+        return None
+    prefilter = _prefilter(rules)
+    if not prefilter.complete:  # some spellings of the keys would not be candidates
+        return None
+    candidates = _candidates(body, prefilter)
+    if not candidates:  # no key of the rules can be in the body, like in the BodyScanner
+        return NO_MATCH
+    keys = _index(body, candidates, limits)
+    if keys is None:  # may go over a limit
+        return None
+    verdicts = {}
+    for position in keys:
+        end = _fires(body, position, rules, verdicts)
+        if end is not None:
+            return _confirm(body, end, rules, limits)
+    return NO_MATCH
+
+
+@functools.lru_cache(maxsize=16)
+def _prefilter(rules):
+    return KeyPrefilter(rules)
+
+
+# Positions of the opening quotes of every spelling of the keys of the rules, in body order.
+def _candidates(body, prefilter):
+    if prefilter.pattern is None:
+        return []
+    if b'\\u' in body:
+        return [match.start() for match in prefilter.pattern.finditer(body)]
+    positions = set()
+    for literal in prefilter.literals:
+        position = body.find(literal)
+        while position >= 0:
+            positions.add(position)
+            position = body.find(literal, position + 1)
+    return sorted(positions)
+
+
+# Index the body block by block.
+# input: body - the raw body bytes
+#        candidates - sorted positions of quotes that may open a key
+#        limits - the Limits of the body
+# output: the candidates that open a string in key position, None if the body may go over a limit
+def _index(body, candidates, limits):
+    data = numpy.frombuffer(body, dtype=numpy.uint8)
+    size = len(data)
+    max_depth = limits.max_depth
+    max_elements = limits.max_elements
+    max_string = limits.max_string
+    numbers = max_string is not None and size > max_string  # a number may be longer than max_string
+    depth = 0  # nesting depth at the end of the previous block
+    elements = 0  # commas and opening brackets outside strings so far, at least the elements of the body
+    backslashes = 0  # length of the run of backslashes that ends the previous block
+    number_run = 0  # length of the run of number bytes that ends the previous block
+    string_start = None  # opening quote of the string the previous block ends in
+    last_significant = -1  # the last byte of the previous blocks that is not whitespace, -1 for none
+    keys = []
+    candidates = numpy.array(candidates, dtype=numpy.int64)
+
+    for start in range(0, size, BLOCK_SIZE):
+        block = data[start:start + BLOCK_SIZE]
+        quotes = numpy.flatnonzero(block == QUOTE)
+        if len(quotes):
+            quotes = quotes[~_escaped(block, quotes, backslashes)]
+        backslashes = _trailing_backslashes(block, backslashes)
+
+        # string interiors: every unescaped quote toggles the mask, opening quotes included
+        toggles = numpy.zeros(len(block), dtype=numpy.uint8)
+        toggles[quotes] = 1
+        inside = numpy.bitwise_xor.accumulate(toggles)
+        if string_start is not None:
+            inside ^= 1
+        outside = inside == 0
+
+        opens = ((block == OPENS[0]) | (block == OPENS[1])) & outside
+        closes = ((block == CLOSES[0]) | (block == CLOSES[1])) & outside
+        if max_depth is not None:
+            levels = numpy.cumsum(opens.view(numpy.int8) - closes.view(numpy.int8), dtype=numpy.int64)
+            if len(levels) and depth + int(levels.max()) > max_depth:
+                return None
+            depth += int(levels[-1]) if len(levels) else 0
+        if max_elements is not None:
+            elements += int(numpy.count_nonzero(opens)) + int(numpy.count_nonzero((block == COMMA) & outside))
+            if elements > max_elements:
+                return None
+
+        # the quotes alternate between opening and closing a string
+        positions = quotes + start
+        if string_start is not None:
+            positions = numpy.concatenate(([string_start], positions))
+        pairs = len(positions) // 2 * 2
+        if max_string is not None and pairs:
+            lengths = positions[1:pairs:2] - positions[0:pairs:2] - 1
+            if int(lengths.max()) > max_string:
+                return None
+        string_start = int(positions[-1]) if len(positions) % 2 else None
+        if numbers:
+            number_run = _number_run(block, number_run, max_string)
+            if number_run is None:
+                return None
+
+        # candidates that open a string (an unescaped quote outside a string before it) after a { or a ,
+        significant = numpy.flatnonzero(~_WHITESPACE_BYTES[block])
+        first, last = numpy.searchsorted(candidates, (start, start + len(block)))
+        if first < last:
+            local = candidates[first:last] - start
+            before = numpy.searchsorted(significant, local) - 1
+            previous = numpy.where(before >= 0, block[significant[before]], last_significant)
+            opening = (toggles[local] == 1) & (inside[local] == 1) & ((previous == 0x7b) | (previous == COMMA))
+            keys.extend((local[opening] + start).tolist())
+        if len(significant):
+            last_significant = int(block[significant[-1]])
+
+    if string_start is not None and max_string is not None and size - string_start - 1 > max_string:
+        return None  # unterminated string
+    return keys
+
+
+# Mask of the quotes of a block that are escaped, i.e. preceded by an odd run of backslashes.
+# backslashes - length of the run of backslashes that ends the previous block
+def _escaped(block, quotes, backslashes):
+    previous = quotes - 1
+    preceded = numpy.zeros(len(quotes), dtype=bool)
+    inner = previous >= 0
+    preceded[inner] = block[previous[inner]] == BACKSLASH
+    if quotes[0] == 0:
+        preceded[0] = backslashes > 0
+    if not preceded.any():
+        return preceded
+    runs = numpy.zeros(len(quotes), dtype=numpy.int64)
+    slashes = numpy.flatnonzero(block == BACKSLASH)
+    if len(slashes):
+        # index in slashes of the first backslash of the run of each backslash
+        first = numpy.zeros(len(slashes), dtype=numpy.int64)
+        breaks = numpy.flatnonzero(numpy.diff(slashes) != 1) + 1
+        first[breaks] = breaks
+        first = numpy.maximum.accumulate(first)
+        ends = previous[preceded & inner]
+        run_starts = slashes[first[numpy.searchsorted(slashes, ends)]]
+        runs[preceded & inner] = ends - run_starts + 1 + numpy.where(run_starts == 0, backslashes, 0)
+    if quotes[0] == 0:
+        runs[0] = backslashes
+    return preceded & (runs % 2 == 1)
+
+
+# length of the run of backslashes that ends a block, following the run that ended the previous one
+def _trailing_backslashes(block, backslashes):
+    if not len(block) or block[-1] != BACKSLASH:
+        return 0
+    others = numpy.flatnonzero(block != BACKSLASH)
+    if not len(others):
+        return backslashes + len(block)
+    return len(block) - 1 - int(others[-1])
+
+
+# length of the run of number bytes that ends a block, following the run that ended the previous one, or
+# None if the block has a run longer than max_string (inside a string too, where it is only a may)
+def _number_run(block, run, max_string):
+    mask = _NUMBER_BYTES[block]
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(mask[1:] != mask[:-1]) + 1, [len(block)]))
+    lengths = numpy.diff(bounds)[0 if mask[0] else 1::2]  # the runs of number bytes
+    if not len(lengths):
+        return 0
+    if mask[0]:
+        lengths[0] += run
+    if int(lengths.max()) > max_string:
+        return None
+    return int(lengths[-1]) if mask[-1] else 0
+
+
+# Read the key that starts at a candidate position and its value, and check them against the rules.
+# verdicts - the outcome of every (key, value) pair checked so far, as they spell in the body
+# output: the end of the pair (the position after the key or value that fired), None if no rule fires
+def _fires(body, position, rules, verdicts):
+    pair = _PAIR.match(body, position)
+    if pair is None:
+        return None
+    raw = pair.group(1, 2)
+    fired = verdicts.get(raw)
+    if fired is None:
+        fired = verdicts[raw] = _check(raw[0], raw[1] or None, rules)
+    if fired is KEY:
+        return pair.end(1) + 1
+    return pair.end() if fired is VALUE else None
+
+
+# what of a pair fires: KEY, VALUE or False for nothing
+# input: raw_key - the raw content of the key
+#        raw_value - the raw text of a scalar value, None if the value is not one
+def _check(raw_key, raw_value, rules):
+    key = _decode(raw_key)
+    if key is None:
+        return False
+    if rules.match(key, CONTAINER) is not None:  # rules without values fire on the key
+        return KEY
+    if raw_value is None or not rules.match_key(key):
+        return False
+    if raw_value[:1] == b'"':
+        value = _decode(raw_value[1:-1])
+        if value is None:
+            return False
+    elif raw_value in _LITERALS:
+        value = _LITERALS[raw_value]
+    else:
+        try:
+            value = json.loads(raw_value)
+        except ValueError:  # not a number or literal, the scanner stops there
+            return False
+    return VALUE if rules.match(key, value) is not None else False
+
+
+# Tokenize the body up to the end of a pair that fired and return the verdict of the scanner,
+# going on to the end of the body if the scanner does not stop there.
+def _confirm(body, end, rules, limits):
+    scanner = StreamScanner(rules, limits)
+    verdict = scanner.feed(body[:end + 1])
+    if verdict is None:
+        verdict = scanner.feed(body[end + 1:])
+    if verdict is None:
+        verdict = scanner.close()
+    return verdict
+
+
+# decoded content of a JSON string, None if it is not valid
+def _decode(raw):
+    try:
+        if b'\\' not in raw:
+            return raw.decode('utf-8')
+        return json.loads(b'"' + raw + b'"')
+    except ValueError:
+        return None
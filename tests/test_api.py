@@ -1,7 +1,11 @@
 import pytest
+import gzip
+import http.client
 import json
 import requests
 import os
+import zlib
+from urllib.parse import urlsplit
 
 BASE_URL = os.getenv('BASE_URL', default='http://localhost:5000')
 print("")
@@ -749,4 +753,357 @@ class TestApi:
 
         response = requests.post(url, headers=headers, data=payload)
 
-        assert response.status_code == 403  # ensure return status is forbidden
\ No newline at end of file
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test duplicate keys, json.loads would keep only the last value and let this through.
+    def test_duplicate_key_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = '{"is_malicious": true, "is_malicious": false}'
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a malicious body sent with chunked transfer-encoding, split in the middle of the key.
+    def test_chunked_request_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        # a generator body makes requests use Transfer-Encoding: chunked
+        payload = iter([b'{"data": [1, 2, 3], "is_mal', b'icious"', b': tr', b'ue}'])
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a large non malicious body sent with chunked transfer-encoding.
+    def test_chunked_request_ok(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = iter([b'{"data": [', b'1, ' * 100000, b'1], "is_malicious": false}'])
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 200  # ensure return status is ok
+
+    # Test a body that is not valid JSON, there is no { "is_malicious": true } so it is allowed.
+    def test_invalid_json_ok(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = '{"data": [1, 2, 3}'
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 200  # ensure return status is ok
+
+    # Test a key written with \u escapes, the prefilter must still treat it as a possible match.
+    def test_escaped_key_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = '{"hidden": {"\\u0069s_m\\u0061licious": true}}'
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a deeply nested malicious request, nesting must not exhaust the server.
+    def test_deeply_nested_request(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        depth = 5000
+        payload = '[' * depth + '{"is_malicious": true}' + ']' * depth
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a body nested deeper than the depth limit is rejected before it is scanned.
+    def test_too_deep_request(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        depth = 100000
+        payload = '[' * depth + '{"is_malicious": true}' + ']' * depth
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 400  # ensure return status is bad request
+        assert response.json()["limit"] == "depth"
+
+    # Test a Content-Length over the size limit is rejected before the body is sent.
+    def test_too_large_request(self):
+        parts = urlsplit(BASE_URL)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+        connection.putrequest('POST', '/api/handle-request')
+        connection.putheader('Content-Type', 'application/json')
+        connection.putheader('Content-Length', str(1024 ** 4))
+        connection.endheaders()
+
+        response = connection.getresponse()  # no byte of the body was sent
+
+        assert response.status == 413  # ensure return status is payload too large
+        assert json.loads(response.read())["limit"] == "bytes"
+        connection.close()
+
+    # Test a chunked body with too many elements is rejected while it is read.
+    def test_too_many_elements_chunked(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = iter([b'{"is_malicious": false, "data": ['] + [b'[], ' * 100000] * 11 + [b'[]]}'])
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 400  # ensure return status is bad request
+        assert response.json()["limit"] == "elements"
+
+    # Test a gzip compressed malicious request is decompressed and scanned.
+    def test_gzip_request_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+        payload = gzip.compress(json.dumps({"data": [1, 2, 3], "hidden": {"is_malicious": True}}).encode())
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a deflate compressed non malicious request sent with chunked transfer-encoding.
+    def test_deflate_request_ok(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
+
+        data = zlib.compress(json.dumps({"data": list(range(10000)), "is_malicious": False}).encode())
+        payload = (data[i:i + 1000] for i in range(0, len(data), 1000))
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 200  # ensure return status is ok
+
+    # Test a decompression bomb is rejected without inflating it.
+    def test_gzip_bomb(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+        payload = gzip.compress(b'{"data": "0"' + b' ' * (100 * 1024 * 1024) + b', "is_malicious": true}')
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 413  # ensure return status is payload too large
+        assert response.json()["limit"] == "ratio"
+
+    # Test an unsupported or corrupt Content-Encoding is rejected rather than passed unscanned.
+    def test_bad_encoding(self):
+        url = f'{BASE_URL}/api/handle-request'
+        payload = json.dumps({"is_malicious": True})
+
+        response = requests.post(url, headers={'Content-Type': 'application/json', 'Content-Encoding': 'br'},
+                                 data=payload)
+        assert response.status_code == 415  # ensure return status is unsupported media type
+
+        response = requests.post(url, headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'},
+                                 data=payload)
+        assert response.status_code == 400  # ensure return status is bad request
+
+    # Test JSON bodies with a byte order mark or in UTF-16 and UTF-32 are decoded like json.loads does.
+    def test_body_encodings(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        for encoding in ('utf-8-sig', 'utf-16', 'utf-16-le', 'utf-16-be', 'utf-32', 'utf-32-le', 'utf-32-be'):
+            response = requests.post(url, headers=headers, data='{"is_malicious": true}'.encode(encoding))
+            assert response.status_code == 403, encoding  # ensure return status is forbidden
+
+            response = requests.post(url, headers=headers, data='{"is_malicious": false}'.encode(encoding))
+            assert response.status_code == 200, encoding  # ensure return status is ok
+
+    # Test a form-encoded malicious request.
+    def test_form_request_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+
+        response = requests.post(url, data={"name": "x", "hidden[is_malicious]": "true"})
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a form-encoded non malicious request.
+    def test_form_request_ok(self):
+        url = f'{BASE_URL}/api/handle-request'
+
+        response = requests.post(url, data={"name": "x", "is_malicious": "false"})
+
+        assert response.status_code == 200  # ensure return status is ok
+
+    # Test a multipart request with a JSON part and a file.
+    def test_multipart_request(self):
+        url = f'{BASE_URL}/api/handle-request'
+        upload = ('data.bin', b'is_malicious=true' * 10000, 'application/octet-stream')
+        document = ('doc.json', json.dumps({"hidden": {"is_malicious": True}}), 'application/json')
+
+        response = requests.post(url, files={"upload": upload, "note": (None, "hello")})
+        assert response.status_code == 200  # ensure return status is ok (file contents are not fields)
+
+        response = requests.post(url, files={"upload": upload, "doc": document})
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test the query string is checked whatever the body.
+    def test_query_string_forbid(self):
+        url = f'{BASE_URL}/api/handle-request?page=1&is_malicious=true'
+
+        response = requests.get(url)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test a telemetry style body, a large numeric array followed by the malicious key.
+    def test_large_array_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = json.dumps({
+            "samples": [i * 0.5 for i in range(50000)],
+            "labels": ["cpu", "mem", "disk"] * 1000,
+            "hidden": {"is_malicious": True}
+        })
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test the homepage is served with an ETag and revalidated with 304 Not Modified.
+    def test_homepage_etag(self):
+        url = f'{BASE_URL}/'
+
+        response = requests.get(url, headers={'Accept-Encoding': 'identity'})
+
+        assert response.status_code == 200  # ensure return status is ok
+        assert b'http-waf' in response.content
+        etag = response.headers['ETag']
+
+        response = requests.get(url, headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+
+        assert response.status_code == 304  # ensure return status is not modified
+        assert response.content == b''
+
+    # Test the precompressed gzip variant of the homepage.
+    def test_homepage_gzip(self):
+        url = f'{BASE_URL}/'
+
+        response = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        assert response.status_code == 200  # ensure return status is ok
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert b'http-waf' in response.content  # requests decompresses the body for us
+
+    # Test the forbidden response reports the rule that fired.
+    def test_forbidden_response_rule(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = json.dumps({
+            "hidden": {"is_malicious": True}
+        })
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 403  # ensure return status is forbidden
+        assert response.json()["message"] == "is_malicious found"
+        assert response.json()["rule"] == "is-malicious"
+
+    # Test the batch endpoint returns one verdict line per NDJSON input line.
+    def test_batch_request(self):
+        url = f'{BASE_URL}/api/handle-requests'
+        headers = {'Content-Type': 'application/x-ndjson'}
+
+        payload = "\n".join([
+            json.dumps({"is_malicious": True}),
+            json.dumps({"is_malicious": False}),
+            "",
+            json.dumps({"hidden": {"is_malicious": True}}),
+            "not json",
+        ]) + "\n"
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 200  # ensure return status is ok
+        verdicts = [json.loads(line) for line in response.text.splitlines()]
+        assert [(verdict["line"], verdict["code"]) for verdict in verdicts] == [(1, 403), (2, 200), (4, 403), (5, 200)]
+
+    # Test the batch endpoint with a chunked upload, lines split across chunks.
+    def test_batch_request_chunked(self):
+        url = f'{BASE_URL}/api/handle-requests'
+        headers = {'Content-Type': 'application/x-ndjson'}
+
+        lines = [json.dumps({"id": i, "is_malicious": i % 3 == 0}).encode() for i in range(1000)]
+        data = b"\n".join(lines)
+        payload = (data[i:i + 1000] for i in range(0, len(data), 1000))
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        codes = [json.loads(line)["code"] for line in response.text.splitlines()]
+        assert codes == [403 if i % 3 == 0 else 200 for i in range(1000)]
+
+    # Test a compressed batch upload is refused rather than scanned as compressed bytes.
+    def test_batch_request_gzip(self):
+        url = f'{BASE_URL}/api/handle-requests'
+        headers = {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+
+        payload = gzip.compress(json.dumps({"is_malicious": True}).encode() + b"\n")
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert response.status_code == 415  # ensure return status is unsupported media type
+
+    # Test a body large enough to be scanned in the scanner process pool.
+    def test_huge_request_forbid(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        payload = json.dumps({
+            "data": ["padding" * 10] * 80000,
+            "hidden": {"is_malicious": True}
+        })
+
+        response = requests.post(url, headers=headers, data=payload)
+
+        assert len(payload) > 5 * 1024 * 1024
+        assert response.status_code == 403  # ensure return status is forbidden
+
+    # Test that the metrics endpoint counts blocked requests.
+    def test_metrics(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        def blocked():
+            text = requests.get(f'{BASE_URL}/metrics').text
+            for line in text.splitlines():
+                if line.startswith('waf_rule_matches_total{rule="is-malicious"}'):
+                    return int(line.split()[-1])
+
+        before = blocked()
+        requests.post(url, headers=headers, data=json.dumps({"is_malicious": True}))
+
+        assert blocked() == before + 1
+
+    # Test that a replayed body large enough for the scanner process pool is answered from the verdict cache.
+    def test_huge_request_cached(self):
+        url = f'{BASE_URL}/api/handle-request'
+        headers = {'Content-Type': 'application/json'}
+
+        def lookups(outcome):
+            text = requests.get(f'{BASE_URL}/metrics').text
+            for line in text.splitlines():
+                if line.startswith('waf_cache_lookups_total{outcome="%s"}' % outcome):
+                    return int(line.split()[-1])
+
+        payload = json.dumps({"data": ["replayed" * 10] * 80000, "nonce": os.urandom(8).hex(), "is_malicious": False})
+        before = lookups("hit")
+        codes = [requests.post(url, headers=headers, data=payload).status_code for _ in range(2)]
+
+        assert len(payload) > 5 * 1024 * 1024
+        assert codes == [200, 200]  # ensure return status is ok
+        assert lookups("hit") == before + 1
@@ -0,0 +1,164 @@
+import asyncio
+import gzip
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asgi
+from limits import Limits
+
+
+# Call the ASGI app in-process with a body split into the given chunks.
+# returns the response status and body
+def call(chunks, headers=((b'content-type', b'application/json'),), path='/api/handle-request', method='POST'):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+    received = []
+    sent = []
+
+    async def receive():
+        message = messages.pop(0)
+        received.append(message)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers)}
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]['status'], sent[1]['body'], len(received)
+
+
+# Class to unit test the asyncio serving mode of asgi.py
+class TestAsgi:
+
+    # Test simple malicious request.
+    def test_simple_request(self):
+        code, body, _ = call([json.dumps({"is_malicious": True}).encode()])
+
+        assert code == 403  # ensure return status is forbidden
+        assert json.loads(body)["message"] == "is_malicious found"
+
+    # Test simple non malicious request.
+    def test_simple_request_ok(self):
+        code, _, _ = call([json.dumps({"is_malicious": False}).encode()])
+
+        assert code == 200  # ensure return status is ok
+
+    # Test the verdict is sent before the rest of the body is received.
+    def test_early_verdict(self):
+        chunks = [b'{"hidden": {"is_mal', b'icious": true}, "rest": [', b'1, ' * 1000, b'1]}']
+
+        code, _, received = call(chunks)
+
+        assert code == 403  # ensure return status is forbidden
+        assert received == 2  # the last chunks were never read
+
+    # Test a body that is not JSON is not inspected.
+    def test_not_json_ok(self):
+        code, _, _ = call([b'{"is_malicious": true}'], headers=[(b'content-type', b'text/plain')])
+
+        assert code == 200  # ensure return status is ok
+
+    # Test a Content-Length over the size limit is rejected before the body is received.
+    def test_too_large(self, monkeypatch):
+        monkeypatch.setattr(asgi, 'LIMITS', Limits(max_bytes=100))
+        headers = [(b'content-type', b'application/json'), (b'content-length', b'1000')]
+
+        code, body, received = call([b'{"data": "' + b'x' * 988 + b'"}'], headers=headers)
+
+        assert code == 413  # ensure return status is payload too large
+        assert json.loads(body)["limit"] == "bytes"
+        assert received == 0  # the body was never read
+
+    # Test a body nested deeper than the depth limit is rejected while it is received.
+    def test_too_deep(self, monkeypatch):
+        monkeypatch.setattr(asgi, 'LIMITS', Limits(max_depth=10))
+
+        code, body, received = call([b'{"is_malicious": false, "a": ', b'[' * 20, b']' * 20 + b'}'])
+
+        assert code == 400  # ensure return status is bad request
+        assert json.loads(body)["limit"] == "depth"
+        assert received == 2
+
+    # Test a gzip compressed body is decompressed chunk by chunk and scanned.
+    def test_gzip(self):
+        compressed = gzip.compress(json.dumps({"data": [1] * 1000, "hidden": {"is_malicious": True}}).encode())
+        chunks = [compressed[i:i + 100] for i in range(0, len(compressed), 100)]
+        headers = [(b'content-type', b'application/json'), (b'content-encoding', b'gzip')]
+
+        code, _, _ = call(chunks, headers=headers)
+
+        assert code == 403  # ensure return status is forbidden
+
+    # Test form-encoded bodies and query strings are checked.
+    def test_form_and_query(self):
+        code, _, _ = call([b'a=1&is_mal', b'icious=true'],
+                          headers=[(b'content-type', b'application/x-www-form-urlencoded')])
+        assert code == 403  # ensure return status is forbidden
+
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/handle-request', 'headers': [],
+                 'query_string': b'is_malicious=1'}
+        asyncio.run(asgi.app(scope, receive, send))
+        assert sent[0]['status'] == 403  # ensure return status is forbidden
+
+    # Test a client that stalls in the middle of its body gets 408.
+    def test_stalled_upload(self, monkeypatch):
+        monkeypatch.setattr(asgi, 'RECEIVE_TIMEOUT', 0.01)
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(1)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/handle-request',
+                 'headers': [(b'content-type', b'application/json')]}
+        asyncio.run(asgi.app(scope, receive, send))
+
+        assert sent[0]['status'] == 408
+
+    # Test unknown paths return 404.
+    def test_not_found(self):
+        code, _, _ = call([], path='/missing')
+
+        assert code == 404
+
+    # Test that the metrics endpoint counts the verdicts of the asyncio mode.
+    def test_metrics(self):
+        def blocked():
+            _, body, _ = call([], path='/metrics')
+            for line in body.decode().splitlines():
+                if line.startswith('waf_rule_matches_total{rule="is-malicious"}'):
+                    return int(line.split()[-1])
+
+        before = blocked()
+        call([json.dumps({"is_malicious": True}).encode()])
+
+        assert blocked() == before + 1
+
+    # Test a HEAD request gets the headers of the response without its body.
+    def test_head(self):
+        code, body, _ = call([json.dumps({"is_malicious": True}).encode()], method='HEAD')
+        assert code == 403 and body == b''
+        code, body, _ = call([], path='/', method='HEAD')
+        assert code == 200 and body == b''
+
+    # Test the homepage is revalidated only by an If-None-Match that lists its ETag.
+    def test_homepage_etag(self):
+        etag = '"%s"' % asgi.load_homepage()["etag"]
+        for if_none_match, code in ((etag, 304), ('"x", W/' + etag, 304), ('*', 304), (etag[:-2] + '"', 200),
+                                    ('"x' + etag[1:], 200), ('', 200)):
+            headers = [(b'if-none-match', if_none_match.encode())]
+            assert call([], headers=headers, path='/', method='GET')[0] == code, if_none_match
@@ -0,0 +1,116 @@
+import pytest
+import threading
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from cache import VerdictCache, ENTRY_BYTES
+from metrics import Metrics
+from rules import compile_rules
+
+RULES = compile_rules({"rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True]}]})
+
+
+# Class to unit test the verdict cache of cache.py
+class TestVerdictCache:
+
+    # Test a replayed body is answered from the cache.
+    def test_hit(self):
+        cache = VerdictCache()
+        scans = []
+
+        def scan(body):
+            scans.append(body)
+            return "verdict"
+
+        assert cache.get_or_scan(b'{"a": 1}', RULES, scan) == "verdict"
+        assert cache.get_or_scan(b'{"a": 1}', RULES, scan) == "verdict"
+        assert cache.get_or_scan(b'{"a": 2}', RULES, scan) == "verdict"
+
+        assert len(scans) == 2
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
+
+    # Test verdicts of another rule set version are not reused.
+    def test_rule_version(self):
+        cache = VerdictCache()
+        other = compile_rules({"rules": [{"key": "other"}]})
+
+        cache.get_or_scan(b'{}', RULES, lambda body: 1)
+
+        assert cache.get_or_scan(b'{}', other, lambda body: 2) == 2
+
+    # Test the least recently used verdict is evicted, bounded by entries and by memory.
+    def test_eviction(self):
+        cache = VerdictCache(max_entries=2)
+        for body in (b'1', b'2', b'1', b'3'):
+            cache.get_or_scan(body, RULES, lambda body: body)
+
+        assert len(cache) == 2
+        assert cache.stats()["evictions"] == 1
+        assert cache.get_or_scan(b'1', RULES, lambda body: None) == b'1'  # kept, it was used again
+        assert cache.get_or_scan(b'2', RULES, lambda body: None) is None  # evicted
+
+        assert VerdictCache(max_entries=1000, max_bytes=10 * ENTRY_BYTES).capacity == 10
+
+    # Test verdicts expire after the ttl.
+    def test_ttl(self):
+        cache = VerdictCache(ttl=0.01)
+        cache.get_or_scan(b'1', RULES, lambda body: 1)
+        time.sleep(0.02)
+
+        assert cache.get_or_scan(b'1', RULES, lambda body: 2) == 2
+
+    # Test concurrent identical bodies are scanned once.
+    def test_single_flight(self):
+        cache = VerdictCache()
+        started = threading.Event()
+        release = threading.Event()
+        scans = []
+
+        def scan(body):
+            scans.append(body)
+            started.set()
+            release.wait()
+            return "verdict"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_scan(b'big', RULES, scan)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while cache.stats()["coalesced"] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert scans == [b'big']
+        assert results == ["verdict"] * 5
+
+    # Test a failed scan is not cached and its error reaches the caller.
+    def test_scan_error(self):
+        cache = VerdictCache()
+
+        def scan(body):
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            cache.get_or_scan(b'1', RULES, scan)
+        assert cache.get_or_scan(b'1', RULES, lambda body: 1) == 1
+
+    # Test the lookups are counted in the metrics by outcome.
+    def test_metrics(self):
+        metrics = Metrics(RULES, slots=1)
+        cache = VerdictCache(metrics=metrics)
+        for body in (b'1', b'1', b'2'):
+            cache.get_or_scan(body, RULES, lambda body: None)
+        text = metrics.exposition()
+
+        assert 'waf_cache_lookups_total{outcome="hit"} 1' in text
+        assert 'waf_cache_lookups_total{outcome="miss"} 2' in text
+        assert 'waf_cache_lookups_total{outcome="coalesced"} 0' in text
@@ -0,0 +1,157 @@
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from decoders import select_decoder, BACKENDS, Decoder
+from limits import Limits, LimitExceeded
+from rules import compile_rules
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+    {"id": "debug", "prefix": "__debug"},
+    {"id": "role", "key": "role", "values": [18446744073709551617]},
+]})
+LIMITS = Limits(max_bytes=10 ** 6, max_depth=10000, max_elements=10 ** 6, max_string=10 ** 6)
+
+
+# the decoders that are installed
+def installed():
+    decoders = []
+    for name in BACKENDS:
+        try:
+            decoders.append(select_decoder(name))
+        except ValueError:
+            pass
+    return decoders
+
+
+DECODERS = installed()
+
+
+# the verdict of the streaming pipeline, the name of the limit for a rejected body
+def streamed(body, limits=LIMITS, rules=RULES):
+    scanner = BodyScanner(rules, limits)
+    try:
+        return scanner.feed(body) or scanner.close()
+    except LimitExceeded as error:
+        return error.limit
+
+
+# Class to unit test the JSON decoders of decoders.py
+@pytest.mark.parametrize('decoder', DECODERS, ids=lambda decoder: decoder.name)
+class TestDecoders:
+
+    # Test decoded bodies get the verdict of the streaming scanner.
+    def test_scan(self, decoder):
+        bodies = [
+            {"is_malicious": True},
+            {"hidden": [1, 2, {"is_malicious": 1.0}]},
+            {"is_malicious": False, "data": list(range(100))},
+            {"a": {"__debug_mode": {"x": 1}}},
+            {"is_malicious": [True]},
+            [{"name": "x"}] * 10 + [{"is_malicious": None}],
+        ]
+        for body in bodies:
+            body = json.dumps(body).encode()
+            assert decoder.scan(body, RULES, LIMITS) is streamed(body)
+        assert decoder.scan(b'{"a": "no key here"}', RULES, LIMITS) is NO_MATCH
+        assert decoder.scan(b'{"is_m\\u0061licious": true}', RULES, LIMITS) is RULES.rules[0]
+
+    # Test a duplicate key that would hide a pair is left to the scanner.
+    def test_duplicate_keys(self, decoder):
+        for body in (b'{"is_malicious": true, "is_malicious": false}',
+                     b'{"a": {"is_malicious": true}, "a": 1}',
+                     b'{"a": {"__debug": 1}, "b": {"is_malicious": true}, "a": 2}'):
+            assert decoder.scan(body, RULES, LIMITS) is None
+            assert streamed(body)
+        # duplicates that hide no key of the rules are decoded
+        assert decoder.scan(b'{"a": 1, "a": 2, "is_malicious": true}', RULES, LIMITS) is RULES.rules[0]
+
+    # Test two different rules firing are left to the scanner, which knows which comes first.
+    def test_several_rules(self, decoder):
+        body = b'{"x": 1, "__debug": 1, "x": {"is_malicious": true}}'
+        assert decoder.scan(body, RULES, LIMITS) is None
+        assert streamed(body) is RULES.rules[1]
+        assert decoder.scan(b'[{"is_malicious": true}, {"is_malicious": 1}]', RULES, LIMITS) is RULES.rules[0]
+
+    # Test invalid JSON is left to the scanner, and bodies that not every decoder accepts get the same verdict.
+    def test_rejected(self, decoder):
+        for body in (b'{"is_malicious": true, oops',  # the scanner finds the pair before the error
+                     b'\xef\xbb\xbf{"is_malicious": true}',
+                     '{"is_malicious": true}'.encode('utf-16'),
+                     '{"is_malicious": true}'.encode('utf-32-le'),
+                     b'{"is_malicious": true}x'):
+            assert decoder.scan(body, RULES, LIMITS) is None
+        assert streamed(b'{"is_malicious": true, oops') is RULES.rules[0]
+        assert streamed('{"is_malicious": true}'.encode('utf-16')) is RULES.rules[0]
+        for body in (b'{"is_malicious": NaN, "__debug": 1}', b'{"is_malicious": "\\ud800", "__debug": 1}'):
+            assert decoder.scan(body, RULES, LIMITS) in (None, streamed(body))
+
+    # Test integers beyond 64 bits are compared exactly.
+    def test_long_integers(self, decoder):
+        body = b'{"role": 18446744073709551616}'
+        assert decoder.scan(body, RULES, LIMITS) in (None, NO_MATCH)
+        assert streamed(body) is NO_MATCH
+        assert decoder.scan(b'{"role": 18446744073709551617}', RULES, LIMITS) in (None, RULES.rules[2])
+
+    # Test bodies that could go over a structure limit are left to the scanner.
+    def test_limits(self, decoder):
+        body = json.dumps({"is_malicious": False, "a": [[[1]]]}).encode()
+        assert decoder.scan(body, RULES, Limits(max_depth=2)) is None
+        assert streamed(body, Limits(max_depth=2)) == "depth"
+        assert decoder.scan(body, RULES, Limits(max_elements=3)) is None
+        assert decoder.scan(body, RULES, Limits(max_string=10)) is None
+        assert decoder.scan(body, RULES, Limits(max_depth=10000)) is NO_MATCH
+        deep = b'[' * 200 + b'{"is_malicious": true}' + b']' * 200
+        assert decoder.scan(deep, RULES, Limits(max_depth=100)) is None
+        assert streamed(deep, Limits(max_depth=100)) == "depth"
+        assert decoder.scan(body, RULES, Limits()) is NO_MATCH
+
+    # Test bodies over the string and element limits in size are decoded, unless they may go over a limit.
+    def test_large_bodies(self, decoder):
+        decoded = []
+        counting = Decoder(decoder.name, lambda body: decoded.append(body) or decoder.loads(body), decoder.max_depth,
+                           decoder.exact_numbers)
+        limits = Limits(max_bytes=64 * 2 ** 20, max_depth=10000, max_elements=10 ** 6, max_string=2 ** 20)
+        records = [{"id": i, "name": "x" * 80, "tags": ["a", "b"]} for i in range(12000)]
+        for body, verdict in ((json.dumps({"is_malicious": False, "data": records}).encode(), NO_MATCH),
+                              (json.dumps({"data": records, "hidden": {"is_malicious": True}}).encode(), RULES.rules[0]),
+                              (json.dumps({"is_malicious": False, "n": list(range(300000))}).encode(), NO_MATCH)):
+            assert len(body) > 2 ** 20
+            assert counting.scan(body, RULES, limits) is verdict
+            assert decoded.pop() is body
+            assert streamed(body, limits) is verdict
+        # a string, a key, a number or nesting over the limits, before or after the pair
+        long_string = b'"' + b'x' * (2 ** 20 + 1) + b'"'
+        for body in (b'{"a": [' + long_string + b'], "is_malicious": true}',
+                     b'{"is_malicious": false, "b": {' + long_string + b': 1}}',
+                     b'{"a": "\\u0041' + b'x' * 2 ** 20 + b'", "is_malicious": false}',
+                     b'{"is_malicious": false, "n": ' + b'1' * (2 ** 20 + 1) + b'}',
+                     b'[' + b'[' * 10000 + b']' * 10000 + b', {"is_malicious": true}, "' + b'x' * 2 ** 20 + b'"]'):
+            assert counting.scan(body, RULES, limits) is None
+            assert streamed(body, limits) in ("string", "depth")
+
+    # Test rule sets with signatures are always scanned.
+    def test_signatures(self, decoder):
+        rules = compile_rules({"rules": [{"id": "m", "key": "is_malicious"}],
+                               "signatures": [{"id": "xss", "literal": "<script"}]})
+        assert decoder.scan(b'{"a": "<script>"}', rules, LIMITS) is None
+
+
+# Class to unit test the selection of the decoder
+class TestSelectDecoder:
+
+    # Test auto picks the first decoder installed and stream picks none.
+    def test_select(self):
+        assert select_decoder("auto").name == DECODERS[0].name
+        assert select_decoder("stdlib").name == "stdlib"
+        assert select_decoder(" Stream ") is None
+
+    # Test an unknown decoder is a configuration error.
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            select_decoder("simdjson")
@@ -0,0 +1,97 @@
+import pytest
+import gzip
+import json
+import zlib
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from decoding import decoding, Decompressor, OUTPUT_CHUNK
+from limits import Limits, LimitExceeded
+from rules import compile_rules
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+]})
+BODY = json.dumps({"data": list(range(1000)), "hidden": {"is_malicious": True}}).encode()
+BENIGN = json.dumps({"data": list(range(1000)), "is_malicious": False}).encode()
+
+
+# Scan an encoded body fed in chunks of the given size.
+def scan(body, encoding, size=None, limits=None):
+    scanner = decoding(BodyScanner(RULES, limits), encoding, limits)
+    size = size or len(body) or 1
+    for start in range(0, len(body), size):
+        verdict = scanner.feed(body[start:start + size])
+        if verdict is not None:
+            return verdict
+    return scanner.close()
+
+
+# returns (name, status) of the rejection of an encoded body
+def rejected(body, encoding, size=None, limits=None):
+    with pytest.raises(LimitExceeded) as error:
+        scan(body, encoding, size, limits)
+    return error.value.limit, error.value.status
+
+
+# Class to unit test the Content-Encoding decompression of decoding.py
+class TestDecoding:
+
+    # Test gzip bodies are decompressed and scanned, whatever the chunk boundaries.
+    def test_gzip(self):
+        for size in (1, 7, 4096, None):
+            assert scan(gzip.compress(BODY), 'gzip', size) is RULES.rules[0]
+            assert scan(gzip.compress(BENIGN), 'x-gzip', size) is NO_MATCH
+
+    # Test deflate bodies are decompressed both with the zlib header of HTTP and without one.
+    def test_deflate(self):
+        compressed = zlib.compress(BODY)
+        for size in (1, 7, None):
+            assert scan(compressed, 'deflate', size) is RULES.rules[0]
+            assert scan(compressed[2:-4], 'deflate', size) is RULES.rules[0]  # raw deflate stream
+
+    # Test several codings are undone in reverse order, and identity is no coding.
+    def test_several_codings(self):
+        assert scan(zlib.compress(gzip.compress(BODY)), 'gzip, deflate') is RULES.rules[0]
+        assert scan(gzip.compress(BODY), 'identity, gzip') is RULES.rules[0]
+        assert scan(BODY, 'identity') is RULES.rules[0]
+        assert scan(BODY, None) is RULES.rules[0]
+
+    # Test gzip bodies made of several members are decompressed whole.
+    def test_gzip_members(self):
+        assert scan(gzip.compress(BENIGN[:100]) + gzip.compress(BENIGN[100:]), 'gzip', 7) is NO_MATCH
+        assert scan(gzip.compress(BODY[:100]) + gzip.compress(BODY[100:]), 'gzip', 7) is RULES.rules[0]
+
+    # Test decompression stops once the verdict is known.
+    def test_early_verdict(self):
+        compressed = gzip.compress(b'{"is_malicious": true, "data": [' + b'1, ' * 1000000 + b'1]}')
+        decompressor = Decompressor(BodyScanner(RULES), 'gzip')
+
+        assert decompressor.feed(compressed) is RULES.rules[0]
+        assert decompressor.output <= OUTPUT_CHUNK
+        assert decompressor.close() is RULES.rules[0]
+
+    # Test a decompression bomb is rejected on its ratio and on its decompressed size.
+    def test_bomb(self):
+        bomb = gzip.compress(b'{"data": "' + b'0' * (20 * 1024 * 1024) + b'", "is_malicious": true}')
+
+        assert rejected(bomb, 'gzip', 4096, Limits(max_ratio=100)) == ('ratio', 413)
+        assert rejected(bomb, 'gzip', 4096, Limits(max_bytes=1024 * 1024)) == ('bytes', 413)
+        assert scan(bomb, 'gzip', 4096, Limits(max_ratio=10000)) is RULES.rules[0]
+
+    # Test the compressed bytes count against the size limit too.
+    def test_compressed_size(self):
+        compressed = gzip.compress(os.urandom(10000))  # does not compress
+        assert rejected(compressed, 'gzip', 1000, Limits(max_bytes=5000)) == ('bytes', 413)
+
+    # Test bodies that do not decompress and unknown codings are rejected.
+    def test_bad_encoding(self):
+        assert rejected(b'{"is_malicious": true}', 'gzip') == ('encoding', 400)
+        compressed = gzip.compress(BENIGN)
+        assert rejected(compressed[:len(compressed) // 2], 'gzip', 100) == ('encoding', 400)  # truncated
+        assert rejected(zlib.compress(BENIGN) + b'x', 'deflate') == ('encoding', 400)  # trailing data
+        assert rejected(b'x', 'deflate') == ('encoding', 400)
+        assert rejected(BODY, 'br') == ('encoding', 415)
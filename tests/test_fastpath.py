@@ -0,0 +1,107 @@
+import io
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fastpath import FastPath, is_json
+from pool import PoolSaturated
+from rules import compile_rules
+from scanner import BodyScanner
+
+RULES = compile_rules({"rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "found"},
+                                 {"id": "teapot", "key": "tea", "status": 418, "message": "short and stout"}]})
+SUCCESS = {"status": "success", "code": 200, "message": ""}
+BUSY = {"status": "error", "code": 503, "message": "busy"}
+
+
+# scan function standing in for scan_request in app.py
+def scan(stream, length, encoding=None, content_type='application/json', query=''):
+    if not is_json(content_type):
+        return False
+    body = stream.read()
+    if body == b'busy':
+        raise PoolSaturated()
+    scanner = BodyScanner(RULES)
+    return scanner.feed(body) or scanner.close()
+
+
+# Flask stand-in for every other path
+def fallback(environ, start_response):
+    start_response('404 NOT FOUND', [('Content-Type', 'text/html')])
+    return [b'fallback']
+
+
+# Call the fast path in-process.
+# returns the status line, headers dict and body
+def call(body, path='/api/handle-request', method='POST', content_type='application/json'):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'CONTENT_TYPE': content_type,
+               'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    started = []
+    app = FastPath(fallback, scan, SUCCESS, busy=(PoolSaturated, BUSY))
+    chunks = app(environ, lambda status, headers: started.append((status, dict(headers))))
+    return started[0][0], started[0][1], b''.join(chunks)
+
+
+# Class to unit test the raw WSGI fast path of fastpath.py
+class TestFastPath:
+
+    # Test simple malicious request.
+    def test_malicious(self):
+        status, headers, body = call(b'{"is_malicious": true}')
+
+        assert status == '403 Forbidden'
+        assert json.loads(body) == RULES.rules[0].response
+        assert headers['Content-Length'] == str(len(body))
+        assert headers['Content-Type'] == 'application/json'
+
+    # Test that a benign body gets the pre-encoded success response.
+    def test_success(self):
+        status, _, body = call(b'{"is_malicious": false}')
+
+        assert status == '200 OK'
+        assert json.loads(body) == SUCCESS
+
+    # Test that the status and message of the rule that fired are used.
+    def test_rule_status(self):
+        status, _, body = call(b'{"tea": "earl grey"}')
+
+        assert status.startswith('418 ')
+        assert json.loads(body)['rule'] == 'teapot'
+
+    # Test that non-JSON bodies are not inspected.
+    def test_not_json(self):
+        status, _, _ = call(b'{"is_malicious": true}', content_type='text/plain')
+
+        assert status == '200 OK'
+
+    # Test that a saturated scan pool is answered with 503 and Retry-After.
+    def test_busy(self):
+        status, headers, body = call(b'busy')
+
+        assert status.startswith('503 ')
+        assert headers['Retry-After'] == '1'
+        assert json.loads(body) == BUSY
+
+    # Test that HEAD gets the headers without a body.
+    def test_head(self):
+        status, headers, body = call(b'{"is_malicious": true}', method='HEAD')
+
+        assert status == '403 Forbidden'
+        assert body == b''
+
+    # Test that other paths fall through to the wrapped application.
+    def test_fallback(self):
+        status, _, body = call(b'{}', path='/missing')
+
+        assert status == '404 NOT FOUND'
+        assert body == b'fallback'
+
+    # Test the JSON content type check.
+    def test_is_json(self):
+        assert is_json('application/json')
+        assert is_json('Application/JSON; charset=utf-8')
+        assert is_json('application/problem+json')
+        assert not is_json('text/json')
+        assert not is_json('')
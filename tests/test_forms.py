@@ -0,0 +1,146 @@
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from forms import FormScanner, MultipartScanner, match_field, scan_query, scanner_for, inspected
+from limits import Limits, LimitExceeded
+from rules import compile_rules
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({
+    "rules": [
+        {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+        {"id": "debug", "prefix": "__debug"},
+    ],
+    "signatures": [{"id": "xss-script", "literal": "<script"}],
+})
+FORM = 'application/x-www-form-urlencoded'
+MULTIPART = 'multipart/form-data; boundary=XyZ'
+
+
+# Scan a body with the scanner of its Content-Type, split into chunks of the given size.
+def scan(content_type, body, size=None, limits=None):
+    scanner = scanner_for(content_type, RULES, limits)
+    size = size or len(body) or 1
+    for start in range(0, len(body), size):
+        verdict = scanner.feed(body[start:start + size])
+        if verdict is not None:
+            return verdict
+    return scanner.close()
+
+
+# Build a multipart/form-data body with the boundary XyZ from (headers, content) parts.
+def multipart(*parts):
+    body = b'preamble\r\n'
+    for headers, content in parts:
+        body += b'--XyZ\r\n' + headers + b'\r\n\r\n' + content + b'\r\n'
+    return body + b'--XyZ--\r\nepilogue'
+
+
+def field(name, value):
+    return b'Content-Disposition: form-data; name="%s"' % name, value
+
+
+# Class to unit test the form, multipart and query string scanners of forms.py
+class TestForms:
+
+    # Test form fields are checked like JSON pairs, whatever the chunk boundaries.
+    def test_form(self):
+        for size in (1, 3, None):
+            assert scan(FORM, b'a=1&is_malicious=true&b=2', size) is RULES.rules[0]
+            assert scan(FORM, b'a=1&is_malicious=false&b=2', size) is NO_MATCH
+            assert scan(FORM, b'is%5Fmalicious=tru%65', size) is RULES.rules[0]
+            assert scan(FORM, b'note=hello+%3Cscript%3E', size) is RULES.signatures.signatures[0]
+
+    # Test scanning stops at the first hit.
+    def test_form_early_verdict(self):
+        scanner = FormScanner(RULES)
+        assert scanner.feed(b'is_malicious=1&rest=') is RULES.rules[0]
+        assert scanner.feed(b'x' * 100) is RULES.rules[0]
+        assert scanner.close() is RULES.rules[0]
+
+    # Test bracket names are read as nested objects and arrays.
+    def test_nested_names(self):
+        assert match_field(RULES, 'hidden[is_malicious]', 'true') is RULES.rules[0]
+        assert match_field(RULES, 'list[0][is_malicious]', '1') is RULES.rules[0]
+        assert match_field(RULES, 'is_malicious[]', 'true') is None  # {"is_malicious": [true]}
+        assert match_field(RULES, '__debug[x]', '') is RULES.rules[1]
+        assert match_field(RULES, 'is_malicious', 'yes') is None
+
+    # Test multipart fields, JSON parts and files.
+    def test_multipart(self):
+        malicious = multipart(field(b'a', b'1'), field(b'is_malicious', b'true'))
+        benign = multipart(field(b'a', b'1'), field(b'is_malicious', b'false'))
+        json_part = multipart((b'Content-Disposition: form-data; name="doc"\r\nContent-Type: application/json',
+                               json.dumps({"hidden": {"is_malicious": True}}).encode()))
+        for size in (1, 2, 7, None):
+            assert scan(MULTIPART, malicious, size) is RULES.rules[0]
+            assert scan(MULTIPART, benign, size) is NO_MATCH
+            assert scan(MULTIPART, json_part, size) is RULES.rules[0]
+
+    # Test file contents are skipped without being kept, only the name of a file is checked.
+    def test_multipart_file(self):
+        upload = (b'Content-Disposition: form-data; name="f"; filename="a.bin"\r\nContent-Type: application/octet-stream',
+                  b'is_malicious=true\r\n--Xy' * 1000)
+        scanner = MultipartScanner(RULES, b'XyZ')
+        body = multipart(upload, field(b'is_malicious', b'1'))
+        verdict = None
+        for start in range(0, len(body), 1000):
+            verdict = scanner.feed(body[start:start + 1000])
+            assert len(scanner._buf) < 1000 + len(scanner.delimiter)
+            if verdict is not None:
+                break
+        assert verdict is RULES.rules[0]
+        assert scan(MULTIPART, multipart((b'Content-Disposition: form-data; name="__debug"; filename="x"', b''))) \
+            is RULES.rules[1]
+
+    # Test an unterminated multipart body is still checked, and bodies that are not multipart are allowed.
+    def test_multipart_malformed(self):
+        assert scan(MULTIPART, b'--XyZ\r\nContent-Disposition: form-data; name="is_malicious"\r\n\r\ntrue') \
+            is RULES.rules[0]
+        assert scan(MULTIPART, b'is_malicious=true') is NO_MATCH
+        with pytest.raises(LimitExceeded):
+            scanner_for('multipart/form-data', RULES)  # no boundary
+
+    # Test a line that only starts like a delimiter is content, the part and its check go on.
+    def test_multipart_false_delimiter(self):
+        body = multipart(field(b'note', b'x\r\n--XyZ-not-a-delimiter\r\n\r\n'), field(b'is_malicious', b'true'))
+        for size in (1, 5, None):
+            assert scan(MULTIPART, body, size) is RULES.rules[0]
+        # not the closing delimiter either, the value is the whole of 1\r\n--XyZ--x
+        assert scan(MULTIPART, multipart(field(b'is_malicious', b'1\r\n--XyZ--x'))) is NO_MATCH
+
+    # Test query strings.
+    def test_query(self):
+        assert scan_query('page=2&is_malicious=true', RULES) is RULES.rules[0]
+        assert scan_query(b'page=2', RULES) is NO_MATCH
+        assert scan_query('', RULES) is NO_MATCH
+
+    # Test the Content-Types that are scanned.
+    def test_scanner_for(self):
+        assert isinstance(scanner_for('application/json; charset=utf-8', RULES), BodyScanner)
+        assert isinstance(scanner_for('Application/X-WWW-Form-Urlencoded', RULES), FormScanner)
+        assert isinstance(scanner_for(MULTIPART, RULES), MultipartScanner)
+        assert scanner_for('text/plain', RULES) is None
+        assert inspected(FORM) and inspected(MULTIPART) and not inspected('text/plain')
+
+    # Test the limits apply to fields and parts.
+    def test_limits(self):
+        limits = Limits(max_string=16, max_elements=3, max_bytes=1000)
+        assert scan(FORM, b'a=1&b=2&c=3', limits=limits) is NO_MATCH
+        with pytest.raises(LimitExceeded) as error:
+            scan(FORM, b'a=1&b=2&c=3&d=4', limits=limits)
+        assert error.value.limit == 'elements'
+        with pytest.raises(LimitExceeded) as error:
+            scan(FORM, b'a=' + b'x' * 100, size=10, limits=limits)
+        assert error.value.limit == 'string'
+        with pytest.raises(LimitExceeded) as error:
+            scan(MULTIPART, multipart(field(b'a', b'x' * 100)), size=10, limits=limits)
+        assert error.value.limit == 'string'
+        with pytest.raises(LimitExceeded) as error:
+            scan(MULTIPART, multipart((b'Content-Disposition: form-data; name="f"; filename="x"', b'x' * 2000)),
+                 limits=limits)
+        assert error.value.limit == 'bytes'
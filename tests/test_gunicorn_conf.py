@@ -0,0 +1,60 @@
+import gc
+import runpy
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'gunicorn.conf.py')
+
+
+# Load gunicorn.conf.py with the given environment variables set.
+# returns the settings it defines
+def load_config(monkeypatch, **env):
+    monkeypatch.setattr(os, 'environ', dict(os.environ))  # the config sets defaults in the environment
+    for name in ('WEB_CONCURRENCY', 'WAF_WORKER_CLASS', 'WAF_THREADS', 'WAF_MAX_REQUESTS', 'WAF_MAX_REQUESTS_JITTER',
+                 'WAF_SCAN_WORKERS'):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    return runpy.run_path(CONFIG_PATH)
+
+
+# Class to unit test the production serving profile of gunicorn.conf.py
+class TestGunicornConf:
+
+    # Test the defaults derived from the CPU count.
+    def test_defaults(self, monkeypatch):
+        config = load_config(monkeypatch)
+
+        assert config['workers'] == config['CPUS'] * 2 + 1
+        assert config['worker_class'] in ('sync', 'gthread')
+        assert config['threads'] >= 1
+        assert config['preload_app'] is True  # share the rule tables copy-on-write
+        assert config['max_requests'] > 0
+        assert 0 < config['max_requests_jitter'] < config['max_requests']
+        assert os.environ['WAF_SCAN_WORKERS'] == str(max(1, config['CPUS'] // config['workers']))
+
+    # Test that the environment overrides the defaults.
+    def test_overrides(self, monkeypatch):
+        config = load_config(monkeypatch, WEB_CONCURRENCY='3', WAF_WORKER_CLASS='sync', WAF_MAX_REQUESTS='0', PORT='8080')
+
+        assert config['workers'] == 3
+        assert config['worker_class'] == 'sync'
+        assert config['threads'] == 1
+        assert config['max_requests'] == 0
+        assert config['max_requests_jitter'] == 0
+        assert config['bind'] == '0.0.0.0:8080'
+        assert os.environ['WAF_SCAN_WORKERS'] == str(max(1, config['CPUS'] // 3))
+        load_config(monkeypatch, WAF_SCAN_WORKERS='0')
+        assert os.environ['WAF_SCAN_WORKERS'] == '0'
+
+    # Test that the preloaded objects are frozen once the master is ready.
+    def test_when_ready_freezes(self, monkeypatch):
+        config = load_config(monkeypatch)
+        try:
+            config['when_ready'](None)
+
+            assert gc.get_freeze_count() > 0
+        finally:
+            gc.unfreeze()
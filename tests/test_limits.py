@@ -0,0 +1,157 @@
+import pytest
+import pickle
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from limits import Limits, LimitExceeded
+from pool import ScanPool
+from rules import compile_rules
+import scanner
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+]})
+SIGNATURE_RULES = compile_rules({
+    "rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True]}],
+    "signatures": [{"id": "xss-script", "literal": "<script"}],
+})
+
+
+# feed a body to a BodyScanner in chunks of the given size and return its verdict
+def scan(body, limits, size=None, rules=RULES):
+    scanner = BodyScanner(rules, limits)
+    size = size or len(body) or 1
+    for start in range(0, len(body), size):
+        verdict = scanner.feed(body[start:start + size])
+        if verdict is not None:
+            return verdict
+    return scanner.close()
+
+
+# returns the name of the limit a body goes over, None if it is within the limits
+def exceeded(body, limits, size=None, rules=RULES):
+    try:
+        scan(body, limits, size, rules)
+    except LimitExceeded as error:
+        return error.limit
+    return None
+
+
+# Class to unit test the body limits of limits.py and their enforcement in scanner.py
+class TestLimits:
+
+    # Test a Content-Length is checked before the body is read.
+    def test_check_length(self):
+        limits = Limits(max_bytes=100)
+        limits.check_length(None)
+        limits.check_length(100)
+        with pytest.raises(LimitExceeded) as error:
+            limits.check_length(101)
+        assert error.value.status == 413
+        Limits().check_length(10 ** 12)
+
+    # Test the bytes of a body without a Content-Length are counted as they are fed.
+    def test_max_bytes(self):
+        limits = Limits(max_bytes=100)
+        body = b'{"data": "' + b'x' * 200 + b'"}'
+        assert exceeded(body, limits, size=10) == "bytes"
+        assert exceeded(body[:100], limits, size=10) is None
+
+    # Test nesting deeper than the limit is rejected, a malicious key nested within it is still found.
+    def test_max_depth(self):
+        limits = Limits(max_depth=10)
+        assert scan(b'[' * 9 + b'{"is_malicious": true}' + b']' * 9, limits) is RULES.rules[0]
+        assert exceeded(b'[' * 10 + b'{"is_malicious": true}' + b']' * 10, limits) == "depth"
+        assert exceeded(b'{"is_malicious": false, "a": ' + b'[' * 100, limits, size=7) == "depth"
+
+    # Test every array item and object member counts as an element, including skipped scalar runs.
+    def test_max_elements(self):
+        limits = Limits(max_elements=10)  # is_malicious, a and its items
+        assert scan(b'{"is_malicious": false, "a": [1, 2, 3, 4, 5, 6, 7, 8]}', limits) is NO_MATCH
+        assert exceeded(b'{"is_malicious": false, "a": [1, 2, 3, 4, 5, 6, 7, 8, 9]}', limits) == "elements"
+        assert scan(b'{"is_malicious": false, "a": [[], {}, [], {}, [], {}, [], {}]}', limits) is NO_MATCH
+        assert exceeded(b'{"is_malicious": false, "a": [[], {}, [], {}, [], {}, [], {}, [1]]}', limits) == "elements"
+
+    # Test commas inside strings are not counted as elements.
+    def test_max_elements_strings(self):
+        limits = Limits(max_elements=5)  # is_malicious, a and its items
+        assert scan(b'{"is_malicious": false, "a": ["x,y,z", ",,,,", "a"]}', limits) is NO_MATCH
+        assert exceeded(b'{"is_malicious": false, "a": ["x,y,z", ",,,,", "a", "b"]}', limits) == "elements"
+
+    # Test strings and keys longer than the limit are rejected, also when split across chunks.
+    def test_max_string(self):
+        limits = Limits(max_string=16)
+        long = b'"12345678901234567"'
+        assert scan(b'{"is_malicious": false, "a": ["1234567890123456", "x"]}', limits) is NO_MATCH
+        assert exceeded(b'{"is_malicious": false, "a": [' + long + b', "x"]}', limits) == "string"
+        assert exceeded(b'{"is_malicious": false, "a": ' + long + b'}', limits, size=3) == "string"
+        assert exceeded(b'{"is_malicious": false, ' + long + b': 1}', limits, size=2) == "string"
+        assert exceeded(b'{"a": ' + long + b', "b": "<script>"}', limits, rules=SIGNATURE_RULES) == "string"
+
+    # Test numbers are held to the string length limit wherever they are and however the body is split.
+    def test_max_string_numbers(self):
+        limits = Limits(max_string=16)
+        long = b'-1234567890.12345'
+        assert scan(b'{"is_malicious": false, "a": [-123456789.12345, 1]}', limits, size=3) is NO_MATCH
+        for size in (None, 1, 3, 7):
+            assert exceeded(b'{"is_malicious": false, "a": [' + long + b', 1]}', limits, size) == "string"
+            assert exceeded(b'{"is_malicious": false, "a": ' + long + b'}', limits, size) == "string"
+            assert exceeded(b'{"a": [' + long + b', "<script>"]}', limits, size, SIGNATURE_RULES) == "string"
+        assert scan(b'[-Infinity, 1]', Limits(max_string=4), size=1, rules=SIGNATURE_RULES) is NO_MATCH
+
+    # Test a long number split in small chunks is kept aside rather than scanned again with every chunk.
+    def test_long_number_chunks(self):
+        body = b'{"is_malicious": 1.' + b'0' * (4 * 1024 * 1024) + b'}'
+        start = time.perf_counter()
+        assert scan(body, Limits(), size=64).id == "is-malicious"
+        assert time.perf_counter() - start < 10
+        assert scan(b'{"is_malicious": tr' + b'ue, "a": 1}', Limits(), size=3).id == "is-malicious"
+        assert scan(b'{"is_malicious": -' + b'Infinity}', Limits(), size=1) is NO_MATCH
+        assert scan(b'{"is_malicious": 12', Limits(), size=1) is NO_MATCH
+
+    # Test structure limits only apply to bodies the prefilter sends to the tokenizer.
+    def test_prefiltered(self):
+        limits = Limits(max_depth=2, max_bytes=1000)
+        assert scan(b'[[[[1]]]]', limits) is NO_MATCH
+        assert exceeded(b'[' * 2000, limits) == "bytes"
+
+    # Test a streamed body is not kept aside whole while the prefilter has not fired.
+    def test_max_pending(self, monkeypatch):
+        monkeypatch.setattr(scanner, "MAX_PENDING", 8)
+        limits = Limits(max_depth=2)
+        body = b'[' * 3 + b'"x", ' * 10 + b'{"a": true}' + b']' * 3
+        assert scan(body, limits) is NO_MATCH  # a single chunk is only prefiltered
+        assert exceeded(body, limits, size=4) == "depth"
+        body = b'["' + b'x' * 20 + b'", {"is_malicious": true}]'
+        pipeline = BodyScanner(RULES)
+        assert pipeline.feed(body[:12]) is None and pipeline.feed(body[12:16]) is None
+        assert pipeline._pending is None
+        assert pipeline.feed(body[16:]).id == "is-malicious"
+
+    # Test no limit applies when every limit is disabled.
+    def test_no_limits(self):
+        limits = Limits(0, 0, 0, 0)
+        body = b'{"is_malicious": false, "a": ' + b'[' * 20000 + b'"' + b'x' * 100000 + b'"' + b']' * 20000 + b'}'
+        assert scan(body, limits, size=4096) is NO_MATCH
+
+    # Test a rejection crosses a process boundary with its response.
+    def test_pickle(self):
+        error = pickle.loads(pickle.dumps(Limits(max_depth=3).too_deep()))
+        assert (error.limit, error.status) == ("depth", 400)
+        assert error.response["code"] == 400
+        assert error.body.endswith(b"\n")
+
+    # Test bodies scanned in the process pool are checked against the limits of the pool.
+    def test_pool(self):
+        pool = ScanPool(RULES, 1, limits=Limits(max_depth=5))
+        try:
+            assert pool.scan(b'[[{"is_malicious": true}]]') is RULES.rules[0]
+            with pytest.raises(LimitExceeded) as error:
+                pool.scan(b'{"is_malicious": false, "a": [[[[[[1]]]]]]}')
+            assert error.value.limit == "depth"
+        finally:
+            pool.shutdown()
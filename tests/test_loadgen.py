@@ -0,0 +1,61 @@
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+from loadgen import Histogram, Mix, closed_loop, open_loop
+
+BASE_URL = os.getenv('BASE_URL', default='http://localhost:5000')
+
+
+# Class to unit test the load generator of benchmarks/loadgen.py
+class TestLoadgen:
+
+    # Test that percentiles are within the 1% precision of the histogram.
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for millis in range(1, 1001):
+            histogram.record(millis / 1000.0)
+
+        assert histogram.total == 1000
+        assert histogram.percentile(50) == pytest.approx(0.5, rel=0.02)
+        assert histogram.percentile(99) == pytest.approx(0.99, rel=0.02)
+        assert histogram.percentile(100) == 1.0
+
+    # Test that merged histograms count the samples of both.
+    def test_histogram_merge(self):
+        fast = Histogram()
+        slow = Histogram()
+        for _ in range(90):
+            fast.record(0.001)
+        for _ in range(10):
+            slow.record(1.0)
+        fast.merge(slow)
+
+        assert fast.total == 100
+        assert fast.percentile(50) == pytest.approx(0.001, rel=0.02)
+        assert fast.percentile(99) == pytest.approx(1.0, rel=0.02)
+
+    # Test that the mix has about the requested share of malicious bodies.
+    def test_mix(self):
+        mix = Mix(malicious_ratio=0.25)
+        bodies = [mix.next() for _ in range(1000)]
+
+        assert 150 < sum(body is mix.malicious for body in bodies) < 350
+
+    # Test a short closed loop run against the server.
+    def test_closed_loop(self):
+        results = closed_loop(f'{BASE_URL}/api/handle-request', Mix(malicious_ratio=0.5), concurrency=2, duration=0.5)
+
+        assert results.errors == 0
+        assert set(results.statuses) == {200, 403}
+        assert results.latency.total == sum(results.statuses.values())
+
+    # Test that an open loop sends the requests due at its rate, with or without keep-alive.
+    def test_open_loop(self):
+        results = open_loop(f'{BASE_URL}/api/handle-request', Mix(), rate=40, duration=0.5, connections=4,
+                            keep_alive=False)
+
+        assert results.errors == 0
+        assert results.statuses == {200: 20}
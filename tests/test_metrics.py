@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from metrics import Metrics, TIME_BUCKETS
+from rules import compile_rules
+
+RULES = compile_rules({"rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True]}],
+                       "signatures": [{"id": "sqli", "literal": "union select"}]})
+
+
+# the value of a sample line of an exposition
+def sample(metrics, name):
+    for line in metrics.exposition().splitlines():
+        key, _, value = line.rpartition(' ')
+        if key == name:
+            return float(value)
+    return None
+
+
+# Class to unit test the shared memory metrics of metrics.py
+class TestMetrics:
+
+    # Test the verdict counters and the request histogram.
+    def test_record(self):
+        metrics = Metrics(RULES, slots=4)
+        metrics.record(200, None, 100, 0.001)
+        metrics.record(403, RULES.rules[0], 2000, 0.003)
+        metrics.record(403, RULES.signatures.signatures[0], None, 0.0)
+
+        assert sample(metrics, 'waf_responses_total{code="200"}') == 1
+        assert sample(metrics, 'waf_responses_total{code="403"}') == 2
+        assert sample(metrics, 'waf_rule_matches_total{rule="is-malicious"}') == 1
+        assert sample(metrics, 'waf_rule_matches_total{rule="sqli"}') == 1
+        assert sample(metrics, 'waf_phase_seconds_count{phase="request"}') == 3
+        assert sample(metrics, 'waf_phase_seconds_sum{phase="request"}') == 0.004
+        assert sample(metrics, 'waf_request_body_bytes_count') == 2  # the third request had no Content-Length
+        assert sample(metrics, 'waf_request_body_bytes_bucket{le="128"}') == 1
+        assert sample(metrics, 'waf_request_body_bytes_bucket{le="+Inf"}') == 2
+
+    # Test that the configuration is reported as labels of waf_info.
+    def test_info(self):
+        assert sample(Metrics(RULES, slots=1, info={"json_decoder": "orjson"}), 'waf_info{json_decoder="orjson"}') == 1
+        assert 'waf_info' not in Metrics(RULES, slots=1).exposition()
+
+    # Test that the histogram buckets are cumulative and end with +Inf.
+    def test_buckets(self):
+        metrics = Metrics(RULES, slots=1)
+        metrics.observe('scan', 0.000003)  # 3 microseconds
+        metrics.observe('scan', 100.0)  # beyond the last bound
+
+        assert sample(metrics, 'waf_phase_seconds_bucket{phase="scan",le="2e-06"}') == 0
+        assert sample(metrics, 'waf_phase_seconds_bucket{phase="scan",le="4e-06"}') == 1
+        assert sample(metrics, 'waf_phase_seconds_bucket{phase="scan",le="+Inf"}') == 2
+        assert len([line for line in metrics.exposition().splitlines()
+                    if line.startswith('waf_phase_seconds_bucket{phase="scan"')]) == TIME_BUCKETS
+
+    # Test that threads record into their own slots and that exited threads give them back.
+    def test_threads(self):
+        metrics = Metrics(RULES, slots=2)
+
+        def work():
+            for _ in range(1000):
+                metrics.record(200, None, None, 0.0)
+
+        for _ in range(10):  # more threads than slots, one after the other
+            threads = [threading.Thread(target=work) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            del threads
+
+        assert sample(metrics, 'waf_responses_total{code="200"}') == 20000
+
+    # Test that the counts of forked worker processes are aggregated.
+    def test_workers(self):
+        metrics = Metrics(RULES, slots=8)
+        metrics.record(200, None, None, 0.0)
+        children = []
+        for _ in range(3):
+            pid = os.fork()
+            if pid == 0:  # worker
+                try:
+                    for _ in range(10):
+                        metrics.record(403, RULES.rules[0], None, 0.0)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        assert sample(metrics, 'waf_responses_total{code="200"}') == 1
+        assert sample(metrics, 'waf_responses_total{code="403"}') == 30
+        assert sample(metrics, 'waf_rule_matches_total{rule="is-malicious"}') == 30
@@ -0,0 +1,67 @@
+import pytest
+import json
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pool import ScanPool, PoolSaturated
+from rules import compile_rules
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+    {"id": "debug", "prefix": "__debug"},
+]})
+
+
+# Class to unit test the scanner process pool of pool.py
+class TestScanPool:
+
+    # Test verdicts computed in a worker process map back to the rules of this process.
+    def test_scan(self):
+        pool = ScanPool(RULES, 1)
+        try:
+            assert pool.scan(json.dumps({"data": [1] * 1000, "is_malicious": True}).encode()) is RULES.rules[0]
+            assert pool.scan(b'{"a": {"__debug_x": 1}}') is RULES.rules[1]
+            assert pool.scan(b'{"is_malicious": false}') is False
+        finally:
+            pool.shutdown()
+
+    # Test worker processes decode bodies with the decoder of the pool, with the same verdicts.
+    def test_decoder(self):
+        pool = ScanPool(RULES, 1, decoder="stdlib")
+        try:
+            assert pool.scan(json.dumps({"data": [{"a": 1}] * 100, "is_malicious": True}).encode()) is RULES.rules[0]
+            assert pool.scan(b'{"is_malicious": true, "is_malicious": false}') is RULES.rules[0]
+            assert pool.scan(b'{"is_malicious": false}') is False
+        finally:
+            pool.shutdown()
+
+    # Test worker processes scan large bodies with the structural index, with the same verdicts.
+    def test_index(self):
+        pool = ScanPool(RULES, 1, index_min_body=1)
+        try:
+            assert pool.scan(b'{"a": "\\"is_malicious\\": true", "b": [{"is_malicious": true}]}') is RULES.rules[0]
+            assert pool.scan(b'{"is_malicious": false, "__debugger": 1}') is RULES.rules[1]
+            assert pool.scan(b'{"is_malicious": false}') is False
+        finally:
+            pool.shutdown()
+
+    # Test a saturated pool rejects bodies instead of queueing them.
+    def test_saturated(self):
+        pool = ScanPool(RULES, 1, max_pending=1)
+        try:
+            pool.scan(b'{}')  # start the worker process
+            body = json.dumps({"data": ["x" * 100] * 200000}).encode()
+            thread = threading.Thread(target=pool.scan, args=(body,))
+            thread.start()
+            while pool._slots._value:  # wait until the body holds the only slot
+                pass
+
+            with pytest.raises(PoolSaturated):
+                pool.scan(b'{}')
+            thread.join()
+            assert pool.scan(b'{}') is False  # the slot is free again
+        finally:
+            pool.shutdown()
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from profiler import Profiler
+
+
+# stand-in for the Flask app: the profiler only swaps its wsgi_app
+class App:
+
+    def __init__(self):
+        self.wsgi_app = self.handle
+
+    # spends the number of milliseconds given as the body length in a function of its own
+    def handle(self, environ, start_response):
+        busy_wait(int(environ.get('CONTENT_LENGTH') or 0) / 1000.0)
+        start_response('200 OK', [])
+        return [b'']
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def call(app, millis):
+    return app.wsgi_app({'CONTENT_LENGTH': str(millis)}, lambda status, headers: None)
+
+
+# Class to unit test the sampling profiler of profiler.py
+class TestProfiler:
+
+    # Test that a stopped profiler leaves the original application in place.
+    def test_stopped(self):
+        app = App()
+        original = app.wsgi_app
+        profiler = Profiler(rate=1.0)
+        profiler.attach(app)
+        profiler.start()
+
+        assert app.wsgi_app != original
+        profiler.stop()
+        assert app.wsgi_app == original
+
+    # Test that profiled requests are sampled into collapsed stacks.
+    def test_collapsed_stacks(self, tmp_path):
+        app = App()
+        profiler = Profiler(rate=1.0, interval=0.001, directory=str(tmp_path))
+        profiler.attach(app)
+        profiler.start()
+        call(app, 100)
+        text = profiler.collapsed()
+        path = profiler.stop()
+
+        assert profiler.requests == 0  # reset by the dump
+        stacks = [line.rsplit(' ', 1) for line in text.splitlines()]
+        # the sampler thread only runs when the busy request thread lets go of the GIL, so the number of
+        # samples and where the request was when they were taken vary from run to run
+        assert sum(int(count) for _, count in stacks) >= 1
+        assert any('test_profiler:App.handle;test_profiler:busy_wait' in stack for stack, _ in stacks)
+        assert open(path).read() == text
+        assert os.path.basename(path).startswith('waf-profile-%d-' % os.getpid())
+
+    # Test that with a latency threshold only the slow requests are kept.
+    def test_min_seconds(self):
+        app = App()
+        profiler = Profiler(rate=0.0, min_seconds=0.05, interval=0.001)
+        profiler.attach(app)
+        profiler.start()
+        call(app, 20)
+        fast = profiler.requests
+        call(app, 80)
+        slow = profiler.requests
+        profiler.stop()
+
+        assert (fast, slow) == (0, 1)
+
+    # Test selection by body size.
+    def test_min_bytes(self):
+        app = App()
+        profiler = Profiler(rate=0.0, min_bytes=50, interval=0.001)
+        profiler.attach(app)
+        profiler.start()
+        call(app, 10)
+        call(app, 60)
+        requests = profiler.requests
+        profiler.stop()
+
+        assert requests == 1
+
+    # Test that the profiler can be toggled like the SIGUSR2 handler does.
+    def test_toggle(self, tmp_path):
+        app = App()
+        profiler = Profiler(rate=1.0, interval=0.001, directory=str(tmp_path))
+        profiler.attach(app)
+        profiler.toggle()
+        assert profiler.running
+        call(app, 30)
+        profiler.toggle()
+
+        assert not profiler.running
+        assert len(os.listdir(str(tmp_path))) == 1
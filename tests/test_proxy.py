@@ -0,0 +1,211 @@
+import pytest
+import io
+import json
+import threading
+import sys
+import os
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import proxy
+from proxy import Proxy, UpstreamPool
+from limits import Limits, LimitExceeded
+from pool import PoolSaturated
+from rules import compile_rules
+from scanner import BodyScanner
+
+RULES = compile_rules({"rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "found"}]})
+UNAVAILABLE = {"status": "error", "code": 502, "message": "upstream unavailable"}
+BAD_REQUEST = {"status": "error", "code": 400, "message": "request cannot be forwarded"}
+BUSY = {"status": "error", "code": 503, "message": "busy"}
+
+
+# scan function standing in for scan_request in app.py, it reads the body up to the first newline
+def scan(stream, length, encoding=None, content_type='application/json', query=''):
+    head = b''
+    while not head.endswith(b'\n'):
+        byte = stream.read(1)
+        if not byte:
+            break
+        head += byte
+    if head == b'busy':
+        raise PoolSaturated()
+    scanner = BodyScanner(RULES)
+    return scanner.feed(head) or scanner.close()
+
+
+# Stand-in upstream: echoes the request it got as JSON and counts the connections it accepted.
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        except ConnectionError:
+            self.close_connection = True
+
+    def echo(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        reply = json.dumps({"method": self.command, "path": self.path, "headers": dict(self.headers),
+                            "body": body.decode("latin-1")}).encode()
+        status = 418 if self.path == "/teapot" else 200
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.send_header("Keep-Alive", "timeout=5")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(reply)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_HEAD = echo
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    server.daemon_threads = True
+    Upstream.connections = 0
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    pool = UpstreamPool("http://127.0.0.1:%d" % server.server_address[1], size=4, timeout=5)
+    yield pool
+    pool.close()
+    server.shutdown()
+    server.server_close()
+
+
+# Flask stand-in for the local paths
+def fallback(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'local']
+
+
+# Call the proxy in-process.
+# returns the status line, headers dict and body
+def call(pool, body=b'', path='/api/orders', method='POST', headers=None, limits=None, query=''):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'CONTENT_TYPE': 'application/json', 'QUERY_STRING': query,
+               'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body), 'wsgi.url_scheme': 'http',
+               'REMOTE_ADDR': '10.0.0.7', 'HTTP_HOST': 'waf.example'}
+    environ.update(headers or {})
+    started = []
+    app = Proxy(fallback, scan, pool, UNAVAILABLE, BAD_REQUEST, limits=limits, busy=(PoolSaturated, BUSY),
+                rejected=LimitExceeded)
+    chunks = app(environ, lambda status, headers: started.append((status, dict(headers))))
+    try:
+        content = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return started[0][0], started[0][1], content
+
+
+# Class to unit test the reverse proxy mode of proxy.py
+class TestProxy:
+
+    # Test an allowed request is forwarded whole, with its method, path, query string and headers.
+    def test_forward(self, upstream):
+        body = b'{"is_malicious": false}\n' + b'x' * 200000
+        status, headers, content = call(upstream, body, query='a=1&b=%20', headers={'HTTP_X_TRACE': 'abc'})
+        echoed = json.loads(content)
+
+        assert status == '200 OK'
+        assert headers['Content-Type'] == 'application/json'
+        assert echoed['method'] == 'POST'
+        assert echoed['path'] == '/api/orders?a=1&b=%20'
+        assert echoed['body'].encode('latin-1') == body
+        assert echoed['headers']['X-Trace'] == 'abc'
+        assert echoed['headers']['X-Forwarded-For'] == '10.0.0.7'
+        assert echoed['headers']['X-Forwarded-Host'] == 'waf.example'
+        assert echoed['headers']['Host'] == upstream.netloc
+
+    # Test a forbidden request gets the response of the rule and is not forwarded.
+    def test_blocked(self, upstream):
+        status, headers, content = call(upstream, b'{"is_malicious": true}\n...')
+
+        assert status == '403 Forbidden'
+        assert json.loads(content) == RULES.rules[0].response
+        assert Upstream.connections == 0
+
+    # Test the status and headers of the upstream are returned, without its hop-by-hop headers.
+    def test_upstream_response(self, upstream):
+        status, headers, _ = call(upstream, path='/teapot', method='GET',
+                                  headers={'HTTP_CONNECTION': 'keep-alive, X-Secret', 'HTTP_X_SECRET': '1'})
+        assert status.startswith('418 ')
+        assert 'Keep-Alive' not in headers
+        status, _, content = call(upstream, method='HEAD')
+        assert status == '200 OK' and content == b''
+
+    # Test connections to the upstream are kept alive and reused.
+    def test_keep_alive(self, upstream):
+        for _ in range(5):
+            assert call(upstream, b'{}')[0] == '200 OK'
+        assert Upstream.connections == 1
+
+    # Test a pooled connection the upstream has closed is replaced.
+    def test_stale_connection(self, upstream):
+        assert call(upstream, b'{}')[0] == '200 OK'
+        upstream._idle[0].sock.shutdown(2)
+        assert call(upstream, b'{}')[0] == '200 OK'
+        assert Upstream.connections == 2
+
+    # Test an upstream that cannot be reached is answered with 502.
+    def test_unavailable(self):
+        pool = UpstreamPool("http://127.0.0.1:1", timeout=1)
+        status, _, content = call(pool, b'{}')
+
+        assert status == '502 Bad Gateway'
+        assert json.loads(content) == UNAVAILABLE
+
+    # Test a header that cannot be forwarded is answered with 400 and the pool stays usable.
+    def test_bad_header(self, upstream):
+        status, _, content = call(upstream, b'{}', headers={'HTTP_X_TRACE': 'a\r\nX-Injected: 1'})
+
+        assert status == '400 Bad Request'
+        assert json.loads(content) == BAD_REQUEST
+        assert Upstream.connections == 0
+        assert call(upstream, b'{}')[0] == '200 OK'
+
+    # Test the size limit applies to the part of the body the scanner does not read, and a busy scanner.
+    def test_rejected(self, upstream):
+        status, _, content = call(upstream, b'{}\n' + b'x' * 100, limits=Limits(max_bytes=50))
+        assert status == '413 Request Entity Too Large'
+        assert json.loads(content)['limit'] == 'bytes'
+        assert call(upstream, b'busy')[0] == '503 Service Unavailable'
+        assert Upstream.connections == 0
+
+    # Test a large body is spooled to a file rather than kept in memory.
+    def test_spool(self, upstream, monkeypatch):
+        files = []
+
+        def temporary_file(*args, **kwargs):
+            files.append(temporary(*args, **kwargs))
+            return files[-1]
+
+        temporary = tempfile.TemporaryFile
+        monkeypatch.setattr(tempfile, "TemporaryFile", temporary_file)  # the file a spool rolls over to
+        monkeypatch.setattr(proxy, "SPOOL_MEMORY", 1000)
+        body = b'{}\n' + b'y' * 100000
+        _, _, content = call(upstream, body)
+        assert json.loads(content)['body'].encode('latin-1') == body
+        assert len(files) == 1
+        assert call(upstream, b'{}\n' + b'y' * 500)[0] == '200 OK'
+        assert len(files) == 1  # a body within SPOOL_MEMORY stays in memory
+
+    # Test the local paths are not forwarded.
+    def test_local(self, upstream):
+        assert call(upstream, path='/metrics', method='GET')[2] == b'local'
+
+    # Test an upstream URL that is not http is a configuration error.
+    def test_bad_upstream(self):
+        with pytest.raises(ValueError):
+            UpstreamPool("ftp://example.com")
@@ -0,0 +1,129 @@
+import pytest
+import io
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ratelimit import BucketSketch, RateLimiter, Rate, parse_rates
+
+LIMITED = {"status": "error", "code": 429, "message": "too many requests"}
+
+
+# clock standing in for time.monotonic, moved by the tests
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# wsgi.input that fails the test if the body is read
+class Unread:
+
+    def read(self, *args):
+        raise AssertionError("the body of a limited request was read")
+
+
+# application behind the limiter, it reads the body
+def backend(environ, start_response):
+    environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
+
+
+# Call the limiter in-process.
+# returns the status line and headers dict
+def call(limiter, path='/api/handle-request', address='10.0.0.1', headers=None):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'POST', 'REMOTE_ADDR': address, 'CONTENT_LENGTH': '2',
+               'wsgi.input': io.BytesIO(b'{}')}
+    environ.update(headers or {})
+    started = []
+
+    def start_response(status, headers):
+        started.append((status, dict(headers)))
+        if status.startswith('429'):
+            environ['wsgi.input'] = Unread()
+
+    body = b''.join(limiter(environ, start_response))
+    if started[0][0].startswith('429'):
+        assert json.loads(body) == LIMITED
+    return started[0]
+
+
+def limiter(spec, clock, **kwargs):
+    return RateLimiter(backend, parse_rates(spec), LIMITED, sketch=BucketSketch(cells=1024, clock=clock), **kwargs)
+
+
+# Class to unit test the rate limiting of ratelimit.py
+class TestRateLimit:
+
+    # Test a client gets its burst at once, then its rate, and 429 with Retry-After beyond.
+    def test_bucket(self):
+        clock = Clock()
+        app = limiter('/api/handle-request=2:5', clock)
+        assert [call(app)[0] for _ in range(5)] == ['200 OK'] * 5
+        status, headers = call(app)
+        assert status == '429 Too Many Requests'
+        assert headers['Retry-After'] == '1'
+        clock.now += 0.5  # one token refilled
+        assert call(app)[0] == '200 OK'
+        assert call(app)[0].startswith('429')
+        clock.now += 100  # the bucket is full again, not fuller
+        assert [call(app)[0] for _ in range(6)] == ['200 OK'] * 5 + ['429 Too Many Requests']
+
+    # Test clients and routes have buckets of their own, and paths without a rate are not limited.
+    def test_keys(self):
+        app = limiter('/api/handle-request=1:1,*=1:2', Clock())
+        assert call(app)[0] == '200 OK'
+        assert call(app)[0].startswith('429')
+        assert call(app, address='10.0.0.2')[0] == '200 OK'
+        assert [call(app, path='/other')[0] for _ in range(3)] == ['200 OK', '200 OK', '429 Too Many Requests']
+        assert call(app, path='/another')[0].startswith('429')  # every other path shares the * bucket
+        app = limiter('/api/handle-request=1:1', Clock())
+        assert [call(app, path='/metrics')[0] for _ in range(5)] == ['200 OK'] * 5
+
+    # Test clients identified by a header, X-Forwarded-For by the address the last proxy added.
+    def test_key_header(self):
+        app = limiter('*=1:1', Clock(), key_header='X-Api-Key')
+        assert call(app, headers={'HTTP_X_API_KEY': 'a'})[0] == '200 OK'
+        assert call(app, headers={'HTTP_X_API_KEY': 'b'})[0] == '200 OK'
+        assert call(app, headers={'HTTP_X_API_KEY': 'a'}, address='10.0.0.9')[0].startswith('429')
+        app = limiter('*=1:1', Clock(), key_header='X-Forwarded-For')
+        assert call(app, headers={'HTTP_X_FORWARDED_FOR': '1.1.1.1, 192.0.2.7'})[0] == '200 OK'
+        assert call(app, headers={'HTTP_X_FORWARDED_FOR': '2.2.2.2, 192.0.2.7'})[0].startswith('429')
+
+    # Test the sketch takes the same memory however many clients it sees, and collisions only limit more.
+    def test_sketch(self):
+        clock = Clock()
+        sketch = BucketSketch(cells=64, depth=2, clock=clock)
+        rate = Rate(1, 1)
+        allowed = sum(not sketch.take(b'client %d' % n, rate) for n in range(10000))
+        assert len(sketch.region) == 64 * 2 * 8
+        assert 0 < allowed < 10000
+        clock.now += 10
+        assert sketch.take(b'client 1', rate) == 0
+        assert sketch.take(b'client 1', rate) > 0  # never more than its rate
+
+    # Test the buckets are shared with forked worker processes.
+    def test_fork(self):
+        sketch = BucketSketch(cells=64, clock=Clock())
+        rate = Rate(1, 1)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if sketch.take(b'client', rate) == 0 else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert sketch.take(b'client', rate) > 0
+
+    # Test the WAF_RATE_LIMITS format.
+    def test_parse(self):
+        rates = parse_rates(' /api/handle-request=100:200, *=0.5 ,')
+        assert rates['/api/handle-request'].rate == 100 and rates['/api/handle-request'].burst == 200
+        assert rates['*'].rate == 0.5 and rates['*'].burst == 1
+        assert parse_rates('') == {}
+        for spec in ('/a', '=5', '/a=0', '/a=x', '/a=5:0.5'):
+            with pytest.raises(ValueError):
+                parse_rates(spec)
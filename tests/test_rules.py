@@ -0,0 +1,100 @@
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rules import compile_rules, load_rules, RuleError
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+    {"id": "debug", "prefix": "__debug", "message": "debug keys are not allowed"},
+    {"id": "admin", "key": "role", "values": ["admin", "root"], "status": 401, "message": "no admins"},
+]})
+
+
+# Scan a body with the rules above, split into chunks of the given size.
+# returns the id of the rule that fired or None
+def scan(body, size=7):
+    scanner = BodyScanner(RULES)
+    data = json.dumps(body).encode()
+    for i in range(0, len(data), size):
+        verdict = scanner.feed(data[i:i + size])
+        if verdict is not None:
+            break
+    else:
+        verdict = scanner.close()
+    return verdict.id if verdict else None
+
+
+# Class to unit test the rule matcher of rules.py and how the scanner applies it
+class TestRules:
+
+    # Test every kind of rule in a single scan.
+    def test_rule_kinds(self):
+        assert scan({"hidden": {"is_malicious": 1}}) == "is-malicious"
+        assert scan({"a": [{"__debug_mode": [1, 2]}]}) == "debug"
+        assert scan({"user": {"role": "root"}}) == "admin"
+        assert scan({"role": "user", "is_malicious": False, "__debu": 1}) is None
+
+    # Test the first rule that fires in the body is reported.
+    def test_first_rule_reported(self):
+        assert scan({"role": "admin", "is_malicious": True}) == "admin"
+        assert scan({"is_malicious": True, "role": "admin"}) == "is-malicious"
+
+    # Test escaped keys and values.
+    def test_escaped_rule_keys(self):
+        assert BodyScanner(RULES).feed(b'{"\\u0072ole": "\\u0061dmin"}').id == "admin"
+        assert BodyScanner(RULES).feed(b'{"\\u005f_debug": 1}').id == "debug"
+
+        scanner = BodyScanner(RULES)
+        assert scanner.feed(b'{"\\u0072ole": "\\u0061dmins"}') is None
+        assert scanner.close() == NO_MATCH
+
+    # Test the rule responses.
+    def test_rule_response(self):
+        rule = RULES.rules[2]
+
+        assert rule.status == 401
+        assert rule.response == {"status": "error", "code": 401, "message": "no admins", "rule": "admin"}
+        assert json.loads(rule.body) == rule.response
+
+    # Test bodies in every encoding json.loads detects, fed a byte at a time.
+    def test_encodings(self):
+        text = json.dumps({"a": ["\u00e9\U0001f600"], "is_malicious": True}, ensure_ascii=False)
+        for encoding in ("utf-8-sig", "utf-16", "utf-16-le", "utf-16-be", "utf-32", "utf-32-le", "utf-32-be"):
+            body = text.encode(encoding)
+            assert BodyScanner(RULES).feed(body).id == "is-malicious", encoding
+            scanner = BodyScanner(RULES)
+            verdicts = [scanner.feed(body[i:i + 1]) for i in range(len(body))]
+            assert [verdict for verdict in verdicts if verdict is not None][0].id == "is-malicious", encoding
+        assert BodyScanner(RULES).feed('{"is_malicious": false}'.encode("utf-16")) is None
+        # not valid in its encoding
+        scanner = BodyScanner(RULES)
+        assert scanner.feed(b'{\x00"\x00' + b'\x00\xd8' + '", "is_malicious": true}'.encode("utf-16-le")) == NO_MATCH
+        assert scanner.close() == NO_MATCH
+        scanner = BodyScanner(RULES)
+        assert scanner.feed('{"is_malicious": true'.encode("utf-16-le") + b'\x00') is None
+        assert scanner.close() == NO_MATCH
+        assert BodyScanner(RULES).close() == NO_MATCH
+
+    # Test malformed rules are rejected.
+    def test_bad_rules(self):
+        with pytest.raises(RuleError):
+            compile_rules({"rules": [{"key": "a", "prefix": "b"}]})
+        with pytest.raises(RuleError):
+            compile_rules({"rules": [{"prefix": ""}]})
+        with pytest.raises(RuleError):
+            compile_rules({"rules": [{"key": "a", "values": [[1]]}]})
+        with pytest.raises(RuleError):
+            compile_rules({"rules": [{"key": "a", "status": 200}]})
+
+    # Test the default rule file keeps the original behavior.
+    def test_default_rules(self):
+        rules = load_rules(os.path.join(os.path.dirname(__file__), '..', 'rules.json'))
+
+        assert [rule.id for rule in rules.rules] == ["is-malicious"]
+        assert rules.match("is_malicious", True).message == "is_malicious found"
+        assert rules.match("is_malicious", False) is None
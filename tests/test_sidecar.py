@@ -0,0 +1,145 @@
+import pytest
+import json
+import socket
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sidecar import SidecarServer, encode_request, decode_response, RESPONSE
+from limits import Limits
+from pool import PoolSaturated
+from rules import compile_rules
+from scanner import BodyScanner
+
+RULES = compile_rules({"rules": [{"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "found"},
+                                 {"id": "teapot", "key": "tea", "status": 418, "message": "short and stout"}]})
+SEEN = []  # (content type, encoding, query) of the requests scanned
+
+
+# scan function standing in for scan_request in app.py
+def scan(stream, length, encoding=None, content_type='application/json', query=''):
+    SEEN.append((content_type, encoding, query))
+    body = stream.read()
+    if body == b'busy':
+        raise PoolSaturated()
+    if 'is_malicious=true' in query:
+        return RULES.rules[0]
+    if content_type != 'application/json':
+        return False
+    scanner = BodyScanner(RULES)
+    return scanner.feed(body) or scanner.close()
+
+
+# Start a sidecar on a socket in a temporary directory, with the given scan function and limits.
+def start(tmp_path, scan_function=scan, limits=None):
+    server = SidecarServer(str(tmp_path / "waf.sock"), scan_function, limits=limits, busy=PoolSaturated)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+def connect(server):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(server.server_address)
+    return connection
+
+
+# Receive the given number of response frames.
+def receive(connection, count=1):
+    data = b''
+    while len(data) < count * RESPONSE.size:
+        chunk = connection.recv(4096)
+        assert chunk
+        data += chunk
+    return [decode_response(data[start:start + RESPONSE.size]) for start in range(0, len(data), RESPONSE.size)]
+
+
+@pytest.fixture
+def sidecar(tmp_path):
+    server = start(tmp_path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Class to unit test the Unix domain socket sidecar of sidecar.py
+class TestSidecar:
+
+    # Test verdicts come back as the status code and number of the rule.
+    def test_verdict(self, sidecar):
+        with connect(sidecar) as connection:
+            connection.sendall(encode_request(b'{"is_malicious": true}'))
+            assert receive(connection) == [(403, 1)]
+            connection.sendall(encode_request(b'{"tea": "earl grey"}'))
+            assert receive(connection) == [(418, 2)]
+            connection.sendall(encode_request(b'{"is_malicious": false}'))
+            assert receive(connection) == [(200, 0)]
+
+    # Test the Content-Type, Content-Encoding and query string reach the scan function.
+    def test_fields(self, sidecar):
+        SEEN.clear()
+        with connect(sidecar) as connection:
+            connection.sendall(encode_request(b'a=1', 'text/plain', 'gzip', 'page=2&is_malicious=true'))
+            assert receive(connection) == [(403, 1)]
+            connection.sendall(encode_request(b'{}'))
+            assert receive(connection) == [(200, 0)]
+        assert SEEN == [('text/plain', 'gzip', 'page=2&is_malicious=true'), ('application/json', None, '')]
+
+    # Test pipelined requests are answered in order, however their frames are split.
+    def test_pipelined(self, sidecar):
+        bodies = [b'{"is_malicious": true}', b'{}', b'{"tea": 1}', b''.join([b'{"a": "', b'x' * 100000, b'"}'])] * 5
+        expected = [(403, 1), (200, 0), (418, 2), (200, 0)] * 5
+        frames = b''.join(encode_request(body) for body in bodies)
+        with connect(sidecar) as connection:
+            connection.sendall(frames)
+            assert receive(connection, len(bodies)) == expected
+            for start in range(0, len(frames), 7):
+                connection.sendall(frames[start:start + 7])
+            assert receive(connection, len(bodies)) == expected
+
+    # Test a body over the size limit is discarded and answered with 413, and the connection goes on.
+    def test_too_large(self, tmp_path):
+        server = start(tmp_path, limits=Limits(max_bytes=1000))
+        try:
+            with connect(server) as connection:
+                connection.sendall(encode_request(b'{"is_malicious": true}' + b' ' * 5000) +
+                                   encode_request(b'{"is_malicious": true}'))
+                assert receive(connection, 2) == [(413, 0), (403, 1)]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Test a busy scanner pool is answered with 503.
+    def test_busy(self, sidecar):
+        with connect(sidecar) as connection:
+            connection.sendall(encode_request(b'busy'))
+            assert receive(connection) == [(503, 0)]
+
+    # Test the socket of a previous run is replaced, and removed when the server is closed.
+    def test_socket_file(self, tmp_path):
+        start(tmp_path).server_close()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(str(tmp_path / "waf.sock"))
+        stale.close()
+        server = start(tmp_path)
+        server.shutdown()
+        server.server_close()
+        assert not (tmp_path / "waf.sock").exists()
+
+    # Test the sidecar gives the verdicts of the HTTP endpoint with the scan function of app.py.
+    def test_app(self, tmp_path):
+        import app
+        server = SidecarServer(str(tmp_path / "app.sock"), app.scan_request, limits=app.LIMITS, busy=PoolSaturated)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        try:
+            with connect(server) as connection:
+                connection.sendall(encode_request(json.dumps({"hidden": {"is_malicious": True}}).encode()) +
+                                   encode_request(b'is_malicious=true', 'application/x-www-form-urlencoded') +
+                                   encode_request(b'[' * 20000 + b'{"is_malicious": true}' + b']' * 20000) +
+                                   encode_request(b'{"is_malicious": false}'))
+                assert receive(connection, 4) == [(403, app.RULES.rules[0].number), (403, app.RULES.rules[0].number),
+                                                  (400, 0), (200, 0)]
+        finally:
+            server.shutdown()
+            server.server_close()
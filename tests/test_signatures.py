@@ -0,0 +1,97 @@
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rules import compile_rules, RuleError
+from scanner import BodyScanner
+
+RULES = compile_rules({
+    "rules": [
+        {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+    ],
+    "signatures": [
+        {"id": "sqli-union", "literal": "union select", "ignore_case": True, "message": "SQL injection"},
+        {"id": "sqli-union-all", "literal": "union all select", "ignore_case": True, "message": "SQL injection"},
+        {"id": "xss-script", "regex": "<script\\b", "ignore_case": True, "message": "script tag"},
+        {"id": "path-traversal", "regex": "(?:\\.\\./){2,}", "message": "path traversal"},
+        {"id": "repeated", "regex": "(ab)\\1{3}", "message": "repeated pair"},
+    ],
+})
+
+
+# Scan a body with the rules above, split into chunks of the given size.
+# returns the id of the signature or rule that fired, or None
+def scan(body, size=5):
+    scanner = BodyScanner(RULES)
+    data = json.dumps(body).encode()
+    for i in range(0, len(data), size):
+        verdict = scanner.feed(data[i:i + size])
+        if verdict is not None:
+            break
+    else:
+        verdict = scanner.close()
+    return verdict.id if verdict else None
+
+
+# Class to unit test the value signatures of signatures.py
+class TestSignatures:
+
+    # Test literal and regex signatures on string values anywhere in the body.
+    def test_signature_kinds(self):
+        assert scan({"q": "1 UNION Select password"}) == "sqli-union"
+        assert scan({"q": "1 union all select password"}) == "sqli-union-all"
+        assert scan({"a": [1, {"b": ["<SCRIPT src=x>"]}]}) == "xss-script"
+        assert scan(["../../../etc/passwd"]) == "path-traversal"
+        assert scan("abababab") == "repeated"
+        assert scan({"q": "union of states", "file": "../x", "html": "<scripts>"}) is None
+
+    # Test key rules and signatures are checked in the same scan.
+    def test_rules_and_signatures(self):
+        assert scan({"is_malicious": True, "q": "union select"}) == "is-malicious"
+        assert scan({"q": "union select", "is_malicious": True}) == "sqli-union"
+
+    # Test escaped values are decoded before they are searched.
+    def test_escaped_values(self):
+        data = b'{"q": "\\u003cscript>"}'
+
+        assert BodyScanner(RULES).feed(data).id == "xss-script"
+
+    # Test keys are not searched, only values.
+    def test_keys_not_searched(self):
+        assert scan({"<script>": 1}) is None
+
+    # Test the signature responses.
+    def test_signature_response(self):
+        signature = RULES.signatures.search("<script>")
+
+        assert signature.number == 4  # numbered after the rule
+        assert json.loads(signature.body) == {"status": "error", "code": 403, "message": "script tag",
+                                              "signature": "xss-script"}
+
+    # Test regexes with named groups, including the names of the groups of the combined pattern.
+    def test_named_groups(self):
+        rules = compile_rules({"signatures": [
+            {"id": "literal", "regex": "(?P<literal>evil)"},
+            {"id": "r0", "regex": "(?P<r0>bad)"},
+            {"id": "word", "regex": "(?P<w>x+)y(?P=w)"},
+            {"id": "word-again", "regex": "(?P<w>z+)q"},
+            {"id": "plain", "regex": "nope"},
+        ]})
+        assert rules.signatures.search("an evil one").id == "literal"
+        assert rules.signatures.search("too bad").id == "r0"
+        assert rules.signatures.search("xxyxx").id == "word"
+        assert rules.signatures.search("zzq").id == "word-again"
+        assert rules.signatures.search("nope").id == "plain"
+        assert rules.signatures.search("fine") is None
+
+    # Test malformed signatures are rejected.
+    def test_bad_signatures(self):
+        with pytest.raises(RuleError):
+            compile_rules({"signatures": [{"literal": "a", "regex": "b"}]})
+        with pytest.raises(RuleError, match="bad-group"):
+            compile_rules({"signatures": [{"id": "bad-group", "regex": "("}]})
+        with pytest.raises(RuleError):
+            compile_rules({"signatures": [{"literal": ""}]})
@@ -0,0 +1,114 @@
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+pytest.importorskip("numpy")
+
+import structural
+from structural import scan_indexed
+from limits import Limits, LimitExceeded
+from rules import compile_rules
+from scanner import BodyScanner, NO_MATCH
+
+RULES = compile_rules({"rules": [
+    {"id": "is-malicious", "key": "is_malicious", "values": [True], "message": "is_malicious found"},
+    {"id": "debug", "prefix": "__debug"},
+]})
+LIMITS = Limits(max_bytes=10 ** 7, max_depth=10000, max_elements=10 ** 6, max_string=10 ** 6)
+
+
+# the verdict of the streaming pipeline, the name of the limit for a rejected body
+def streamed(body, limits=LIMITS, rules=RULES):
+    scanner = BodyScanner(rules, limits)
+    try:
+        return scanner.feed(body) or scanner.close()
+    except LimitExceeded as error:
+        return error.limit
+
+
+# the verdict of the index, the name of the limit for a rejected body
+def indexed(body, limits=LIMITS, rules=RULES):
+    try:
+        return scan_indexed(body, rules, limits)
+    except LimitExceeded as error:
+        return error.limit
+
+
+# Class to unit test the structural index of structural.py
+class TestStructural:
+
+    # Test indexed bodies get the verdict of the streaming scanner.
+    def test_scan(self):
+        bodies = [
+            {"is_malicious": True},
+            {"hidden": [1, 2, {"is_malicious": 1.0}]},
+            {"is_malicious": False, "data": list(range(100))},
+            {"a": {"__debug_mode": {"x": 1}}},
+            {"is_malicious": [True]},
+            [{"name": "x"}] * 10 + [{"is_malicious": None}],
+            {"is_malicious": False, "is_malicious ": True, "b": {"is_malicious": True}},
+        ]
+        for body in bodies:
+            body = json.dumps(body).encode()
+            assert indexed(body) is streamed(body)
+        assert indexed(b'{"a": "no key here"}') is NO_MATCH
+        assert indexed(b'{"is_m\\u0061licious" :\n true}') is RULES.rules[0]
+
+    # Test spellings of the keys that are not keys are told apart from keys.
+    def test_not_keys(self):
+        for body in (b'{"a": "\\"is_malicious\\": true"}',
+                     b'{"a": ["x", "is_malicious", "__debug"]}',
+                     b'{"a": "x\\\\", "b": "is_malicious"}',
+                     b'{"a": "{\\"__debug\\": 1, \\"is_malicious\\": true}"}'):
+            assert indexed(body) is NO_MATCH
+            assert streamed(body) is NO_MATCH
+        # the key after a string that ends in an escaped backslash
+        assert indexed(b'{"a": "x\\\\", "is_malicious": true}') is RULES.rules[0]
+
+    # Test runs of backslashes and strings that span blocks.
+    def test_blocks(self, monkeypatch):
+        monkeypatch.setattr(structural, "BLOCK_SIZE", 7)
+        bodies = [b'{"a": "' + b'\\' * n + b'\\"", "is_malicious": true}' for n in range(0, 20, 2)]
+        bodies += [b'{"a": "' + b'\\' * n + b'", "is_malicious": true}' for n in range(0, 20, 2)]
+        bodies += [b'{"a": "' + b'\\' * n + b'\\", "is_malicious": true}"}' for n in range(0, 20, 2)]
+        bodies += [b' ' * n + b'{"a": "x,\\"is_malicious\\":1}", \t "__debug": 1}' for n in range(8)]
+        for body in bodies:
+            assert indexed(body) is streamed(body), body
+
+    # Test a hit is confirmed by the scanner, which may stop at an error first.
+    def test_confirm(self):
+        assert indexed(b'{"a": 1 2, "is_malicious": true}') is NO_MATCH
+        assert indexed(b'{"is_malicious": true, oops') is RULES.rules[0]
+        assert indexed(b'["is_malicious", {"__debug": 1}]') is RULES.rules[1]
+        assert indexed(b'{"is_malicious": truex}') is NO_MATCH
+
+    # Test bodies that could go over a limit are left to the scanner.
+    def test_limits(self):
+        body = json.dumps({"is_malicious": False, "a": [[[1]]], "b": "x" * 20}).encode()
+        assert indexed(body, Limits(max_depth=2)) is None
+        assert indexed(body, Limits(max_depth=4)) is NO_MATCH
+        assert indexed(body, Limits(max_elements=3)) is None
+        assert indexed(body, Limits(max_string=10)) is None
+        assert indexed(body, Limits(max_string=20)) is NO_MATCH
+        body = json.dumps({"is_malicious": False, "n": [10 ** 30, 1]}).encode()
+        assert indexed(body, Limits(max_string=30)) is None
+        assert indexed(body, Limits(max_string=31)) is NO_MATCH
+        assert indexed(body, Limits(max_bytes=10)) is None
+        deep = b'[' * 20 + b'{"is_malicious": true}' + b']' * 20
+        assert indexed(deep, Limits(max_depth=100)) is RULES.rules[0]
+        assert indexed(deep, Limits(max_depth=10)) is None
+
+    # Test rule sets with signatures or keys with escaped characters are left to the scanner.
+    def test_unindexed(self):
+        rules = compile_rules({"rules": [{"id": "m", "key": "is_malicious"}],
+                               "signatures": [{"id": "xss", "literal": "<script"}]})
+        assert scan_indexed(b'{"a": "<script>"}', rules, LIMITS) is None
+        rules = compile_rules({"rules": [{"id": "q", "key": "a\"b"}]})
+        assert scan_indexed(b'{"a\\u0022b": 1}', rules, LIMITS) is None
+        # bodies that are not in UTF-8 are transcoded by the BodyScanner
+        for body in (b'\xef\xbb\xbf{"is_malicious": true}', '{"is_malicious": true}'.encode('utf-16-be')):
+            assert indexed(body) is None
+            assert streamed(body) is RULES.rules[0]
@@ -0,0 +1,62 @@
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import traverse_object, NestingTooDeep
+
+
+# Class to unit test the traverse_object generator of app.py
+class TestTraverseObject:
+
+    # Test the depth first order of the example in app.py.
+    def test_traverse_order(self):
+        obj = {
+            "language": "Python",
+            "framework": "Flask",
+            "website": "Scotch",
+            "version_info": {
+                "python": 3.4,
+                "flask": 0.12
+            },
+            "examples": [{"is_malicious": {"is_malicious": "false"}}, "form", "json"],
+            "boolean_test": True
+        }
+
+        assert list(traverse_object(obj)) == [
+            ('language', 'Python'),
+            ('framework', 'Flask'),
+            ('website', 'Scotch'),
+            ('python', 3.4),
+            ('flask', 0.12),
+            ('is_malicious', 'false'),
+            (1, 'form'),
+            (2, 'json'),
+            ('boolean_test', True),
+        ]
+
+    # Test a scalar at the root and empty containers.
+    def test_traverse_scalar_and_empty(self):
+        assert list(traverse_object(None)) == [(None, None)]
+        assert list(traverse_object("x", "key")) == [("key", "x")]
+        assert list(traverse_object({"a": [], "b": {}, "c": [[], {"d": 1}]})) == [("d", 1)]
+
+    # Test nesting far deeper than the recursion limit.
+    def test_traverse_deep(self):
+        root = leaf = []
+        for _ in range(sys.getrecursionlimit() * 10):
+            child = []
+            leaf.append(child)
+            leaf = child
+        leaf.append({"is_malicious": True})
+
+        assert list(traverse_object(root, max_depth=None)) == [("is_malicious", True)]
+
+    # Test the configurable nesting limit.
+    def test_traverse_depth_limit(self):
+        assert list(traverse_object([[1]], max_depth=2)) == [(0, 1)]
+
+        with pytest.raises(NestingTooDeep):
+            list(traverse_object([[[1]]], max_depth=2))
+